@@ -25,6 +25,7 @@ extras_require = {
     'testing': [
         'nose',
         'coverage',
+        'WebTest',
     ],
 }
 
@@ -54,5 +55,17 @@ setup(
     main = todopyramid:main
     [console_scripts]
     initialize_todopyramid_db = todopyramid.scripts.initializedb:main
+    check_todopyramid_counters = todopyramid.scripts.counters:main
+    import_todopyramid_tasks = todopyramid.scripts.importtasks:main
+    benchmark_todopyramid_grid = todopyramid.scripts.benchgrid:main
+    migrate_todopyramid_db = todopyramid.scripts.migrate:main
+    explain_todopyramid_queries = todopyramid.scripts.explainqueries:main
+    load_test_todopyramid_db = todopyramid.scripts.loadtest:main
+    build_todopyramid_assets = todopyramid.scripts.buildassets:main
+    purge_todopyramid_archive = todopyramid.scripts.purgearchive:main
+    rebuild_todopyramid_search = todopyramid.scripts.rebuildsearch:main
+    run_todopyramid_reminders = todopyramid.scripts.reminders:main
+    generate_todopyramid_data = todopyramid.scripts.generatedata:main
+    benchmark_todopyramid_views = todopyramid.scripts.benchviews:main
     """,
 )
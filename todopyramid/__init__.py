@@ -1,37 +1,62 @@
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
+from pyramid.renderers import JSON
 
+from .assets import STATIC_VIEWS
+from .assets import assets_from_settings
+from .database import engine_from_settings
+from .formcache import FormCache
+from .fragments import fragment_cache_from_settings
+from .instrumentation import setup_query_count
+from .instrumentation import setup_timing
 from .models import (
     DBSession,
     Base,
     )
+from .profiles import ProfileCache
+from .reminders import start_reminders
+from .search import has_search_index
+from .tagindex import TagIndex
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = engine_from_settings(settings)
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
     config = Configurator(
         settings=settings,
         root_factory='todopyramid.models.RootFactory',
     )
-    config.include('pyramid_persona')
-    config.include('deform_bootstrap_extra')
-    config.add_static_view('static', 'static', cache_max_age=3600)
-    # Adding the static resources from Deform
-    config.add_static_view(
-        'deform_static', 'deform:static', cache_max_age=3600
+    config.registry.tag_index = TagIndex(
+        max_bytes=int(settings.get('todopyramid.tag_index.max_bytes',
+                                   8 * 1024 * 1024)),
+        limit=int(settings.get('todopyramid.tag_index.limit', 10)),
     )
-    config.add_static_view(
-        'deform_bootstrap_static', 'deform_bootstrap:static',
-        cache_max_age=3600
+    config.registry.profile_cache = ProfileCache(
+        ttl=int(settings.get('todopyramid.profile_cache.ttl', 300)),
+        max_entries=int(settings.get('todopyramid.profile_cache.max_entries',
+                                     10000)),
     )
-    config.add_static_view(
-        'deform_bootstrap_extra_static', 'deform_bootstrap_extra:static',
-        cache_max_age=3600
+    config.registry.fragment_cache = fragment_cache_from_settings(settings)
+    with engine.connect() as connection:
+        config.registry.full_text_search = has_search_index(connection)
+    config.registry.form_cache = FormCache(
+        max_entries=int(settings.get('todopyramid.form_cache.max_entries',
+                                     1000)),
     )
+    # Reminders for tasks as they come due, when sent from this process
+    config.registry.reminders = start_reminders(engine, settings)
+    setup_query_count(config, engine)
+    setup_timing(config, engine)
+    config.include('pyramid_persona')
+    config.include('deform_bootstrap_extra')
+    # The static files of the app and of Deform
+    for name, spec in STATIC_VIEWS:
+        config.add_static_view(name, spec, cache_max_age=3600)
+    # Bundles of the static files built by build_todopyramid_assets
+    config.registry.assets = assets_from_settings(settings)
+    config.add_route('bundle', '/bundles/{filename}')
     # Misc. views
     config.add_route('home', '/')
     config.add_route('about', '/about')
@@ -41,5 +66,12 @@ def main(global_config, **settings):
     config.add_route('list', '/list')
     config.add_route('tags', '/tags')
     config.add_route('tag', '/tags/{tag_name}')
+    config.add_route('archive', '/archive')
+    config.add_route('search', '/search')
+    config.add_route('export', '/export.{format}')
+    # JSON API
+    config.add_renderer('compact_json', JSON(separators=(',', ':')))
+    config.add_route('api.tasks', '/api/tasks')
+    config.add_route('api.task', '/api/tasks/{id}')
     config.scan()
     return config.make_wsgi_app()
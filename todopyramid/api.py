@@ -0,0 +1,229 @@
+import colander
+from pyramid.decorator import reify
+from pyramid.httpexceptions import HTTPNoContent
+from pyramid.security import authenticated_userid
+from pyramid.view import view_config
+
+from .database import locked_retries
+from .importer import format_invalid
+from .importer import record_to_cstruct
+from .models import DBSession
+from .models import Tag
+from .models import TodoItem
+from .models import TodoUser
+from .models import load_sorted_tags
+from .paging import paginate
+from .paging import sort_params
+from .profiles import profile_time_zone
+from .schema import TodoSchema
+from .tasks import captured_values
+from .tasks import delete_task
+from .tasks import save_task
+from .utils import TimezoneConverter
+
+FIELDS = ('id', 'name', 'tags', 'due_date')
+
+
+class TaskAPI(object):
+    """A JSON API for the tasks of the logged in user, for clients that
+    only need the data. The input is validated with the TodoSchema
+    nodes, but no form is ever built or rendered. The responses use the
+    `compact_json` renderer. Requests that change tasks have to send the
+    session's CSRF token in an X-CSRF-Token header, as a page would.
+    The token is sent back in the same header by `list_tasks`.
+    """
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+        self.user_id = authenticated_userid(request)
+
+    @reify
+    def profile(self):
+        return self.request.registry.profile_cache.get(self.user_id)
+
+    @reify
+    def time_zone(self):
+        return profile_time_zone(self.profile)
+
+    @reify
+    def converter(self):
+        return TimezoneConverter(self.time_zone)
+
+    def load_user(self):
+        """The logged in user, or None when their account is gone, as
+        happens when the database is blown away.
+        """
+        query = DBSession.query(TodoUser)
+        return query.filter(TodoUser.email == self.user_id).first()
+
+    def no_user(self):
+        return self.error(403, error='No such user, sign in again')
+
+    def error(self, status, **body):
+        self.request.response.status = status
+        return body
+
+    def serialize(self, items, fields):
+        """Turn tasks into dicts with only the requested fields. The
+        tags are loaded for all of the tasks at once, and only if asked
+        for.
+        """
+        tag_map = None
+        if 'tags' in fields:
+            tag_map = load_sorted_tags([item.id for item in items])
+        rows = []
+        for item in items:
+            row = {}
+            if 'id' in fields:
+                row['id'] = item.id
+            if 'name' in fields:
+                row['name'] = item.task
+            if 'tags' in fields:
+                row['tags'] = tag_map[item.id]
+            if 'due_date' in fields:
+                due_date = item.due_date
+                if due_date is not None:
+                    due_date = self.converter.localize(due_date).isoformat()
+                row['due_date'] = due_date
+            rows.append(row)
+        return rows
+
+    def deserialize(self):
+        """Validate the JSON body of the request against the TodoSchema.
+        Returns the name, tags and due date to store. Raises ValueError
+        for a body that is not a JSON object, and colander.Invalid for
+        invalid values.
+        """
+        try:
+            record = self.request.json_body
+        except ValueError:
+            raise ValueError('Invalid JSON')
+        if not isinstance(record, dict):
+            raise ValueError('Expected a JSON object')
+        schema = TodoSchema().bind(user_tz=self.time_zone)
+        return captured_values(schema.deserialize(record_to_cstruct(record)))
+
+    def save(self, task_id=None):
+        try:
+            name, tags, due_date = self.deserialize()
+        except colander.Invalid as e:
+            return self.error(400, error=format_invalid(e))
+        except ValueError as e:
+            return self.error(400, error=str(e))
+        for attempt in locked_retries():
+            with attempt:
+                user = self.load_user()
+                if user is None:
+                    return self.no_user()
+                task, created, added_tags, removed_tags = save_task(
+                    user, name, tags, due_date, task_id=task_id)
+                DBSession.flush()
+                result = self.serialize([task], FIELDS)[0]
+        if added_tags or removed_tags:
+            self.request.registry.tag_index.invalidate(self.user_id)
+        return result
+
+    def task_id(self):
+        """The id of one of the user's tasks from the url, or None.
+        """
+        try:
+            task_id = int(self.request.matchdict['id'])
+        except ValueError:
+            return None
+        query = DBSession.query(TodoItem.id).filter(
+            TodoItem.id == task_id,
+            TodoItem.user == self.user_id,
+        )
+        if query.first() is None:
+            return None
+        return task_id
+
+    @view_config(route_name='api.tasks', request_method='GET',
+                 renderer='compact_json', permission='view')
+    def list_tasks(self):
+        """List a page of tasks. The `fields` to include can be given as
+        a comma separated list, the list can be narrowed down to a `tag`,
+        and is paged and sorted with the same parameters as the todo
+        list, plus a `limit` of up to the page size.
+        """
+        params = self.request.GET
+        fields = params.get('fields')
+        fields = fields.split(',') if fields else FIELDS
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            return self.error(
+                400, error='Unknown fields: %s' % ', '.join(unknown))
+        settings = self.request.registry.settings
+        page_size = int(settings.get('todopyramid.page_size', 100))
+        try:
+            limit = min(int(params.get('limit', page_size)), page_size)
+        except ValueError:
+            limit = page_size
+        limit = max(limit, 1)
+        query = DBSession.query(TodoItem).filter(
+            TodoItem.user == self.user_id)
+        tag_name = params.get('tag')
+        if tag_name:
+            query = query.filter(TodoItem.tags.any(Tag.name == tag_name))
+        order, order_dir = sort_params(
+            params.get('order_col'), params.get('order_dir'))
+        page = paginate(
+            query,
+            order,
+            order_dir,
+            limit,
+            after=params.get('after'),
+            before=params.get('before'),
+        )
+        self.request.response.headers['X-CSRF-Token'] = \
+            self.request.session.get_csrf_token()
+        return {
+            'tasks': self.serialize(page.items, fields),
+            'next': page.next_cursor,
+            'prev': page.prev_cursor,
+        }
+
+    @view_config(route_name='api.tasks', request_method='POST',
+                 renderer='compact_json', permission='view',
+                 check_csrf=True)
+    def create_task(self):
+        """Create a task from a JSON object with the `name`, `tags` and
+        `due_date` of the task.
+        """
+        result = self.save()
+        if 'id' in result:
+            self.request.response.status = 201
+            self.request.response.location = self.request.route_url(
+                'api.task', id=result['id'])
+        return result
+
+    @view_config(route_name='api.task', request_method='PUT',
+                 renderer='compact_json', permission='view',
+                 check_csrf=True)
+    def update_task(self):
+        """Replace the name, tags and due date of a task.
+        """
+        task_id = self.task_id()
+        if task_id is None:
+            return self.error(404, error='No such task')
+        return self.save(task_id)
+
+    @view_config(route_name='api.task', request_method='DELETE',
+                 renderer='compact_json', permission='view',
+                 check_csrf=True)
+    def delete_task(self):
+        """Delete a task, answering with no content.
+        """
+        task_id = self.task_id()
+        if task_id is None:
+            return self.error(404, error='No such task')
+        for attempt in locked_retries():
+            with attempt:
+                user = self.load_user()
+                if user is None:
+                    return self.no_user()
+                tags = delete_task(user, task_id)
+        if tags:
+            self.request.registry.tag_index.invalidate(self.user_id)
+        return HTTPNoContent()
@@ -0,0 +1,70 @@
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from .models import ArchivedTask
+from .models import DBSession
+
+ArchivePage = namedtuple('ArchivePage', ['items', 'prev_id', 'next_id'])
+
+
+def archive_page(user_id, page_size, after=None, before=None):
+    """Fetch one page of a user's archive, most recently completed first.
+    `after` and `before` are the ids of the last and the first task of
+    the pages linked to as next and previous. The ids of the archive
+    only go up as tasks are completed, so paging by id walks the index
+    on (user, id), however deep into the archive the page is.
+    """
+    qry = DBSession.query(ArchivedTask)
+    qry = qry.filter(ArchivedTask.user == user_id)
+    forward = after is not None or before is None
+    if after is not None:
+        qry = qry.filter(ArchivedTask.id < after)
+        qry = qry.order_by(ArchivedTask.id.desc())
+    elif before is not None:
+        qry = qry.filter(ArchivedTask.id > before)
+        qry = qry.order_by(ArchivedTask.id)
+    else:
+        qry = qry.order_by(ArchivedTask.id.desc())
+    items = qry.limit(page_size + 1).all()
+    more = len(items) > page_size
+    items = items[:page_size]
+    if forward:
+        has_prev, has_next = after is not None, more
+    else:
+        items.reverse()
+        has_prev, has_next = more, True
+    if not items:
+        return ArchivePage(items, None, None)
+    return ArchivePage(
+        items,
+        items[0].id if has_prev else None,
+        items[-1].id if has_next else None,
+    )
+
+
+def purge_archive(engine, cutoff, chunk_size=1000):
+    """Delete the tasks completed before `cutoff` from the archive. The
+    oldest tasks are deleted a chunk at a time, each in its own
+    transaction, so that requests are not locked out for long. Returns
+    the number of tasks deleted.
+    """
+    table = ArchivedTask.__table__
+    oldest = select([table.c.id]).where(table.c.completed < cutoff)
+    oldest = oldest.order_by(table.c.completed).limit(chunk_size)
+    purged = 0
+    while True:
+        with engine.begin() as connection:
+            result = connection.execute(
+                table.delete().where(table.c.id.in_(oldest)))
+        purged += result.rowcount
+        if result.rowcount < chunk_size:
+            return purged
+
+
+def compact(engine):
+    """Give the space freed by purging back to the file system. Only
+    SQLite needs this, other backends reclaim space on their own.
+    """
+    if engine.dialect.name == 'sqlite':
+        engine.execute('VACUUM')
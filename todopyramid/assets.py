@@ -0,0 +1,294 @@
+from hashlib import sha1
+import gzip
+import io
+import json
+import os
+import posixpath
+import re
+
+import pkg_resources
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.path import AssetResolver
+from pyramid.response import FileResponse
+from pyramid.settings import asbool
+from pyramid.view import view_config
+
+try:
+    from rjsmin import jsmin
+except ImportError:  # pragma: no cover
+    jsmin = None
+
+# The static views of the app, as (url name, asset spec)
+STATIC_VIEWS = [
+    ('static', 'todopyramid:static'),
+    ('deform_static', 'deform:static'),
+    ('deform_bootstrap_static', 'deform_bootstrap:static'),
+    ('deform_bootstrap_extra_static', 'deform_bootstrap_extra:static'),
+]
+
+# The css and javascript the templates load, in the order they load it
+BUNDLES = {
+    'layout.css': [
+        'deform_bootstrap:static/deform_bootstrap.css',
+        'todopyramid:static/bootglyph/css/icon.css',
+    ],
+    'main.css': [
+        'todopyramid:static/main.css',
+    ],
+    'layout.js': [
+        'deform:static/scripts/jquery-1.7.2.min.js',
+        'deform:static/scripts/deform.js',
+        'deform_bootstrap:static/deform_bootstrap.js',
+        'deform_bootstrap:static/bootstrap.min.js',
+    ],
+    'todo_list.css': [
+        'deform:static/css/jquery.autocomplete.css',
+        'deform:static/css/ui-lightness/jquery-ui-1.8.11.custom.css',
+        'deform:static/css/jquery-ui-timepicker-addon.css',
+        ('deform_bootstrap_extra:static/jQuery-Tags-Input/'
+         'jquery.tagsinput.css'),
+    ],
+    'todo_list.js': [
+        'todopyramid:static/moment.min.js',
+        'deform:static/scripts/jquery-ui-1.8.11.custom.min.js',
+        'deform:static/scripts/jquery-ui-timepicker-addon.js',
+        ('deform_bootstrap_extra:static/jQuery-Tags-Input/'
+         'jquery.tagsinput.min.js'),
+        'todopyramid:static/bootbox.min.js',
+        'todopyramid:static/todo_list.js',
+    ],
+}
+
+BUNDLE_DIRECTORY = 'todopyramid:static/bundles'
+MANIFEST = 'manifest.json'
+ONE_YEAR = 365 * 24 * 60 * 60
+CONTENT_TYPES = {
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+}
+# The names `build_bundles` gives the bundles
+BUNDLE_FILENAME = re.compile(r'^[\w-]+\.[0-9a-f]{12}\.(css|js)$')
+
+# Only ASCII whitespace is collapsed. The files are read as latin-1, and
+# the non-breaking space and NEL that \s also matches would be bytes of
+# UTF-8 characters.
+WHITESPACE = ' \t\n\r\f\v'
+CSS_COMMENT = re.compile(r'/\*(?!!).*?\*/', re.S)
+CSS_SPACE = re.compile(r'[ \t\n\r\f\v]+')
+CSS_PUNCTUATION = re.compile(r'[ \t\n\r\f\v]*([{};,])[ \t\n\r\f\v]*')
+CSS_URL = re.compile(
+    r'url\([ \t\n\r\f\v]*([\'"]?)([^\'")]+)\1[ \t\n\r\f\v]*\)')
+
+
+def asset_path(spec):
+    """The file an asset spec points to.
+    """
+    return AssetResolver().resolve(spec).abspath()
+
+
+def static_path(spec):
+    """The url path, relative to the app, of an asset served by one of
+    the STATIC_VIEWS.
+    """
+    for name, prefix in STATIC_VIEWS:
+        if spec.startswith(prefix + '/'):
+            return name + spec[len(prefix):]
+    raise ValueError('%s is not served by a static view' % spec)
+
+
+def rewrite_css_urls(css, spec):
+    """Point the relative urls of a stylesheet at the static view the
+    file is normally served from, so they still work from the bundle
+    directory.
+    """
+    base = posixpath.dirname(static_path(spec))
+
+    def rewrite(match):
+        quote, url = match.groups()
+        if url.startswith(('/', '#', 'data:', 'http:', 'https:')):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(base, url))
+        return 'url(%s../%s%s)' % (quote, path, quote)
+
+    return CSS_URL.sub(rewrite, css)
+
+
+def minify_css(css):
+    """Drop the comments and the whitespace that does not matter. Comments
+    starting with /*! are kept, as they usually hold a license.
+    """
+    css = CSS_COMMENT.sub('', css)
+    css = CSS_SPACE.sub(' ', css)
+    return CSS_PUNCTUATION.sub(r'\1', css).strip(WHITESPACE)
+
+
+def minify_js(js):
+    """Minify javascript with rjsmin when it is installed. Most of the
+    scripts are shipped minified already, and the bundles are gzipped
+    either way.
+    """
+    if jsmin is None:
+        return js.strip(WHITESPACE)
+    return jsmin(js).strip(WHITESPACE)
+
+
+def bundle_content(specs):
+    """Concatenate and minify the files of a bundle. The files are read
+    as latin-1 so that their bytes are passed on untouched, whatever
+    their encoding.
+    """
+    parts = []
+    for spec in specs:
+        with io.open(asset_path(spec), 'rb') as f:
+            text = f.read().decode('latin-1')
+        if spec.endswith('.css'):
+            parts.append(minify_css(rewrite_css_urls(text, spec)))
+        else:
+            parts.append(minify_js(text))
+    if specs[0].endswith('.css'):
+        content = '\n'.join(parts)
+    else:
+        # Guard against scripts that do not end their last statement
+        content = ';\n'.join(parts)
+    return (content + '\n').encode('latin-1')
+
+
+def gzip_content(content):
+    out = io.BytesIO()
+    # A fixed mtime keeps the output the same for the same content
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(content)
+    return out.getvalue()
+
+
+def write_file(path, content):
+    with io.open(path, 'wb') as f:
+        f.write(content)
+
+
+def build_bundles(directory, bundles=BUNDLES):
+    """Write each bundle to `directory` under a name that includes a
+    hash of its content, next to a gzipped copy, and a manifest mapping
+    the bundle names to the files. Files of earlier builds are left in
+    place for pages that still link to them. Returns the manifest.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = {}
+    for name in sorted(bundles):
+        content = bundle_content(bundles[name])
+        base, ext = os.path.splitext(name)
+        filename = '%s.%s%s' % (base, sha1(content).hexdigest()[:12], ext)
+        path = os.path.join(directory, filename)
+        write_file(path, content)
+        write_file(path + '.gz', gzip_content(content))
+        manifest[name] = filename
+    manifest_json = json.dumps(manifest, indent=2, sort_keys=True)
+    write_file(os.path.join(directory, MANIFEST),
+               manifest_json.encode('utf-8'))
+    return manifest
+
+
+def app_version():
+    """The installed version of the app, or None when it is run from a
+    checkout that was never installed.
+    """
+    try:
+        return pkg_resources.get_distribution('todopyramid').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+class Assets(object):
+    """The urls of the css and javascript bundles the templates use.
+    Without a manifest each file of a bundle is linked to on its own,
+    which suits development. With the manifest written by
+    `build_bundles`, each bundle is a single file whose name changes
+    with its content, so it can be cached for good.
+
+    `version` changes with the installed version of the app and with the
+    bundles, for caches of pages that link to them.
+    """
+
+    def __init__(self, bundles=BUNDLES, directory=None, manifest=None):
+        self.bundles = bundles
+        self.directory = directory
+        self.manifest = manifest or {}
+        state = json.dumps([app_version(), self.manifest], sort_keys=True)
+        self.version = sha1(state.encode('utf-8')).hexdigest()[:12]
+
+    def urls(self, request, name):
+        if name in self.manifest:
+            return [request.route_url('bundle',
+                                      filename=self.manifest[name])]
+        return [request.static_url(spec) for spec in self.bundles[name]]
+
+    def unbundled(self, specs, names):
+        """Drop the resources that are part of the built bundles called
+        `names`, for widgets whose resources a page already loads.
+        """
+        bundled = set()
+        for name in names:
+            if name in self.manifest:
+                bundled.update(self.bundles[name])
+        return [spec for spec in specs if spec not in bundled]
+
+
+def bundle_directory(settings):
+    """The directory of the bundles, set with
+    `todopyramid.assets.directory`. It defaults to the bundles directory
+    of the static files.
+    """
+    directory = settings.get('todopyramid.assets.directory')
+    if directory is None:
+        directory = asset_path(BUNDLE_DIRECTORY)
+    return directory
+
+
+def assets_from_settings(settings):
+    """Serve the built bundles when `todopyramid.assets.bundles` is on.
+    """
+    directory = bundle_directory(settings)
+    if not asbool(settings.get('todopyramid.assets.bundles', False)):
+        return Assets(directory=directory)
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        raise ValueError('No asset manifest at %s, run '
+                         'build_todopyramid_assets first' % path)
+    with io.open(path, 'rb') as f:
+        manifest = json.loads(f.read().decode('utf-8'))
+    return Assets(directory=directory, manifest=manifest)
+
+
+@view_config(route_name='bundle')
+def bundle_view(request):
+    """Serve a built bundle, gzipped to clients that accept it. The name
+    of a bundle changes with its content, so it is cached for a year
+    and never revalidated. Bundles of earlier builds are served as well,
+    for pages that were rendered before the last build.
+    """
+    assets = request.registry.assets
+    filename = request.matchdict['filename']
+    if assets.directory is None or not BUNDLE_FILENAME.match(filename):
+        raise HTTPNotFound()
+    path = os.path.join(assets.directory, filename)
+    if not os.path.isfile(path):
+        raise HTTPNotFound()
+    content_type = CONTENT_TYPES[os.path.splitext(filename)[1]]
+    content_encoding = None
+    if (request.accept_encoding.best_match(['gzip']) and
+            os.path.exists(path + '.gz')):
+        path += '.gz'
+        content_encoding = 'gzip'
+    response = FileResponse(
+        path,
+        request=request,
+        cache_max_age=ONE_YEAR,
+        content_type=content_type,
+        content_encoding=content_encoding,
+    )
+    response.headers['Cache-Control'] = (
+        'public, max-age=%d, immutable' % ONE_YEAR)
+    response.vary = ('Accept-Encoding',)
+    return response
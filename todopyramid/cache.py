@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import sys
+import threading
+
+
+class LRUCache(object):
+    """A thread safe, least recently used cache. It can be bounded by
+    the number of entries, by an approximate memory budget in bytes, or
+    both. The size of each value is measured with the `sizeof` callable,
+    which defaults to `sys.getsizeof`.
+
+    Hits and misses are counted so the cache can be tuned.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or sys.getsizeof
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value for `key`, marking it as recently used.
+        """
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries until
+        the cache fits in its bounds again. A value that is bigger than
+        the whole memory budget is not stored.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self._over_budget():
+                evicted, (value, size) = self._data.popitem(last=False)
+                self.size -= size
+
+    def invalidate(self, key):
+        """Drop the entry for `key`, if there is one.
+        """
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._data) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
@@ -0,0 +1,134 @@
+import time
+
+from sqlalchemy import engine_from_config
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+import transaction
+
+# Pragmas of the production profile for SQLite. WAL lets readers carry
+# on while a write is committed, and synchronous=NORMAL is safe with WAL.
+PRODUCTION_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', '5000'),
+    ('cache_size', '-16000'),
+    ('mmap_size', '268435456'),
+]
+
+
+def sqlite_profile(settings):
+    """Return the pragmas and pool options of the SQLite profile chosen
+    with `todopyramid.sqlite.profile`. The `default` profile leaves the
+    engine as SQLAlchemy sets it up. The `production` profile sets the
+    pragmas above, any of which can be changed with a
+    `todopyramid.sqlite.pragma.<name>` setting, and pools as many
+    connections as there are server threads.
+    """
+    profile = settings.get('todopyramid.sqlite.profile', 'default')
+    if profile == 'default':
+        return [], {}
+    if profile != 'production':
+        raise ValueError('Unknown SQLite profile: %s' % profile)
+    prefix = 'todopyramid.sqlite.pragma.'
+    pragmas = [
+        (name, settings.get(prefix + name, value))
+        for name, value in PRODUCTION_PRAGMAS
+    ]
+    known = set(name for name, value in PRODUCTION_PRAGMAS)
+    for key in sorted(settings):
+        name = key[len(prefix):]
+        if key.startswith(prefix) and name not in known:
+            pragmas.append((name, settings[key]))
+    pool_options = dict(
+        poolclass=QueuePool,
+        pool_size=int(settings.get('todopyramid.sqlite.pool_size', 4)),
+        max_overflow=int(settings.get('todopyramid.sqlite.max_overflow', 0)),
+        connect_args={'check_same_thread': False},
+    )
+    return pragmas, pool_options
+
+
+def set_pragmas(engine, pragmas):
+    """Run the given pragmas on every new connection of the engine.
+    """
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    event.listen(engine, 'connect', connect)
+
+
+def engine_from_settings(settings, prefix='sqlalchemy.'):
+    """Create the engine from the app settings, applying the SQLite
+    profile to file databases.
+    """
+    url = settings.get(prefix + 'url', '')
+    if not url.startswith('sqlite') or url.rstrip('/') in (
+            'sqlite:', 'sqlite:///:memory:'):
+        return engine_from_config(settings, prefix)
+    pragmas, pool_options = sqlite_profile(settings)
+    engine = engine_from_config(settings, prefix, **pool_options)
+    if pragmas:
+        set_pragmas(engine, pragmas)
+    return engine
+
+
+def is_locked_error(error):
+    """Check if an error is SQLite giving up on waiting for a lock.
+    """
+    return (isinstance(error, OperationalError) and
+            'database is locked' in str(error.orig))
+
+
+class LockedAttempt(object):
+    """One attempt of `locked_retries`, used as a context manager that
+    runs a transaction like `transaction.manager` does.
+    """
+
+    def __init__(self, manager, last):
+        self.manager = manager
+        self.last = last
+        self.success = False
+
+    def __enter__(self):
+        return self.manager.__enter__()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.manager.__exit__(exc_type, exc_value, tb)
+        except OperationalError as e:
+            # The commit itself failed
+            if self.last or not is_locked_error(e):
+                raise
+            return True
+        if exc_type is None:
+            self.success = True
+            return False
+        # Swallow the error to try again, the transaction was aborted
+        return not self.last and is_locked_error(exc_value)
+
+
+def locked_retries(attempts=3, delay=0.05, manager=None):
+    """Run a write transaction again when SQLite reports that the
+    database is locked, which the busy timeout does not cover when a
+    read transaction has to be upgraded to a write. Used like
+    `transaction.manager.attempts`:
+
+        for attempt in locked_retries():
+            with attempt:
+                ...
+
+    The attempts back off exponentially starting at `delay` seconds,
+    and the error of the last one is raised.
+    """
+    if manager is None:
+        manager = transaction.manager
+    for number in range(attempts):
+        attempt = LockedAttempt(manager, number == attempts - 1)
+        yield attempt
+        if attempt.success:
+            break
+        time.sleep(delay * 2 ** number)
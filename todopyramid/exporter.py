@@ -0,0 +1,188 @@
+import csv
+from datetime import datetime
+import io
+import json
+import sys
+
+from sqlalchemy import select
+import transaction
+
+from .models import DBSession
+from .models import TodoItem
+from .models import load_sorted_tags
+from .utils import TimezoneConverter
+
+PY2 = sys.version_info[0] == 2
+
+
+def iter_task_chunks(user_id, chunk_size=1000):
+    """Yield a user's tasks as lists of (id, task, due_date, tags)
+    tuples, `chunk_size` tasks at a time. The rows are read from a
+    streaming cursor and the tags are loaded once per chunk, so memory
+    use does not grow with the number of tasks.
+    """
+    table = TodoItem.__table__
+    qry = select([table.c.id, table.c.task, table.c.due_date])
+    qry = qry.where(table.c.user == user_id).order_by(table.c.id)
+    qry = qry.execution_options(stream_results=True)
+    result = DBSession.execute(qry)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            tag_map = load_sorted_tags([row.id for row in rows])
+            yield [
+                (row.id, row.task, row.due_date, tag_map[row.id])
+                for row in rows
+            ]
+    finally:
+        result.close()
+
+
+class Exporter(object):
+    """Base class for the export formats. Subclasses render a chunk of
+    tasks at a time, between an optional header and footer.
+    """
+    content_type = 'text/plain'
+    extension = 'txt'
+
+    def __init__(self, time_zone, modified=None):
+        self.time_zone = time_zone
+        self.modified = modified
+        self.converter = TimezoneConverter(time_zone)
+
+    def localize(self, due_date):
+        if due_date is None:
+            return None
+        return self.converter.localize(due_date).isoformat()
+
+    def header(self):
+        return u''
+
+    def footer(self):
+        return u''
+
+    def format_chunk(self, tasks):
+        raise NotImplementedError
+
+
+class JSONLExporter(Exporter):
+    """One JSON object per task and line.
+    """
+    content_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def format_chunk(self, tasks):
+        lines = []
+        for todo_id, task, due_date, tags in tasks:
+            lines.append(json.dumps(dict(
+                id=todo_id,
+                name=task,
+                tags=tags,
+                due_date=self.localize(due_date),
+            ), sort_keys=True))
+            lines.append(u'\n')
+        return u''.join(lines)
+
+
+class CSVExporter(Exporter):
+    """A CSV file with the same columns the importer reads.
+    """
+    content_type = 'text/csv'
+    extension = 'csv'
+    columns = ('id', 'name', 'tags', 'due_date')
+
+    def write_rows(self, rows):
+        if PY2:
+            out = io.BytesIO()
+            rows = [
+                [(u'%s' % value).encode('utf-8') for value in row]
+                for row in rows
+            ]
+        else:
+            out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        value = out.getvalue()
+        return value.decode('utf-8') if PY2 else value
+
+    def header(self):
+        return self.write_rows([self.columns])
+
+    def format_chunk(self, tasks):
+        return self.write_rows([
+            (todo_id, task, ','.join(tags), self.localize(due_date) or '')
+            for todo_id, task, due_date, tags in tasks
+        ])
+
+
+def ical_escape(text):
+    """Escape a TEXT value for iCalendar (RFC 5545 section 3.3.11).
+    """
+    text = text.replace('\\', '\\\\').replace(';', '\\;')
+    text = text.replace(',', '\\,')
+    return text.replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def ical_fold(line):
+    """Fold a content line so no line is longer than 75 characters.
+    """
+    parts = []
+    while len(line) > 75:
+        parts.append(line[:75])
+        line = u' ' + line[75:]
+    parts.append(line)
+    return u'\r\n'.join(parts) + u'\r\n'
+
+
+class ICalendarExporter(Exporter):
+    """A calendar feed with a VTODO per task, for calendar clients. Due
+    dates are given in UTC so the clients can show them in any zone.
+    """
+    content_type = 'text/calendar'
+    extension = 'ics'
+    date_format = '%Y%m%dT%H%M%SZ'
+
+    def header(self):
+        return u'BEGIN:VCALENDAR\r\nVERSION:2.0\r\n' \
+               u'PRODID:-//Six Feet Up//ToDo Pyramid//EN\r\n'
+
+    def footer(self):
+        return u'END:VCALENDAR\r\n'
+
+    def format_chunk(self, tasks):
+        stamp = (self.modified or datetime.utcnow()).strftime(
+            self.date_format)
+        lines = []
+        for todo_id, task, due_date, tags in tasks:
+            lines.append(u'BEGIN:VTODO\r\n')
+            lines.append(u'UID:todo-%s@todopyramid\r\n' % todo_id)
+            lines.append(u'DTSTAMP:%s\r\n' % stamp)
+            lines.append(ical_fold(u'SUMMARY:%s' % ical_escape(task)))
+            if tags:
+                lines.append(ical_fold(u'CATEGORIES:%s' % u','.join(
+                    ical_escape(tag) for tag in tags)))
+            if due_date is not None:
+                lines.append(
+                    u'DUE:%s\r\n' % due_date.strftime(self.date_format))
+            lines.append(u'END:VTODO\r\n')
+        return u''.join(lines)
+
+
+EXPORTERS = {
+    'jsonl': JSONLExporter,
+    'csv': CSVExporter,
+    'ics': ICalendarExporter,
+}
+
+
+def export_app_iter(user_id, exporter, chunk_size=1000):
+    """A WSGI app_iter streaming a user's tasks in the exporter's format.
+    It runs after the view has returned, so it uses a transaction of its
+    own.
+    """
+    yield exporter.header().encode('utf-8')
+    with transaction.manager:
+        for tasks in iter_task_chunks(user_id, chunk_size):
+            yield exporter.format_chunk(tasks).encode('utf-8')
+    yield exporter.footer().encode('utf-8')
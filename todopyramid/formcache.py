@@ -0,0 +1,28 @@
+from collections import namedtuple
+
+from .cache import LRUCache
+
+RenderedForm = namedtuple('RenderedForm', ['html', 'css', 'js'])
+
+
+class FormCache(object):
+    """Keeps the rendered add task form of the list and tag pages. The
+    empty form only differs by the user's time zone, which the schema is
+    bound to, and the tag that is filled in on a tag page, so those make
+    up the key. Forms with validation errors are never cached.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.cache = LRUCache(max_entries=max_entries)
+
+    def get(self, time_zone, tag_name, render):
+        """Return the RenderedForm for a time zone and prefilled tag.
+        `render` is called on a miss and returns the html of the form
+        and its css and javascript resources.
+        """
+        key = (time_zone, tag_name)
+        rendered = self.cache.get(key)
+        if rendered is None:
+            rendered = RenderedForm(*render())
+            self.cache.set(key, rendered)
+        return rendered
@@ -0,0 +1,115 @@
+from hashlib import sha1
+import io
+import os
+import tempfile
+
+from .cache import LRUCache
+
+
+class FragmentCache(object):
+    """Base class for the backends of the rendered row cache. Backends
+    store unicode fragments under tuple keys and count their hits and
+    misses.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Return a dict with the fragments found for the given keys.
+        """
+        found = {}
+        for key in keys:
+            fragment = self.get(key)
+            if fragment is not None:
+                found[key] = fragment
+        return found
+
+    def set_many(self, fragments):
+        for key, fragment in fragments.items():
+            self.set(key, fragment)
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, fragment):
+        raise NotImplementedError
+
+
+class MemoryFragmentCache(FragmentCache):
+    """Keeps the fragments in an in-process LRU cache bounded by an
+    approximate memory budget.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        super(MemoryFragmentCache, self).__init__()
+        self.cache = LRUCache(max_bytes=max_bytes)
+
+    def get(self, key):
+        fragment = self.cache.get(key)
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fragment
+
+    def set(self, key, fragment):
+        self.cache.set(key, fragment)
+
+
+class FileFragmentCache(FragmentCache):
+    """Keeps the fragments in files under a directory, so that they are
+    shared between processes and survive restarts. Files are written
+    atomically, and nothing is ever evicted: stale rows simply stop being
+    asked for, so the directory can be cleared at any time.
+    """
+
+    def __init__(self, directory):
+        super(FileFragmentCache, self).__init__()
+        self.directory = directory
+
+    def path(self, key):
+        digest = sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        try:
+            with io.open(self.path(key), encoding='utf-8') as f:
+                fragment = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fragment
+
+    def set(self, key, fragment):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                f.write(fragment)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # The cache is only an optimization, rendering still works
+            pass
+
+
+def fragment_cache_from_settings(settings):
+    """Build the backend chosen with `todopyramid.fragment_cache`, which
+    can be `memory`, `file` or `none`.
+    """
+    backend = settings.get('todopyramid.fragment_cache', 'memory')
+    if backend == 'memory':
+        max_bytes = int(settings.get(
+            'todopyramid.fragment_cache.max_bytes', 32 * 1024 * 1024))
+        return MemoryFragmentCache(max_bytes=max_bytes)
+    if backend == 'file':
+        return FileFragmentCache(
+            settings['todopyramid.fragment_cache.directory'])
+    if backend == 'none':
+        return None
+    raise ValueError('Unknown fragment cache backend: %s' % backend)
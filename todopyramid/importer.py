@@ -0,0 +1,249 @@
+import csv
+import io
+import json
+import sys
+
+import colander
+from sqlalchemy import func
+from sqlalchemy import select
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from .database import locked_retries
+from .models import DBSession
+from .models import TodoItem
+from .models import TodoUser
+from .models import ensure_tags
+from .models import todoitemtag_table
+from .schema import TodoSchema
+from .tasks import after_commit
+from .tasks import captured_values
+from .tasks import reminder_scheduler
+
+PY2 = sys.version_info[0] == 2
+
+FORMATS = ('jsonl', 'csv')
+
+
+class ImportReport(object):
+    """Keeps track of how an import is going. Only the first
+    `max_errors` errors are kept, the rest are just counted. An
+    `on_error` callback can be given to see every error as it happens.
+    """
+
+    def __init__(self, max_errors=100, on_error=None):
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+        self.max_errors = max_errors
+        self.on_error = on_error
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, message))
+        if self.on_error is not None:
+            self.on_error(line, message)
+
+    def as_dict(self):
+        return dict(
+            imported=self.imported,
+            error_count=self.error_count,
+            errors=[
+                dict(line=line, error=message)
+                for line, message in self.errors
+            ],
+        )
+
+
+def guess_format(format=None, filename=None, content_type=None):
+    """Work out the format of an import from an explicit format name,
+    the name of the uploaded file or the content type of the request.
+    Returns None when it cannot be told.
+    """
+    if format in FORMATS:
+        return format
+    filename = (filename or '').lower()
+    if filename.endswith('.csv') or content_type == 'text/csv':
+        return 'csv'
+    if filename.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    if content_type in ('application/x-ndjson', 'application/jsonl',
+                        'application/json'):
+        return 'jsonl'
+    return None
+
+
+def read_jsonl(stream):
+    """Read records from a stream of JSON objects, one per line. Yields
+    (line number, record, error) tuples, one line at a time.
+    """
+    for line_no, line in enumerate(stream, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, None, 'Invalid JSON'
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, 'Expected a JSON object'
+            continue
+        yield line_no, record, None
+
+
+def read_csv(stream):
+    """Read records from a CSV stream with a header row. Yields (line
+    number, record, error) tuples, one row at a time.
+    """
+    if not PY2 and not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    reader = csv.DictReader(stream)
+    for record in reader:
+        if PY2:
+            record = dict(
+                (k.decode('utf-8'), v.decode('utf-8') if v else v)
+                for k, v in record.items() if k is not None
+            )
+        yield reader.line_num, record, None
+
+
+def read_records(stream, format):
+    if format == 'csv':
+        return read_csv(stream)
+    return read_jsonl(stream)
+
+
+def record_to_cstruct(record):
+    """Map an imported record on to the fields of the TodoSchema. The
+    task can be given as `name` or `task`, and the tags as a list or a
+    comma separated string.
+    """
+    tags = record.get('tags') or ''
+    if isinstance(tags, (list, tuple)):
+        tags = ','.join(tags)
+    return dict(
+        name=record.get('name') or record.get('task') or colander.null,
+        tags=tags or colander.null,
+        due_date=record.get('due_date') or colander.null,
+    )
+
+
+def format_invalid(error):
+    """Turn a colander.Invalid into a single line message.
+    """
+    return '; '.join(
+        '%s: %s' % (field, message)
+        for field, message in sorted(error.asdict().items())
+    )
+
+
+def insert_tasks(session, items):
+    """Insert task rows and return the ids they were given, in order.
+    Backends with RETURNING, like PostgreSQL, take all the rows in one
+    INSERT. SQLite allows a single writer, and the transaction already
+    holds the write lock from the counter update, so the ids are given
+    out after the highest one and the rows sent with one executemany.
+    Other backends get one row at a time, in the same transaction.
+    """
+    table = TodoItem.__table__
+    dialect = session.get_bind().dialect
+    if dialect.implicit_returning:
+        result = session.execute(
+            table.insert().values(items).returning(table.c.id))
+        return [row[0] for row in result]
+    if dialect.name == 'sqlite':
+        last_id = session.execute(
+            select([func.max(table.c.id)])).scalar() or 0
+        todo_ids = list(range(last_id + 1, last_id + len(items) + 1))
+        session.execute(table.insert(), [
+            dict(item, id=todo_id) for todo_id, item in zip(todo_ids, items)
+        ])
+        return todo_ids
+    return [
+        session.execute(table.insert(), item).inserted_primary_key[0]
+        for item in items
+    ]
+
+
+def write_batch(user_id, rows):
+    """Insert a batch of (task, due_date, tags) rows for a user. The
+    tag rows are created in bulk, the association rows are written with
+    one executemany, and the counters are updated in the same
+    transaction. Returns the ids of the new tasks.
+    """
+    session = DBSession()
+    tag_names = [tag for task, due_date, tags in rows for tag in tags]
+    ensure_tags(tag_names)
+    user = session.query(TodoUser).filter(TodoUser.email == user_id).one()
+    user.update_counts(tasks=len(rows), added_tags=tag_names)
+    user.touch()
+    # Takes the write lock on SQLite before the tasks are given ids
+    session.flush()
+    todo_ids = insert_tasks(session, [
+        dict(user=user_id, task=task, due_date=due_date)
+        for task, due_date, tags in rows
+    ])
+    links = [
+        dict(todo_id=todo_id, tag_id=tag)
+        for todo_id, (task, due_date, tags) in zip(todo_ids, rows)
+        for tag in tags
+    ]
+    if links:
+        session.execute(todoitemtag_table.insert(), links)
+    mark_changed(session)
+    scheduler = reminder_scheduler()
+    if scheduler is not None:
+        after_commit(scheduler.tasks_changed, [
+            (todo_id, due_date)
+            for todo_id, (task, due_date, tags) in zip(todo_ids, rows)
+            if due_date is not None
+        ])
+    return todo_ids
+
+
+def import_tasks(user_id, records, batch_size=500, report=None,
+                 progress=None):
+    """Validate the given records against the TodoSchema and insert the
+    valid ones for the user, `batch_size` at a time. Each batch is
+    committed in its own transaction, and `progress` is called with the
+    report after each one. Only one batch is held in memory at a time.
+    """
+    if report is None:
+        report = ImportReport()
+    with transaction.manager:
+        user = DBSession.query(TodoUser).filter(
+            TodoUser.email == user_id).one()
+        time_zone = user.time_zone
+    schema = TodoSchema().bind(user_tz=time_zone)
+    batch = []
+    for line_no, record, error in records:
+        if error is not None:
+            report.add_error(line_no, error)
+            continue
+        try:
+            captured = schema.deserialize(record_to_cstruct(record))
+        except colander.Invalid as e:
+            report.add_error(line_no, format_invalid(e))
+            continue
+        name, tags, due_date = captured_values(captured)
+        batch.append((name, due_date, tags))
+        if len(batch) >= batch_size:
+            for attempt in locked_retries():
+                with attempt:
+                    write_batch(user_id, batch)
+            report.imported += len(batch)
+            batch = []
+            if progress is not None:
+                progress(report)
+    if batch:
+        for attempt in locked_retries():
+            with attempt:
+                write_batch(user_id, batch)
+        report.imported += len(batch)
+        if progress is not None:
+            progress(report)
+    return report
@@ -0,0 +1,211 @@
+import json
+import logging
+import timeit
+
+from pyramid.events import BeforeRender
+from pyramid.events import NewRequest
+from pyramid.events import NewResponse
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+from pyramid.tweens import INGRESS
+from pyramid.tweens import MAIN
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+timer = timeit.default_timer
+
+# Slow statements are cut to this many characters in the log
+MAX_STATEMENT = 1000
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """SQLAlchemy `before_cursor_execute` hook that bumps the query
+    counter of the request currently being served. Queries run outside
+    of a request (scripts, tests without a request) are not counted.
+    """
+    request = get_current_request()
+    if request is not None:
+        request.query_count = getattr(request, 'query_count', 0) + 1
+
+
+def start_query_count(event):
+    """Reset the counter at the start of each request.
+    """
+    event.request.query_count = 0
+
+
+def add_query_count_header(event):
+    """Expose the number of queries a request ran as a response header.
+    """
+    count = getattr(event.request, 'query_count', 0)
+    event.response.headers['X-Query-Count'] = str(count)
+
+
+def setup_query_count(config, engine):
+    """Hook the query counter into the engine and the request cycle.
+    The count is always available as `request.query_count`. Setting
+    `todopyramid.query_count_header = true` will also add it to every
+    response as the `X-Query-Count` header.
+    """
+    event.listen(engine, 'before_cursor_execute', count_query)
+    config.add_subscriber(start_query_count, NewRequest)
+    settings = config.get_settings()
+    if asbool(settings.get('todopyramid.query_count_header', False)):
+        config.add_subscriber(add_query_count_header, NewResponse)
+
+
+class RequestTimings(object):
+    """What a request spent its time on. The SQL queries are timed by
+    the engine hooks, rendering from the `BeforeRender` event until the
+    view returns its response, and the total by the timing tween.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.render_start = None
+        self.render_time = None
+
+    def add_query(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+
+    def server_timing(self, total):
+        """The value of a `Server-Timing` header, in milliseconds.
+        """
+        metrics = [
+            'db;dur=%.1f;desc="%s queries"' % (
+                self.db_time * 1000, self.queries),
+            'db-slowest;dur=%.1f' % (self.slowest * 1000),
+        ]
+        if self.render_time is not None:
+            metrics.append('render;dur=%.1f' % (self.render_time * 1000))
+        metrics.append('total;dur=%.1f' % (total * 1000))
+        return ', '.join(metrics)
+
+    def as_dict(self, request, response, total):
+        """The timings of a request for the slow request log. The
+        `response` is None when the request failed with an error.
+        """
+        # Requests that matched no route have no matched_route
+        route = getattr(request, 'matched_route', None)
+        statement = self.slowest_statement
+        if statement is not None:
+            statement = ' '.join(statement.split())[:MAX_STATEMENT]
+        return dict(
+            method=request.method,
+            path=request.path,
+            route=route.name if route is not None else None,
+            view_name=getattr(request, 'view_name', None),
+            status=response.status_int if response is not None else None,
+            total_ms=round(total * 1000, 1),
+            db_ms=round(self.db_time * 1000, 1),
+            render_ms=round(self.render_time * 1000, 1)
+            if self.render_time is not None else None,
+            queries=self.queries,
+            slowest_ms=round(self.slowest * 1000, 1),
+            slowest_statement=statement,
+        )
+
+
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    """SQLAlchemy `before_cursor_execute` hook. The start time is kept
+    on the execution context, which goes away with a failed query.
+    """
+    if context is not None:
+        context.todopyramid_start = timer()
+
+
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    """SQLAlchemy `after_cursor_execute` hook that adds the query to the
+    timings of the request being served, if it is being timed.
+    """
+    start = getattr(context, 'todopyramid_start', None)
+    if start is None:
+        return
+    timings = getattr(get_current_request(), 'timings', None)
+    if timings is not None:
+        timings.add_query(statement, timer() - start)
+
+
+def start_render_timer(event):
+    """Start the render timer on the first `BeforeRender` of a request,
+    so the templates rendered from within the main one do not restart
+    it.
+    """
+    timings = getattr(event.get('request'), 'timings', None)
+    if timings is not None and timings.render_start is None:
+        timings.render_start = timer()
+
+
+def render_tween_factory(handler, registry):
+    """Stop the render timer as the view returns its rendered response.
+    """
+    def render_tween(request):
+        response = handler(request)
+        timings = getattr(request, 'timings', None)
+        if timings is not None and timings.render_start is not None:
+            timings.render_time = timer() - timings.render_start
+        return response
+
+    return render_tween
+
+
+def timing_tween_factory(handler, registry):
+    """Time each request, and add the timings to the response as a
+    `Server-Timing` header and/or log the request when it was slow, as
+    set up by `setup_timing`. Slow requests that fail with an error are
+    logged too, without a status.
+    """
+    settings = registry.settings
+    header = asbool(settings.get('todopyramid.server_timing', False))
+    slow = int(settings.get('todopyramid.slow_request_ms', 0)) / 1000.0
+
+    def timing_tween(request):
+        start = timer()
+        request.timings = timings = RequestTimings()
+        response = None
+        try:
+            response = handler(request)
+        finally:
+            total = timer() - start
+            if slow and total >= slow:
+                log.warning('Slow request %s', json.dumps(
+                    timings.as_dict(request, response, total),
+                    sort_keys=True))
+        if header:
+            response.headers['Server-Timing'] = timings.server_timing(total)
+        return response
+
+    return timing_tween
+
+
+def setup_timing(config, engine):
+    """Time the SQL queries, the rendering and the whole of each request
+    when `todopyramid.server_timing = true`, which sends the timings to
+    the browser as a `Server-Timing` header, or when
+    `todopyramid.slow_request_ms` is set, which logs the requests that
+    take longer as JSON. With neither set nothing is hooked in, so the
+    requests are not slowed down at all.
+    """
+    settings = config.get_settings()
+    header = asbool(settings.get('todopyramid.server_timing', False))
+    slow = int(settings.get('todopyramid.slow_request_ms', 0))
+    if not header and not slow:
+        return
+    event.listen(engine, 'before_cursor_execute', start_query_timer)
+    event.listen(engine, 'after_cursor_execute', stop_query_timer)
+    config.add_subscriber(start_render_timer, BeforeRender)
+    # Outermost, so the commit of pyramid_tm is part of the total
+    config.add_tween('todopyramid.instrumentation.timing_tween_factory',
+                     under=INGRESS)
+    config.add_tween('todopyramid.instrumentation.render_tween_factory',
+                     over=MAIN)
@@ -12,3 +12,9 @@ class Layouts(object):
     def global_template(self):
         renderer = get_renderer("templates/global_layout.pt")
         return renderer.implementation().macros['layout']
+
+    def asset_urls(self, name):
+        """The urls to load a bundle of css or javascript from. See the
+        assets module for the bundles.
+        """
+        return self.request.registry.assets.urls(self.request, name)
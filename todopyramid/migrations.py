@@ -0,0 +1,196 @@
+from sqlalchemy import MetaData
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateTable
+
+from .models import ArchivedTask
+from .models import Base
+from .models import SORT_INDEXES
+from .models import TodoItem
+from .models import UserTag
+from .models import create_search_index
+from .models import drop_search_index
+from .models import todoitemtag_table
+from .search import rebuild_search_index
+
+
+def get_version(connection):
+    """The schema version is kept in SQLite's `user_version` pragma.
+    """
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def set_version(connection, version):
+    # Pragmas do not take bound parameters
+    connection.execute('PRAGMA user_version = %d' % int(version))
+
+
+def add_column(connection, table_name, column_name, ddl):
+    """Add a column unless the table already has it.
+    """
+    columns = [c['name'] for c in inspect(connection).get_columns(table_name)]
+    if column_name not in columns:
+        connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            table_name, column_name, ddl))
+
+
+def create_indexes(connection, table):
+    """Create the indexes declared on a table that are missing.
+    """
+    existing = set(
+        index['name'] for index in inspect(connection).get_indexes(table.name))
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name not in existing:
+            index.create(connection)
+
+
+def rebuild_table(connection, table, casts):
+    """Copy a table into a new one created from its current model, with
+    `casts` mapping column names to the SQL expressions they are copied
+    with, then swap it in and create its indexes. SQLite can not change
+    the type of a column in place.
+    """
+    metadata = MetaData()
+    # The tables it has foreign keys to, so they can be resolved
+    for other in table.metadata.tables.values():
+        if other is not table:
+            other.tometadata(metadata)
+    new_name = table.name + '_new'
+    connection.execute('DROP TABLE IF EXISTS %s' % new_name)
+    connection.execute(CreateTable(table.tometadata(metadata, name=new_name)))
+    preparer = connection.dialect.identifier_preparer
+    names = [column.name for column in table.columns]
+    connection.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+        new_name,
+        ', '.join(preparer.quote(name) for name in names),
+        ', '.join(casts.get(name, preparer.quote(name)) for name in names),
+        table.name,
+    ))
+    connection.execute('DROP TABLE %s' % table.name)
+    connection.execute('ALTER TABLE %s RENAME TO %s' % (new_name, table.name))
+
+
+def add_counters(connection):
+    add_column(connection, 'users', 'task_count',
+               'INTEGER NOT NULL DEFAULT 0')
+    add_column(connection, 'users', 'modified', 'DATETIME')
+    UserTag.__table__.create(connection, checkfirst=True)
+    connection.execute(
+        'UPDATE users SET task_count = ('
+        'SELECT count(*) FROM todoitems WHERE todoitems.user = users.email)'
+    )
+    connection.execute('DELETE FROM usertags')
+    connection.execute(
+        'INSERT INTO usertags (user, tag_id, task_count) '
+        'SELECT todoitems.user, todoitemtag.tag_id, count(*) '
+        'FROM todoitemtag JOIN todoitems '
+        'ON todoitems.id = todoitemtag.todo_id '
+        'GROUP BY todoitems.user, todoitemtag.tag_id'
+    )
+
+
+def add_revisions(connection):
+    add_column(connection, 'todoitems', 'modified', 'DATETIME')
+    add_column(connection, 'users', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def add_indexes(connection):
+    create_indexes(connection, TodoItem.__table__)
+    create_indexes(connection, todoitemtag_table)
+    for dialect_name, statement in SORT_INDEXES:
+        if dialect_name == 'sqlite':
+            connection.execute(statement)
+
+
+def add_archive(connection):
+    ArchivedTask.__table__.create(connection, checkfirst=True)
+    create_indexes(connection, ArchivedTask.__table__)
+
+
+def add_search_index(connection):
+    if create_search_index(connection):
+        rebuild_search_index(connection)
+
+
+def add_reminder_index(connection):
+    create_indexes(connection, TodoItem.__table__)
+
+
+def add_search_user(connection):
+    drop_search_index(connection)
+    add_search_index(connection)
+
+
+def retype_text_columns(connection):
+    # Tags and users that look like numbers were stored as integers by
+    # the INTEGER columns of the first schema
+    drop_search_index(connection)
+    rebuild_table(connection, TodoItem.__table__,
+                  {'user': 'CAST("user" AS TEXT)'})
+    rebuild_table(connection, todoitemtag_table,
+                  {'tag_id': 'CAST(tag_id AS TEXT)'})
+    add_indexes(connection)
+    add_search_index(connection)
+
+
+# The version each migration upgrades the database to, in order
+MIGRATIONS = [
+    (1, 'Task and tag counters', add_counters),
+    (2, 'Task modification times and user revisions', add_revisions),
+    (3, 'Indexes for listing and filtering tasks', add_indexes),
+    (4, 'Archive of completed tasks', add_archive),
+    (5, 'Full text search index', add_search_index),
+    (6, 'Index for the reminder queue', add_reminder_index),
+    (7, 'Owner of the tasks in the full text index', add_search_user),
+    (8, 'Text columns for the tag and user of tasks', retype_text_columns),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def pending_migrations(engine):
+    """Return the migrations that have not been applied to a database.
+    """
+    with engine.connect() as connection:
+        version = get_version(connection)
+    return [
+        migration for migration in MIGRATIONS
+        if migration[0] > version
+    ]
+
+
+def migrate(engine, progress=None):
+    """Apply the pending migrations to an existing SQLite database. Each
+    migration runs in its own transaction together with the version
+    bump, and is written so that it can run against a database that
+    already has some of its changes. `progress` is called with the
+    version and description of each migration before it runs. Returns
+    the number of migrations applied.
+    """
+    applied = 0
+    for version, description, upgrade in pending_migrations(engine):
+        if progress is not None:
+            progress(version, description)
+        with engine.begin() as connection:
+            upgrade(connection)
+            set_version(connection, version)
+        applied += 1
+    return applied
+
+
+def stamp(engine):
+    """Mark a database created from the current models as up to date.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        set_version(connection, LATEST_VERSION)
+
+
+def create_schema(engine):
+    """Create the tables of the database. A new database is stamped with
+    the latest version, an existing one is left for `migrate`.
+    """
+    is_new = not inspect(engine).get_table_names()
+    Base.metadata.create_all(engine)
+    if is_new:
+        stamp(engine)
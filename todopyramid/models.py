@@ -3,10 +3,17 @@ from datetime import datetime
 from pyramid.security import Allow
 from pyramid.security import Authenticated
 
+from sqlalchemy import and_
 from sqlalchemy import Column
 from sqlalchemy import DateTime
+from sqlalchemy import DDL
+from sqlalchemy import event
 from sqlalchemy import ForeignKey
+from sqlalchemy import func
+from sqlalchemy import Index
+from sqlalchemy import inspect
 from sqlalchemy import Integer
+from sqlalchemy import select
 from sqlalchemy import Table
 from sqlalchemy import Text
 from sqlalchemy.ext.declarative import declarative_base
@@ -14,15 +21,22 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import mark_changed
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
+# The time zone of new users, and of users without a profile
+DEFAULT_TIME_ZONE = u'US/Eastern'
+
 todoitemtag_table = Table(
     'todoitemtag',
     Base.metadata,
-    Column('tag_id', Integer, ForeignKey('tags.name')),
+    Column('tag_id', Text, ForeignKey('tags.name')),
     Column('todo_id', Integer, ForeignKey('todoitems.id')),
+    # Loading the tags of tasks, and filtering the tasks by tag
+    Index('ix_todoitemtag_todo_id_tag_id', 'todo_id', 'tag_id'),
+    Index('ix_todoitemtag_tag_id_todo_id', 'tag_id', 'todo_id'),
 )
 
 
@@ -56,7 +70,8 @@ class TodoItem(Base):
     id = Column(Integer, primary_key=True)
     task = Column(Text, nullable=False)
     due_date = Column(DateTime)
-    user = Column(Integer, ForeignKey('users.email'), nullable=False)
+    user = Column(Text, ForeignKey('users.email'), nullable=False)
+    modified = Column(DateTime, default=datetime.utcnow)
     tags = relationship(Tag, secondary=todoitemtag_table, lazy='dynamic')
 
     def __init__(self, user, task, tags=None, due_date=None):
@@ -70,10 +85,47 @@ class TodoItem(Base):
         """This helper function merely takes a list of tags and
         creates the associated tag object. We strip off whitespace
         and lowercase the tags to keep a normalized list.
+
+        The tags are created and loaded in bulk rather than one at a
+        time.
+        """
+        tags = normalize_tags(tags)
+        if not tags:
+            return
+        ensure_tags(tags)
+        for tag in DBSession.query(Tag).filter(Tag.name.in_(tags)):
+            self.tags.append(tag)
+
+    def set_tags(self, tags):
+        """Replace the tags of a task that has already been saved. Only
+        the association rows for the tags that were added or removed are
+        written. Returns the lists of added and removed tag names.
         """
-        for tag_name in tags:
-            tag = tag_name.strip().lower()
-            self.tags.append(DBSession.merge(Tag(tag)))
+        tags = normalize_tags(tags)
+        old_tags = load_sorted_tags([self.id])[self.id]
+        added = [tag for tag in tags if tag not in old_tags]
+        removed = [tag for tag in old_tags if tag not in tags]
+        session = DBSession()
+        table = todoitemtag_table
+        if removed:
+            session.execute(table.delete().where(and_(
+                table.c.todo_id == self.id,
+                table.c.tag_id.in_(removed),
+            )))
+        if added:
+            ensure_tags(added)
+            session.execute(table.insert(), [
+                dict(todo_id=self.id, tag_id=tag) for tag in added
+            ])
+        if added or removed:
+            mark_changed(session)
+        return added, removed
+
+    def touch(self):
+        """Record that the task changed, so that cached renderings of it
+        are no longer used.
+        """
+        self.modified = datetime.utcnow()
 
     @property
     def sorted_tags(self):
@@ -89,6 +141,144 @@ class TodoItem(Base):
         return self.due_date and self.due_date < datetime.utcnow()
 
 
+# The todo list is always filtered by user and sorted by due date or by
+# the case insensitive task name
+Index('ix_todoitems_user_due_date', TodoItem.user, TodoItem.due_date)
+# The reminder queue reads the next tasks to come due across all users
+Index('ix_todoitems_due_date', TodoItem.due_date)
+
+# Indexes on the sort expressions, which differ between backends. See
+# `paging.sort_style` for how each backend sorts.
+SORT_INDEXES = [
+    ('sqlite', 'CREATE INDEX IF NOT EXISTS ix_todoitems_user_task '
+               'ON todoitems (user, task COLLATE NOCASE)'),
+    ('postgresql', 'CREATE INDEX ix_todoitems_user_lower_task '
+                   'ON todoitems ("user", lower(task))'),
+    ('postgresql', 'CREATE INDEX ix_todoitems_user_due_date_desc '
+                   'ON todoitems ("user", due_date DESC NULLS LAST)'),
+]
+
+for dialect_name, statement in SORT_INDEXES:
+    event.listen(
+        TodoItem.__table__,
+        'after_create',
+        DDL(statement).execute_if(dialect=dialect_name),
+    )
+
+
+# A full text index of the task names and tags, kept in sync by triggers.
+# It is only created on SQLite builds that have FTS5, see `search` for
+# the fallback used everywhere else. The user column holds the hex of the
+# owner's email, so searches can be narrowed down to one user's tasks
+# inside the index.
+SEARCH_DDL = [
+    'CREATE VIRTUAL TABLE IF NOT EXISTS tasksearch '
+    'USING fts5(task, tags, user)',
+    'CREATE TRIGGER IF NOT EXISTS tasksearch_insert '
+    'AFTER INSERT ON todoitems BEGIN '
+    'INSERT INTO tasksearch (rowid, task, tags, user) '
+    "VALUES (new.id, new.task, '', hex(new.user)); END",
+    'CREATE TRIGGER IF NOT EXISTS tasksearch_update '
+    'AFTER UPDATE OF task ON todoitems BEGIN '
+    'UPDATE tasksearch SET task = new.task WHERE rowid = new.id; END',
+    'CREATE TRIGGER IF NOT EXISTS tasksearch_delete '
+    'AFTER DELETE ON todoitems BEGIN '
+    'DELETE FROM tasksearch WHERE rowid = old.id; END',
+    'CREATE TRIGGER IF NOT EXISTS tasksearch_tag_insert '
+    'AFTER INSERT ON todoitemtag BEGIN '
+    'UPDATE tasksearch SET tags = ('
+    "SELECT group_concat(tag_id, ' ') FROM todoitemtag "
+    'WHERE todo_id = new.todo_id) WHERE rowid = new.todo_id; END',
+    'CREATE TRIGGER IF NOT EXISTS tasksearch_tag_delete '
+    'AFTER DELETE ON todoitemtag BEGIN '
+    'UPDATE tasksearch SET tags = coalesce(('
+    "SELECT group_concat(tag_id, ' ') FROM todoitemtag "
+    "WHERE todo_id = old.todo_id), '') WHERE rowid = old.todo_id; END",
+]
+
+SEARCH_TRIGGERS = [
+    'tasksearch_insert',
+    'tasksearch_update',
+    'tasksearch_delete',
+    'tasksearch_tag_insert',
+    'tasksearch_tag_delete',
+]
+
+
+def has_fts5(connection):
+    """Check if a connection is to an SQLite build with FTS5.
+    """
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = connection.execute('PRAGMA compile_options')
+    return 'ENABLE_FTS5' in [row[0] for row in options]
+
+
+def drop_search_index(connection):
+    """Drop the full text index and its triggers, so they can be created
+    again with a new layout.
+    """
+    for name in SEARCH_TRIGGERS:
+        connection.execute('DROP TRIGGER IF EXISTS %s' % name)
+    connection.execute('DROP TABLE IF EXISTS tasksearch')
+
+
+def create_search_index(connection):
+    """Create the full text index and its triggers, when the database
+    supports them. Returns whether it did.
+    """
+    if not has_fts5(connection):
+        return False
+    for statement in SEARCH_DDL:
+        connection.execute(statement)
+    return True
+
+
+# After all of the tables, since the triggers need both todoitems and
+# todoitemtag to exist
+event.listen(
+    Base.metadata,
+    'after_create',
+    lambda target, connection, **kw: create_search_index(connection),
+)
+
+
+class UserTag(Base):
+    """A maintained count of how many of a user's tasks use a tag, so
+    that listing a user's tags does not have to scan every task. Rows
+    are removed once the count drops to zero.
+    """
+    __tablename__ = 'usertags'
+    user = Column(Text, ForeignKey('users.email'), primary_key=True)
+    tag_id = Column(Text, ForeignKey('tags.name'), primary_key=True)
+    task_count = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedTask(Base):
+    """A completed task. Completing a task moves it here out of the
+    todoitems table, so the todo list only ever has open tasks to go
+    through. The archive is only read, so the tags are kept with the
+    task as a comma separated list.
+    """
+    __tablename__ = 'archivedtasks'
+    id = Column(Integer, primary_key=True)
+    todo_id = Column(Integer, nullable=False)
+    user = Column(Text, ForeignKey('users.email'), nullable=False)
+    task = Column(Text, nullable=False)
+    tags = Column(Text, nullable=False, default=u'')
+    due_date = Column(DateTime)
+    completed = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    @property
+    def tag_list(self):
+        return self.tags.split(u',') if self.tags else []
+
+
+# The archive is listed newest first for a user, and purged by age
+Index('ix_archivedtasks_user_id', ArchivedTask.user, ArchivedTask.id)
+Index('ix_archivedtasks_completed', ArchivedTask.completed)
+
+
 class TodoUser(Base):
     """When a user signs in with their persona, this model is what
     stores their account information. It has a one to many relationship
@@ -99,24 +289,120 @@ class TodoUser(Base):
     first_name = Column(Text)
     last_name = Column(Text)
     time_zone = Column(Text)
+    task_count = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime)
+    revision = Column(Integer, nullable=False, default=0)
     todo_list = relationship(TodoItem, lazy='dynamic')
+    tag_counts = relationship(UserTag, lazy='dynamic')
 
     def __init__(self, email, first_name=None, last_name=None,
-                 time_zone=u'US/Eastern'):
+                 time_zone=DEFAULT_TIME_ZONE):
         self.email = email
         self.first_name = first_name
         self.last_name = last_name
         self.time_zone = time_zone
+        self.task_count = 0
+        self.revision = 0
 
     @property
     def user_tags(self):
-        """Find all tags a user has created
+        """Find all tags a user has created, along with the number of
+        tasks using each of them.
+        """
+        return self.tag_counts.order_by(UserTag.tag_id).all()
+
+    def tag_count(self, tag_name):
+        """Return the number of this user's tasks that use a tag.
+        """
+        row = self.tag_counts.filter(UserTag.tag_id == tag_name).first()
+        return row.task_count if row is not None else 0
+
+    def touch(self):
+        """Record that the user's tasks, tags or profile have changed.
+        This bumps the revision used to answer conditional requests for
+        the user's pages, with a relative update so that concurrent
+        writes each get counted.
+        """
+        self.modified = datetime.utcnow()
+        if inspect(self).persistent:
+            self.revision = TodoUser.revision + 1
+        else:
+            self.revision = (self.revision or 0) + 1
+
+    def actual_counts(self):
+        """Count the user's tasks and tag usage the slow way, straight
+        from the tasks. Returns the task count and a dict of tag name to
+        the number of tasks using it.
+        """
+        session = DBSession()
+        task_count = self.todo_list.count()
+        tag_col = todoitemtag_table.c.tag_id
+        qry = session.query(tag_col, func.count(tag_col))
+        qry = qry.join(TodoItem).filter(TodoItem.user == self.email)
+        qry = qry.group_by(tag_col)
+        return task_count, dict(qry.all())
+
+    def recount(self):
+        """Rebuild the task and tag counters from the tasks themselves.
         """
-        qry = self.todo_list.session.query(todoitemtag_table.columns['tag_id'])
-        qry = qry.join(TodoItem).filter_by(user=self.email)
-        qry = qry.group_by('tag_id')
-        qry = qry.order_by('tag_id')
-        return qry.all()
+        session = DBSession()
+        session.flush()
+        task_count, tag_counts = self.actual_counts()
+        self.task_count = task_count
+        table = UserTag.__table__
+        session.execute(table.delete().where(table.c.user == self.email))
+        if tag_counts:
+            session.execute(table.insert(), [
+                dict(user=self.email, tag_id=tag_name, task_count=count)
+                for tag_name, count in sorted(tag_counts.items())
+            ])
+        mark_changed(session)
+
+    def update_counts(self, tasks=0, added_tags=(), removed_tags=()):
+        """Keep the task and tag counters in step with a change to the
+        todo list. This has to be called in the same transaction as the
+        change itself. A tag may be listed more than once to count it
+        for several tasks.
+
+        The counters are changed with relative updates in SQL so that
+        concurrent requests do not overwrite each other's changes.
+        """
+        session = DBSession()
+        if tasks and inspect(self).persistent:
+            self.task_count = TodoUser.task_count + tasks
+        elif tasks:
+            self.task_count += tasks
+        deltas = {}
+        for tag_name in added_tags:
+            deltas[tag_name] = deltas.get(tag_name, 0) + 1
+        for tag_name in removed_tags:
+            deltas[tag_name] = deltas.get(tag_name, 0) - 1
+        deltas = dict((k, v) for k, v in deltas.items() if v)
+        if not deltas:
+            return
+        table = UserTag.__table__
+        mine = table.c.user == self.email
+        qry = session.query(table.c.tag_id)
+        qry = qry.filter(mine, table.c.tag_id.in_(list(deltas)))
+        existing = set(tag_name for (tag_name,) in qry)
+        new_rows = []
+        for tag_name, delta in sorted(deltas.items()):
+            if tag_name in existing:
+                session.execute(
+                    table.update()
+                    .where(and_(mine, table.c.tag_id == tag_name))
+                    .values(task_count=table.c.task_count + delta)
+                )
+            elif delta > 0:
+                new_rows.append(
+                    dict(user=self.email, tag_id=tag_name, task_count=delta)
+                )
+        if new_rows:
+            session.execute(table.insert(), new_rows)
+        session.execute(
+            table.delete().where(and_(mine, table.c.task_count <= 0))
+        )
+        mark_changed(session)
 
     @property
     def profile_complete(self):
@@ -125,3 +411,75 @@ class TodoUser(Base):
         settings.
         """
         return self.first_name and self.last_name
+
+
+def load_revision(user_id, now=None):
+    """Look up what the pages of a user depend on in a single query.
+    Returns the user's revision, when they last changed anything and
+    the next due date after `now`, or None if there is no such user.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    next_due = select([func.min(TodoItem.due_date)]).where(and_(
+        TodoItem.user == TodoUser.email,
+        TodoItem.due_date > now,
+    )).as_scalar()
+    qry = DBSession.query(TodoUser.revision, TodoUser.modified, next_due)
+    return qry.filter(TodoUser.email == user_id).first()
+
+
+def normalize_tags(tags):
+    """Strip whitespace from and lowercase a list of tag names, dropping
+    empty names and duplicates while keeping the original order.
+    """
+    seen = set()
+    normalized = []
+    for tag_name in tags:
+        tag = tag_name.strip().lower()
+        if tag and tag not in seen:
+            seen.add(tag)
+            normalized.append(tag)
+    return normalized
+
+
+def ensure_tags(tag_names, chunk_size=500):
+    """Make sure a Tag row exists for each of the given names. The names
+    that already exist are looked up together and all the missing ones
+    are inserted with a single statement.
+    """
+    session = DBSession()
+    tag_names = set(tag_names)
+    names = list(tag_names)
+    for start in range(0, len(names), chunk_size):
+        chunk = names[start:start + chunk_size]
+        qry = session.query(Tag.name).filter(Tag.name.in_(chunk))
+        tag_names.difference_update(name for (name,) in qry)
+    if tag_names:
+        # Another request may have just created the same tag
+        insert = Tag.__table__.insert().prefix_with(
+            'OR IGNORE', dialect='sqlite')
+        session.execute(insert, [
+            dict(name=name) for name in sorted(tag_names)
+        ])
+        mark_changed(session)
+
+
+def load_sorted_tags(todo_ids, chunk_size=500):
+    """Fetch the tags for a batch of tasks in a single pass over the
+    association table instead of one query per task. Returns a dict
+    mapping each task id to the list of its tag names, already sorted
+    by the database. The ids are sent in chunks to stay under SQLite's
+    bound parameter limit.
+    """
+    tag_map = dict((todo_id, []) for todo_id in todo_ids)
+    todo_col = todoitemtag_table.c.todo_id
+    tag_col = todoitemtag_table.c.tag_id
+    ids = list(tag_map)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        qry = DBSession.query(todo_col, tag_col)
+        qry = qry.filter(todo_col.in_(chunk))
+        qry = qry.order_by(todo_col, tag_col)
+        for todo_id, tag_name in qry:
+            tag_map[todo_id].append(tag_name)
+    return tag_map
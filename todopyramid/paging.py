@@ -0,0 +1,231 @@
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+import json
+
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import or_
+
+from .models import TodoItem
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# The range of the ids SQLite and PostgreSQL can compare with
+MAX_ID = 2 ** 63 - 1
+
+
+SORT_COLUMNS = ('due_date', 'task')
+SORT_DIRECTIONS = ('asc', 'desc')
+
+SortKey = namedtuple('SortKey', ['name', 'expr', 'nullable', 'compare'])
+
+
+def sort_params(order_col, order_dir):
+    """Check the sort parameters from a request against the columns the
+    todo list can be sorted by. Unknown values fall back to the default
+    of due date, ascending.
+    """
+    if order_col not in SORT_COLUMNS:
+        order_col = 'due_date'
+    if order_dir not in SORT_DIRECTIONS:
+        order_dir = 'asc'
+    return order_col, order_dir
+
+
+def sort_style(dialect):
+    """Work out how to sort on a database backend. Returns how task names
+    are compared ignoring case, `nocase` for SQLite's collation or
+    `lower` for the lower() function, and whether the backend supports
+    NULLS LAST. SQLite only does since 3.30, older versions sort the
+    NULLs with a CASE expression instead.
+    """
+    if dialect is None or dialect.name == 'sqlite':
+        dbapi = getattr(dialect, 'dbapi', None)
+        version = getattr(dbapi, 'sqlite_version_info', (0,))
+        return 'nocase', tuple(version) >= (3, 30, 0)
+    if dialect.name == 'mysql':
+        return 'lower', False
+    return 'lower', True
+
+
+def sort_keys(order_col, case_style='nocase'):
+    """Return the keys that the todo list is ordered by as a list of
+    SortKey tuples. The task id is always added last as a tie breaker so
+    that every row has a unique position in the ordering.
+
+    The `case_style` picks how the task name is compared ignoring case,
+    to match the index on the backend. With `lower`, the values from a
+    cursor have to go through lower() as well, which is what `compare`
+    is for.
+    """
+    if order_col not in SORT_COLUMNS:
+        raise ValueError('Cannot sort by %s' % order_col)
+    if order_col == 'task' and case_style == 'lower':
+        keys = [SortKey('task', func.lower(TodoItem.task), False, func.lower)]
+    elif order_col == 'task':
+        keys = [SortKey('task', TodoItem.task.collate('NOCASE'), False, None)]
+    else:
+        keys = [SortKey('due_date', TodoItem.due_date, True, None)]
+    keys.append(SortKey('id', TodoItem.id, False, None))
+    return keys
+
+
+def order_clauses(keys, descending, nulls_last=True, native_nulls=False):
+    """Build the ORDER BY clauses for the given keys. NULL values of
+    nullable keys are sorted at the end of the list, whichever the
+    direction, or at the start if `nulls_last` is False. With
+    `native_nulls` the database's NULLS FIRST/LAST is used, otherwise a
+    CASE expression is sorted on first.
+    """
+    clauses = []
+    for key in keys:
+        clause = key.expr.desc() if descending else key.expr.asc()
+        if key.nullable and native_nulls:
+            clause = clause.nullslast() if nulls_last else clause.nullsfirst()
+        elif key.nullable:
+            is_null = case([(key.expr == None, 1)], else_=0)
+            clauses.append(is_null.asc() if nulls_last else is_null.desc())
+        clauses.append(clause)
+    return clauses
+
+
+def seek_predicate(keys, values, descending, forward=True):
+    """Build the filter that selects the rows that come after (or before
+    when `forward` is False) the row whose sort key values are given.
+    This lets the database seek straight to the page instead of
+    counting its way there with an OFFSET.
+    """
+    key = keys[0]
+    expr = key.expr
+    nullable = key.nullable
+    value = values[0]
+    rest = None
+    if len(keys) > 1:
+        rest = seek_predicate(keys[1:], values[1:], descending, forward)
+    if nullable and value is None:
+        if forward:
+            return and_(expr == None, rest)
+        return or_(expr != None, and_(expr == None, rest))
+    if key.compare is not None:
+        value = key.compare(value)
+    if forward != descending:
+        beyond = expr > value
+    else:
+        beyond = expr < value
+    if rest is None:
+        return beyond
+    if nullable and forward:
+        return or_(beyond, expr == None, and_(expr == value, rest))
+    return or_(beyond, and_(expr == value, rest))
+
+
+def encode_cursor(keys, item):
+    """Turn the sort key values of a row into an opaque url-safe token.
+    """
+    values = []
+    for key in keys:
+        value = getattr(item, key.name)
+        if isinstance(value, datetime):
+            value = value.strftime(CURSOR_DATE_FORMAT)
+        values.append(value)
+    token = urlsafe_b64encode(json.dumps(values).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(keys, token):
+    """Reverse `encode_cursor`. Returns None for a token that does not
+    match the given keys so a stale or tampered link shows the first
+    page instead of an error. The values are checked to have the types
+    of their keys, as they go straight into the query.
+    """
+    try:
+        token = str(token)
+        padding = '=' * (-len(token) % 4)
+        values = json.loads(
+            urlsafe_b64decode(token + padding).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(keys):
+            return None
+        for i, key in enumerate(keys):
+            value = values[i]
+            if value is None:
+                if not key.nullable:
+                    return None
+            elif key.name == 'id':
+                if isinstance(value, bool) or not isinstance(value, int) \
+                        or abs(value) > MAX_ID:
+                    return None
+            elif not isinstance(value, type(u'')):
+                return None
+            elif key.name == 'due_date':
+                values[i] = datetime.strptime(value, CURSOR_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    return values
+
+
+class Page(object):
+    """One page of a keyset paginated todo list, along with the cursors
+    needed to link to its neighbours.
+    """
+
+    def __init__(self, items, keys, has_prev, has_next):
+        self.items = items
+        self.keys = keys
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return encode_cursor(self.keys, self.items[0])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return encode_cursor(self.keys, self.items[-1])
+
+
+def paginate(query, order_col, order_dir, page_size, after=None,
+             before=None, dialect=None):
+    """Fetch one page of tasks from `query`. The `after` and `before`
+    cursors come from the next and previous links of another page. Each
+    page costs one query, no matter how deep into the list it is.
+
+    The ordering is built for the `dialect` of the database, which
+    defaults to the one the query's session is bound to.
+    """
+    if dialect is None:
+        dialect = query.session.get_bind().dialect
+    case_style, native_nulls = sort_style(dialect)
+    keys = sort_keys(order_col, case_style)
+    descending = order_dir == 'desc'
+    forward = True
+    cursor = after
+    if before and not after:
+        forward = False
+        cursor = before
+    values = None
+    if cursor:
+        values = decode_cursor(keys, cursor)
+    if values is None:
+        forward = True
+    else:
+        query = query.filter(
+            seek_predicate(keys, values, descending, forward))
+    if forward:
+        query = query.order_by(*order_clauses(
+            keys, descending, native_nulls=native_nulls))
+    else:
+        # Walk backwards from the cursor, then flip the rows back
+        query = query.order_by(*order_clauses(
+            keys, not descending, nulls_last=False,
+            native_nulls=native_nulls))
+    items = query.limit(page_size + 1).all()
+    more = len(items) > page_size
+    items = items[:page_size]
+    if forward:
+        return Page(items, keys, values is not None, more)
+    items.reverse()
+    return Page(items, keys, more, True)
@@ -0,0 +1,74 @@
+from collections import namedtuple
+import time
+
+from .cache import LRUCache
+from .models import DBSession
+from .models import DEFAULT_TIME_ZONE
+from .models import TodoUser
+
+Profile = namedtuple(
+    'Profile',
+    ['email', 'first_name', 'last_name', 'time_zone', 'profile_complete'],
+)
+
+
+def profile_time_zone(profile):
+    """The time zone of a profile, falling back to the default one when
+    the user has no profile or did not pick a time zone.
+    """
+    if profile is None or not profile.time_zone:
+        return DEFAULT_TIME_ZONE
+    return profile.time_zone
+
+
+class ProfileCache(object):
+    """Keeps the parts of a user's account that most requests need, so
+    that they do not have to load the user. Profiles expire after `ttl`
+    seconds, which bounds how stale they can get when another process
+    changes a user. Views changing a profile must call `invalidate` once
+    their transaction has been committed.
+    """
+
+    def __init__(self, ttl=300, max_entries=10000, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = LRUCache(max_entries=max_entries)
+
+    def load(self, user_id):
+        """Read a user's profile from the database, or None if there is
+        no such user.
+        """
+        qry = DBSession.query(
+            TodoUser.email,
+            TodoUser.first_name,
+            TodoUser.last_name,
+            TodoUser.time_zone,
+        )
+        row = qry.filter(TodoUser.email == user_id).first()
+        if row is None:
+            return None
+        return Profile(
+            row.email,
+            row.first_name,
+            row.last_name,
+            row.time_zone,
+            bool(row.first_name and row.last_name),
+        )
+
+    def get(self, user_id):
+        """Return the profile of a user. Missing users are not cached, so
+        a user that is created shows up right away.
+        """
+        entry = self.cache.get(user_id)
+        now = self.clock()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        profile = self.load(user_id)
+        if profile is None:
+            self.cache.invalidate(user_id)
+        else:
+            self.cache.set(user_id, (now + self.ttl, profile))
+        return profile
+
+    def invalidate(self, user_id):
+        self.cache.invalidate(user_id)
@@ -0,0 +1,311 @@
+from collections import namedtuple
+from datetime import datetime
+import heapq
+import json
+import logging
+import threading
+
+from pyramid.path import DottedNameResolver
+from pyramid.settings import asbool
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import select
+
+from .models import TodoItem
+
+log = logging.getLogger(__name__)
+
+Reminder = namedtuple('Reminder', ['todo_id', 'user', 'task', 'due_date'])
+
+
+class LogNotifier(object):
+    """Send reminders to the `todopyramid.reminders` log.
+    """
+
+    def __init__(self, settings=None):
+        pass
+
+    def notify(self, reminders):
+        for reminder in reminders:
+            log.info('Task %s of %s is due: %s', reminder.todo_id,
+                     reminder.user, reminder.task)
+
+
+class FileNotifier(object):
+    """Append reminders to a file as JSON lines, one for each task. The
+    file is set with `todopyramid.reminders.file`.
+    """
+
+    def __init__(self, settings):
+        self.path = settings['todopyramid.reminders.file']
+
+    def notify(self, reminders):
+        with open(self.path, 'a') as reminder_file:
+            for reminder in reminders:
+                reminder_file.write(json.dumps(dict(
+                    id=reminder.todo_id,
+                    user=reminder.user,
+                    task=reminder.task,
+                    due_date=reminder.due_date.isoformat(),
+                )) + '\n')
+
+
+NOTIFIERS = {
+    'log': LogNotifier,
+    'file': FileNotifier,
+}
+
+
+def notifier_from_settings(settings):
+    """Build the notifier chosen with `todopyramid.reminders.notifier`,
+    which can be `log`, `file` or the dotted name of a class that is
+    created with the settings and has a `notify(reminders)` method.
+    """
+    name = settings.get('todopyramid.reminders.notifier', 'log')
+    factory = NOTIFIERS.get(name)
+    if factory is None:
+        factory = DottedNameResolver().resolve(name)
+    return factory(settings)
+
+
+class ReminderQueue(object):
+    """A min-heap of the next tasks to come due, holding no more than
+    `size` of them. The heap is filled from the index on `due_date`,
+    one range of the next `size` tasks at a time, so the whole table is
+    never read.
+
+    Tasks that are edited or deleted are not removed from the heap, as
+    that would take a linear search. Their entries are invalidated
+    instead, and skipped as they come off the heap.
+    """
+
+    def __init__(self, engine, size=1000):
+        self.engine = engine
+        self.size = size
+        self.heap = []
+        # The due date each task in the heap is scheduled for
+        self.scheduled = {}
+        # Whether there are more tasks due after the last one loaded,
+        # which is due at `horizon`
+        self.truncated = False
+        self.horizon = None
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def schedule(self, todo_id, due_date):
+        """Move a task to a new due date. A task due after the loaded
+        range is left for a later load, which will pick it up in order.
+        """
+        if self.truncated and due_date > self.horizon:
+            self.cancel(todo_id)
+        elif self.scheduled.get(todo_id) != due_date:
+            self.scheduled[todo_id] = due_date
+            heapq.heappush(self.heap, (due_date, todo_id))
+
+    def cancel(self, todo_id):
+        self.scheduled.pop(todo_id, None)
+
+    def next_due(self):
+        """The due date of the first task in the heap, or None.
+        """
+        heap = self.heap
+        while heap and self.scheduled.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        """Take the tasks due by `now` off the heap, in the order they
+        come due, as a list of (due date, id).
+        """
+        due = []
+        while True:
+            due_date = self.next_due()
+            if due_date is None or due_date > now:
+                return due
+            todo_id = heapq.heappop(self.heap)[1]
+            del self.scheduled[todo_id]
+            due.append((due_date, todo_id))
+
+    def load(self, after, after_id=None):
+        """Replace the heap with the next tasks due after `after`, or
+        after the task `after_id` that is due at `after`. Tasks that
+        were deleted or moved since the last load drop out, and ones
+        that were added or moved into the range come in.
+        """
+        table = TodoItem.__table__
+        due_date = table.c.due_date
+        if after_id is None:
+            start = due_date > after
+        else:
+            # Written so the index is searched from `after` on
+            start = and_(due_date >= after,
+                         or_(due_date > after, table.c.id > after_id))
+        qry = select([due_date, table.c.id]).where(start)
+        qry = qry.order_by(due_date, table.c.id).limit(self.size)
+        with self.engine.connect() as connection:
+            rows = connection.execute(qry).fetchall()
+        self.heap = [(row[0], row[1]) for row in rows]
+        heapq.heapify(self.heap)
+        self.scheduled = dict((todo_id, due) for due, todo_id in self.heap)
+        self.truncated = len(rows) == self.size
+        self.horizon = rows[-1][0] if rows else None
+
+
+class ReminderScheduler(object):
+    """Send a reminder for each task as it comes due. Reminders are sent
+    for the tasks due after `since`, which defaults to the time the
+    scheduler is started, so tasks that came due while no scheduler ran
+    are not reminded of late.
+
+    Tasks saved, imported and deleted by the app are passed to
+    `tasks_changed` and `tasks_deleted` as their transaction commits,
+    when the scheduler runs in the app process. Other changes are
+    picked up as the queue is loaded again every `refresh` seconds.
+    Each load starts where the one before it did, so a task
+    another process added in between is still found, if late, even when
+    it came due before the load. Either way, a task is read again just
+    before its reminder is sent, and skipped when it was deleted or its
+    due date changed.
+    """
+
+    def __init__(self, engine, notifier, queue_size=1000, refresh=60,
+                 since=None):
+        self.engine = engine
+        self.notifier = notifier
+        self.queue = ReminderQueue(engine, size=queue_size)
+        self.refresh = refresh
+        self.sent_until = since or datetime.utcnow()
+        self.loaded = None
+        # Where the next load starts, and the reminders sent for tasks
+        # due after that, so they are not sent again
+        self.loaded_from = self.sent_until
+        self.sent = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def tasks_changed(self, changes):
+        """Schedule tasks that were saved, given as (id, due date).
+        """
+        with self.lock:
+            for todo_id, due_date in changes:
+                if due_date is None or due_date <= self.sent_until:
+                    self.queue.cancel(todo_id)
+                elif self.loaded is not None:
+                    self.queue.schedule(todo_id, due_date)
+        self.wakeup.set()
+
+    def tasks_deleted(self, todo_ids):
+        with self.lock:
+            for todo_id in todo_ids:
+                self.queue.cancel(todo_id)
+
+    def current_tasks(self, due):
+        """Read the tasks behind (due date, id) pairs, dropping the ones
+        that are gone or no longer due at that time.
+        """
+        table = TodoItem.__table__
+        qry = select([table.c.id, table.c.user, table.c.task,
+                      table.c.due_date])
+        qry = qry.where(table.c.id.in_([todo_id for _, todo_id in due]))
+        with self.engine.connect() as connection:
+            rows = dict((row.id, row) for row in connection.execute(qry))
+        reminders = []
+        for due_date, todo_id in due:
+            row = rows.get(todo_id)
+            if row is not None and row.due_date == due_date:
+                reminders.append(Reminder(*row))
+        return reminders
+
+    def run_pending(self, now=None):
+        """Send the reminders for the tasks due by `now`. Returns the
+        number of reminders sent.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        queue = self.queue
+        with self.lock:
+            reload = self.loaded is None or \
+                (now - self.loaded).total_seconds() >= self.refresh
+            if reload:
+                queue.load(self.loaded_from)
+                self.loaded = now
+            due = queue.pop_due(now)
+            # When every task loaded was due there may be more
+            while due and not len(queue) and queue.truncated:
+                queue.load(*due[-1])
+                due.extend(queue.pop_due(now))
+            due = [
+                (due_date, todo_id) for due_date, todo_id in due
+                if self.sent.get(todo_id) != due_date
+            ]
+            if reload:
+                # Every task due by now has been read from the database
+                self.loaded_from = now
+                self.sent = {}
+            for due_date, todo_id in due:
+                self.sent[todo_id] = due_date
+            self.sent_until = now
+        if not due:
+            return 0
+        reminders = self.current_tasks(due)
+        if reminders:
+            self.notifier.notify(reminders)
+        return len(reminders)
+
+    def seconds_to_wait(self, now):
+        """How long to sleep until the next task comes due, or until the
+        queue has to be loaded again.
+        """
+        wait = self.refresh - (now - self.loaded).total_seconds()
+        with self.lock:
+            next_due = self.queue.next_due()
+        if next_due is not None:
+            wait = min(wait, (next_due - now).total_seconds())
+        return max(wait, 0)
+
+    def run(self):
+        """Send reminders until `stop` is called.
+        """
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            try:
+                self.run_pending()
+                wait = self.seconds_to_wait(datetime.utcnow())
+            except Exception:
+                log.exception('Sending reminders failed')
+                self.loaded = None
+                wait = self.refresh
+            self.wakeup.wait(wait)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def scheduler_from_settings(engine, settings):
+    return ReminderScheduler(
+        engine,
+        notifier_from_settings(settings),
+        queue_size=int(settings.get('todopyramid.reminders.queue_size',
+                                    1000)),
+        refresh=int(settings.get('todopyramid.reminders.refresh', 60)),
+    )
+
+
+def start_reminders(engine, settings):
+    """Run the scheduler in a thread of the app process when
+    `todopyramid.reminders.enabled` is on. Only one process should send
+    reminders, so with several app processes use the
+    run_todopyramid_reminders script instead. Returns the running
+    scheduler, or None.
+    """
+    if not asbool(settings.get('todopyramid.reminders.enabled', False)):
+        return None
+    scheduler = scheduler_from_settings(engine, settings)
+    thread = threading.Thread(target=scheduler.run,
+                              name='todopyramid-reminders')
+    thread.daemon = True
+    thread.start()
+    return scheduler
@@ -8,7 +8,8 @@ from deform.widget import HiddenWidget
 from deform.widget import SelectWidget
 from deform_bootstrap_extra.widgets import TagsWidget
 from pytz import all_timezones
-from pytz import timezone
+
+from .utils import get_timezone
 
 
 class SettingsSchema(MappingSchema):
@@ -31,7 +32,7 @@ def deferred_datetime_node(node, kw):
     the timezone from the user's profile. See the generate_task_form
     method in views.py to see how this is bound together.
     """
-    tz = timezone(kw['user_tz'])
+    tz = get_timezone(kw['user_tz'])
     return DateTime(default_tzinfo=tz)
 
 
@@ -0,0 +1,88 @@
+from datetime import datetime
+from datetime import timedelta
+import os
+import sys
+import timeit
+
+from pyramid.request import Request
+from pyramid.encode import urlencode
+
+from ..grid import CompiledTodoGrid
+from ..grid import TodoGrid
+from ..models import TodoItem
+
+SIZES = (100, 1000, 10000)
+COLUMNS = ['task', 'tags', 'due_date', '']
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [rows ...]\n'
+          '(example: "%s 100 1000 10000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def make_items(count):
+    """Build `count` unsaved tasks with a mix of tags and due dates, and
+    the tag map the views would hand to the grid.
+    """
+    now = datetime.utcnow()
+    vocabulary = [u'quest', u'knight', u'ni', u'rabbit', u'discuss',
+                  u'grail', u'swallow', u'shrubbery']
+    items = []
+    tag_map = {}
+    for i in range(count):
+        due_date = None
+        if i % 5:
+            due_date = now + timedelta(hours=(i % 97) - 24)
+        item = TodoItem(
+            user=u'king.arthur@example.com',
+            task=u'Task number %s & <friends>' % i,
+            due_date=due_date,
+        )
+        item.id = i + 1
+        items.append(item)
+        tag_map[item.id] = sorted(vocabulary[i % 3:i % 3 + i % 4])
+    return items, tag_map
+
+
+def make_grid(grid_class, items, tag_map):
+    request = Request.blank(
+        '/list?order_col=due_date&order_dir=asc',
+        base_url='http://localhost:6543',
+    )
+
+    def url(_query=None):
+        return 'http://localhost:6543/list?' + urlencode(_query)
+
+    return grid_class(
+        request, u'quest', 'US/Eastern', items, COLUMNS,
+        url=url, tag_map=tag_map,
+    )
+
+
+def best_time(grid, repeat):
+    return min(timeit.repeat(grid.__html__, number=1, repeat=repeat))
+
+
+def main(argv=sys.argv):
+    """Compare how long TodoGrid and CompiledTodoGrid take to render the
+    same list, after checking that they render the same markup.
+    """
+    try:
+        sizes = [int(arg) for arg in argv[1:]] or SIZES
+    except ValueError:
+        usage(argv)
+    print('%8s %12s %12s %8s' % ('rows', 'TodoGrid', 'Compiled', 'speedup'))
+    for size in sizes:
+        items, tag_map = make_items(size)
+        grid = make_grid(TodoGrid, items, tag_map)
+        compiled = make_grid(CompiledTodoGrid, items, tag_map)
+        if grid.__html__() != compiled.__html__():
+            print('The renderers disagree for %s rows' % size)
+            sys.exit(1)
+        repeat = max(3, 10000 // size)
+        slow = best_time(grid, repeat)
+        fast = best_time(compiled, repeat)
+        print('%8s %10.2fms %10.2fms %7.1fx' % (
+            size, slow * 1000, fast * 1000, slow / fast))
@@ -0,0 +1,228 @@
+import argparse
+from datetime import datetime
+import json
+import math
+import os
+import resource
+import sys
+import timeit
+
+from pyramid.paster import bootstrap
+from pyramid.security import remember
+from sqlalchemy import event
+from sqlalchemy import func
+import transaction
+from webtest import TestApp
+
+from ..models import DBSession
+from ..models import TodoItem
+from ..models import UserTag
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Time the main views of the app through WSGI, and '
+                    'save the results to compare between commits.',
+        epilog='example: "%(prog)s development.ini --output before.json"',
+    )
+    parser.add_argument('config_uri')
+    parser.add_argument('--user', help='defaults to the user with the '
+                                       'most tasks')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests timed for each view')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='requests made before timing each view')
+    parser.add_argument('--output', help='file to save the results in')
+    parser.add_argument('--compare', help='results of an earlier run to '
+                                          'compare with')
+    parser.add_argument('--label', default='',
+                        help='saved with the results, like a commit id')
+    return parser.parse_args(argv[1:])
+
+
+def percentile(timings, percent):
+    """The nearest rank percentile of a sorted list.
+    """
+    rank = int(math.ceil(percent * len(timings) / 100.0))
+    return timings[min(max(rank, 1), len(timings)) - 1]
+
+
+def summarize(timings, queries, peak_bytes):
+    timings = sorted(timings)
+    return dict(
+        p50_ms=round(percentile(timings, 50) * 1000, 3),
+        p95_ms=round(percentile(timings, 95) * 1000, 3),
+        p99_ms=round(percentile(timings, 99) * 1000, 3),
+        mean_ms=round(sum(timings) / len(timings) * 1000, 3),
+        queries=round(float(sum(queries)) / len(queries), 1),
+        peak_kb=peak_bytes // 1024 if peak_bytes is not None else None,
+    )
+
+
+def busiest_user():
+    qry = DBSession.query(TodoItem.user, func.count(TodoItem.id))
+    row = qry.group_by(TodoItem.user).order_by(
+        func.count(TodoItem.id).desc()).first()
+    return row[0] if row else None
+
+
+def scenarios(user_id):
+    """The requests to time, as (name, method, path, params). They are
+    what a browser sends for each view.
+    """
+    top_tag = DBSession.query(UserTag.tag_id).filter(
+        UserTag.user == user_id,
+    ).order_by(UserTag.task_count.desc()).limit(1).scalar() or u'quest'
+    return [
+        ('home_view', 'GET', '/', None),
+        ('list_view', 'GET', '/list', None),
+        ('tag_view', 'GET', '/tags/%s' % top_tag, None),
+        ('tags_view', 'GET', '/tags', None),
+        ('tag_autocomplete', 'GET', '/tags.autocomplete',
+         dict(term=top_tag[:2])),
+        ('process_task_form', 'POST', '/list', [
+            ('id', ''),
+            ('name', u'Benchmark task'),
+            ('tags', u'benchmark,%s' % top_tag),
+            ('submit', 'submit'),
+        ]),
+    ]
+
+
+def sign_in(app, headers):
+    """Start a new browser session with the cookies of `remember`.
+    """
+    app.reset()
+    for name, value in headers:
+        if name == 'Set-Cookie':
+            cookie_name, cookie_value = value.split(';')[0].split('=', 1)
+            app.set_cookie(cookie_name, cookie_value)
+
+
+def run_scenario(app, method, path, params, count, warmup, queries,
+                 reset):
+    """Make `warmup` requests, then time `count` more. `queries` is the
+    list the query counter appends to, and `reset` is called after each
+    post so the flashed messages do not pile up in the session. Returns
+    the timings, the number of queries of each request and the peak
+    memory allocated while serving a request, when tracemalloc is
+    available.
+    """
+    def request():
+        if method == 'POST':
+            app.post(path, params)
+        else:
+            app.get(path, params)
+
+    for i in range(warmup):
+        request()
+        if method == 'POST':
+            reset()
+    timings = []
+    counts = []
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        peak = 0
+    try:
+        for i in range(count):
+            del queries[:]
+            if tracemalloc is not None:
+                tracemalloc.clear_traces()
+                base = tracemalloc.get_traced_memory()[0]
+            start = timeit.default_timer()
+            request()
+            timings.append(timeit.default_timer() - start)
+            counts.append(len(queries))
+            if tracemalloc is not None:
+                peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+            if method == 'POST':
+                reset()
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    return timings, counts, peak
+
+
+def print_results(results, baseline=None):
+    header = '%-18s %9s %9s %9s %8s %9s' % (
+        'view', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'peak kB')
+    if baseline is not None:
+        header += ' %9s' % 'p50 diff'
+    print(header)
+    for name, view in sorted(results['views'].items()):
+        line = '%-18s %9.2f %9.2f %9.2f %8.1f %9s' % (
+            name, view['p50_ms'], view['p95_ms'], view['p99_ms'],
+            view['queries'], view['peak_kb'])
+        old = baseline and baseline['views'].get(name)
+        if old:
+            line += ' %+8.1f%%' % (
+                (view['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100)
+        print(line)
+    print('peak rss: %s kB' % results['peak_rss_kb'])
+
+
+def main(argv=sys.argv):
+    """Time each main view over a number of requests, as the signed in
+    user with the most tasks. Run it against a copy of a database made
+    with generate_todopyramid_data, as the task form view adds tasks.
+    """
+    args = parse_args(argv)
+    env = bootstrap(args.config_uri)
+    try:
+        with transaction.manager:
+            user_id = args.user or busiest_user()
+            if user_id is None:
+                print('No tasks to benchmark, run '
+                      'generate_todopyramid_data first')
+                sys.exit(1)
+            requests = scenarios(user_id)
+            task_count = DBSession.query(TodoItem).filter(
+                TodoItem.user == user_id).count()
+        headers = remember(env['request'], user_id)
+        app = TestApp(env['app'])
+        sign_in(app, headers)
+        engine = DBSession.get_bind()
+        queries = []
+
+        def count_query(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_query)
+        results = dict(
+            label=args.label,
+            created=datetime.utcnow().isoformat(),
+            user=user_id,
+            tasks=task_count,
+            requests=args.requests,
+            views={},
+        )
+        try:
+            for name, method, path, params in requests:
+                timings, counts, peak = run_scenario(
+                    app, method, path, params, args.requests, args.warmup,
+                    queries, lambda: sign_in(app, headers))
+                results['views'][name] = summarize(timings, counts, peak)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_query)
+        # Kilobytes on Linux, bytes on OS X
+        results['peak_rss_kb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        env['closer']()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print('%s tasks of %s, %s requests per view\n' % (
+        task_count, user_id, args.requests))
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
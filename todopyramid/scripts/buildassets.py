@@ -0,0 +1,31 @@
+import os
+import sys
+
+from pyramid.paster import get_appsettings
+
+from ..assets import build_bundles
+from ..assets import bundle_directory
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Build the css and javascript bundles into the directory set with
+    `todopyramid.assets.directory`. Turn on `todopyramid.assets.bundles`
+    to serve them.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    settings = get_appsettings(argv[1])
+    directory = bundle_directory(settings)
+    manifest = build_bundles(directory)
+    for name in sorted(manifest):
+        path = os.path.join(directory, manifest[name])
+        print('%s: %s (%d bytes, %d gzipped)' % (
+            name, manifest[name], os.path.getsize(path),
+            os.path.getsize(path + '.gz')))
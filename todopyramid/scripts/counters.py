@@ -0,0 +1,78 @@
+import os
+import sys
+import transaction
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..models import (
+    DBSession,
+    TodoUser,
+    )
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [--rebuild]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def check_counts(user):
+    """Compare the maintained counters of a user with the real counts.
+    Returns a list of (name, stored, actual) tuples for each counter
+    that is off, where the name is either `tasks` or a tag name.
+    """
+    problems = []
+    task_count, tag_counts = user.actual_counts()
+    if user.task_count != task_count:
+        problems.append(('tasks', user.task_count, task_count))
+    stored = dict((row.tag_id, row.task_count) for row in user.user_tags)
+    for tag_name in sorted(set(stored) | set(tag_counts)):
+        if stored.get(tag_name, 0) != tag_counts.get(tag_name, 0):
+            problems.append((
+                tag_name,
+                stored.get(tag_name, 0),
+                tag_counts.get(tag_name, 0),
+            ))
+    return problems
+
+
+def main(argv=sys.argv):
+    """Check the task and tag counters of every user against the tasks
+    in the database. With `--rebuild` the counters of the users that are
+    off are rebuilt from the tasks.
+    """
+    if len(argv) < 2 or argv[2:] not in ([], ['--rebuild']):
+        usage(argv)
+    config_uri = argv[1]
+    rebuild = argv[2:] == ['--rebuild']
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    bad_users = 0
+    with transaction.manager:
+        users = DBSession.query(TodoUser).order_by(TodoUser.email).all()
+        for user in users:
+            problems = check_counts(user)
+            if not problems:
+                continue
+            bad_users += 1
+            for name, stored, actual in problems:
+                print('%s: %s is %s, should be %s' % (
+                    user.email, name, stored, actual))
+            if rebuild:
+                user.recount()
+    if bad_users and rebuild:
+        print('Rebuilt the counters of %s user(s)' % bad_users)
+    elif bad_users:
+        print('%s user(s) with wrong counters, '
+              'run with --rebuild to fix them' % bad_users)
+        sys.exit(1)
+    else:
+        print('All counters are consistent')
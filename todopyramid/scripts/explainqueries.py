@@ -0,0 +1,134 @@
+from datetime import datetime
+import os
+import sys
+import transaction
+
+from sqlalchemy import engine_from_config
+from sqlalchemy import event
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..exporter import iter_task_chunks
+from ..models import (
+    DBSession,
+    Tag,
+    TodoItem,
+    TodoUser,
+    UserTag,
+    load_revision,
+    load_sorted_tags,
+    )
+from ..paging import paginate
+from ..profiles import ProfileCache
+from ..reminders import ReminderQueue
+from ..tagindex import TagIndex
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [email]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def list_page(user, order_col, tag_name=None):
+    qry = user.todo_list
+    if tag_name is not None:
+        qry = qry.filter(TodoItem.tags.any(Tag.name.in_([tag_name])))
+    page = paginate(qry, order_col, 'asc', 100)
+    load_sorted_tags([item.id for item in page.items])
+    if page.has_next:
+        page = paginate(qry, order_col, 'asc', 100, after=page.next_cursor)
+
+
+def view_queries(user, tag_name):
+    """The queries each view runs, as (name, function) pairs. The
+    functions follow the same code paths as the views do. The reminder
+    queue's loads are listed too, as they read across all users.
+    """
+    user_id = user.email
+    reminders = ReminderQueue(DBSession.get_bind())
+    now = datetime.utcnow()
+    return [
+        ('conditional GET', lambda: load_revision(user_id)),
+        ('profile', lambda: ProfileCache().load(user_id)),
+        ('list by due date', lambda: list_page(user, 'due_date')),
+        ('list by task', lambda: list_page(user, 'task')),
+        ('tag %s' % tag_name, lambda: (
+            user.tag_count(tag_name),
+            list_page(user, 'due_date', tag_name),
+        )),
+        ('tags', lambda: user.user_tags),
+        ('tag autocomplete', lambda: TagIndex().load(user_id)),
+        ('export', lambda: list(iter_task_chunks(user_id))),
+        ('reminder queue', lambda: (
+            reminders.load(now),
+            reminders.load(now, 1),
+        )),
+    ]
+
+
+def explain(engine, statement, parameters):
+    """Return the lines of SQLite's query plan for a statement.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def main(argv=sys.argv):
+    """Print the query plan of every query the main views run, for the
+    given user or the first one in the database. Any table scans are
+    counted at the end, since they grow with the number of tasks.
+    """
+    if len(argv) not in (2, 3):
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name != 'sqlite':
+        print('Only SQLite query plans can be shown')
+        sys.exit(1)
+    DBSession.configure(bind=engine)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    scans = 0
+    with transaction.manager:
+        qry = DBSession.query(TodoUser)
+        if len(argv) == 3:
+            qry = qry.filter(TodoUser.email == argv[2])
+        user = qry.order_by(TodoUser.email).first()
+        if user is None:
+            print('No such user')
+            sys.exit(1)
+        top_tag = DBSession.query(UserTag.tag_id).filter(
+            UserTag.user == user.email,
+        ).order_by(UserTag.task_count.desc()).limit(1).scalar()
+        print('Query plans for %s\n' % user.email)
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            for name, run in view_queries(user, top_tag or u'quest'):
+                del statements[:]
+                run()
+                print('== %s' % name)
+                for statement, parameters in statements:
+                    print(' '.join(statement.split()))
+                    for line in explain(engine, statement, parameters):
+                        if line.startswith('SCAN') and 'INDEX' not in line:
+                            scans += 1
+                        print('    %s' % line)
+                print('')
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+    print('%s full table scan(s)' % scans)
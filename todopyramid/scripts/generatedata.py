@@ -0,0 +1,81 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..database import engine_from_settings
+from ..migrations import create_schema
+from ..models import DBSession
+from ..synthetic import TaskGenerator
+from ..synthetic import generate_data
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Fill a database with generated users and tasks, to '
+                    'try the app out at production sizes.',
+        epilog='example: "%(prog)s development.ini --users 100 '
+               '--tasks 1000-20000"',
+    )
+    parser.add_argument('config_uri')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--tasks', default='1000',
+                        help='tasks for each user, or a range like 10-5000')
+    parser.add_argument('--tags', type=int, default=200,
+                        help='size of the tag vocabulary')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='exponent of the Zipf distribution of tags')
+    parser.add_argument('--max-tags', type=int, default=4,
+                        help='most tags on a task')
+    parser.add_argument('--due-days', type=int, default=90,
+                        help='due dates fall this many days either side '
+                             'of today')
+    parser.add_argument('--no-due', type=float, default=0.2,
+                        help='share of the tasks without a due date')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='tasks inserted per transaction')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the same seed generates the same data')
+    args = parser.parse_args(argv[1:])
+    try:
+        counts = [int(count) for count in args.tasks.split('-', 1)]
+    except ValueError:
+        parser.error('--tasks takes a number or a range')
+    args.min_tasks, args.max_tasks = counts[0], counts[-1]
+    return args
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_settings(settings)
+    create_schema(engine)
+    DBSession.configure(bind=engine)
+    rng = random.Random(args.seed)
+    generator = TaskGenerator(
+        rng,
+        tag_count=args.tags,
+        exponent=args.zipf,
+        max_tags=args.max_tags,
+        due_days=args.due_days,
+        no_due_ratio=args.no_due,
+    )
+
+    def progress(user_id, task_count):
+        sys.stderr.write('%s: %s tasks\n' % (user_id, task_count))
+
+    start = time.time()
+    created = generate_data(
+        args.users, args.min_tasks, args.max_tasks, generator, rng,
+        batch_size=args.batch_size, progress=progress,
+    )
+    print('Created %s users and %s tasks in %.1fs' % (
+        args.users, created, time.time() - start))
@@ -0,0 +1,75 @@
+import argparse
+import io
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..database import engine_from_settings
+from ..importer import FORMATS
+from ..importer import ImportReport
+from ..importer import guess_format
+from ..importer import import_tasks
+from ..importer import read_records
+from ..models import DBSession
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Import tasks for a user from a JSONL or CSV file.',
+        epilog='example: "%(prog)s development.ini '
+               'king.arthur@example.com tasks.jsonl"',
+    )
+    parser.add_argument('config_uri')
+    parser.add_argument('email', help='the user to import the tasks for')
+    parser.add_argument('filename', help='the file to import, - for stdin')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='defaults to the extension of the file')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='tasks inserted per transaction')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    format = guess_format(args.format, args.filename)
+    if format is None:
+        print('Could not tell the format of %s, use --format' % (
+            args.filename))
+        sys.exit(1)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_settings(settings)
+    DBSession.configure(bind=engine)
+
+    def on_error(line, message):
+        sys.stderr.write('line %s: %s\n' % (line, message))
+
+    def progress(report):
+        sys.stderr.write('%s tasks imported, %s errors\n' % (
+            report.imported, report.error_count))
+
+    if args.filename == '-':
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        stream = io.open(args.filename, 'rb')
+    report = ImportReport(on_error=on_error)
+    try:
+        import_tasks(
+            args.email,
+            read_records(stream, format),
+            batch_size=args.batch_size,
+            report=report,
+            progress=progress,
+        )
+    finally:
+        if args.filename != '-':
+            stream.close()
+    print('Imported %s tasks with %s errors' % (
+        report.imported, report.error_count))
+    if report.error_count:
+        sys.exit(1)
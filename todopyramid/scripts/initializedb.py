@@ -11,11 +11,11 @@ from pyramid.paster import (
     setup_logging,
     )
 
+from ..migrations import create_schema
 from ..models import (
     DBSession,
     TodoItem,
     TodoUser,
-    Base,
     )
 
 
@@ -27,7 +27,8 @@ def usage(argv):
 
 
 def create_dummy_content(user_id):
-    """Create some tasks by default to show off the site
+    """Create some tasks by default to show off the site. The user must
+    already have been added to the session.
     """
     task = TodoItem(
         user=user_id,
@@ -78,6 +79,8 @@ def create_dummy_content(user_id):
         due_date=None,
     )
     DBSession.add(task)
+    user = DBSession.query(TodoUser).filter(TodoUser.email == user_id).one()
+    user.recount()
 
 
 def main(argv=sys.argv):
@@ -88,7 +91,7 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri)
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
-    Base.metadata.create_all(engine)
+    create_schema(engine)
     with transaction.manager:
         user = TodoUser(
             email=u'king.arthur@example.com',
@@ -0,0 +1,143 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+import transaction
+
+from ..database import engine_from_settings
+from ..database import locked_retries
+from ..migrations import create_schema
+from ..models import (
+    DBSession,
+    TodoItem,
+    TodoUser,
+    load_sorted_tags,
+    )
+from ..paging import paginate
+from ..scripts.initializedb import create_dummy_content
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Compare the throughput of concurrent reads and writes '
+                    'on SQLite with the default and production profiles.',
+    )
+    parser.add_argument('--seconds', type=float, default=5,
+                        help='how long each profile is loaded for')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--tasks', type=int, default=2000,
+                        help='tasks each user starts with')
+    return parser.parse_args(argv[1:])
+
+
+def setup_database(engine, users, tasks):
+    create_schema(engine)
+    DBSession.configure(bind=engine)
+    with transaction.manager:
+        for user_id in users:
+            DBSession.add(TodoUser(user_id, u'Load', u'Test'))
+            DBSession.flush()
+            for i in range(tasks // 7):
+                create_dummy_content(user_id)
+    DBSession.remove()
+
+
+def read(user_id):
+    """What list_view does to show the first page of a user's tasks.
+    """
+    with transaction.manager:
+        user = DBSession.query(TodoUser).get(user_id)
+        page = paginate(user.todo_list, 'due_date', 'asc', 100)
+        load_sorted_tags([item.id for item in page.items])
+
+
+def write(user_id, attempts):
+    """What process_task_form does to add a task.
+    """
+    for attempt in locked_retries(attempts):
+        with attempt:
+            user = DBSession.query(TodoUser).get(user_id)
+            tags = [u'load', u'test']
+            DBSession.add(TodoItem(user_id, u'Load test task', tags))
+            user.update_counts(tasks=1, added_tags=tags)
+            user.touch()
+
+
+def run_profile(settings, args):
+    """Load a new database with the given settings. Returns the number
+    of reads, writes and failed writes.
+    """
+    engine = engine_from_settings(settings)
+    users = [u'user%s@example.com' % i for i in range(args.writers + 1)]
+    setup_database(engine, users, args.tasks)
+    attempts = 1 if settings['todopyramid.sqlite.profile'] == 'default' else 5
+    counts = dict(reads=0, writes=0, errors=0)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(operation, user_id):
+        done = errors = 0
+        try:
+            while not stop.is_set():
+                try:
+                    operation(user_id)
+                    done += 1
+                except OperationalError:
+                    errors += 1
+        finally:
+            DBSession.remove()
+        with lock:
+            kind = 'reads' if operation is read else 'writes'
+            counts[kind] += done
+            counts['errors'] += errors
+
+    threads = [
+        threading.Thread(target=worker, args=(read, users[0]))
+        for i in range(args.readers)
+    ]
+    threads.extend(
+        threading.Thread(
+            target=worker,
+            args=(lambda user_id: write(user_id, attempts), user_id))
+        for user_id in users[1:]
+    )
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts['reads'], counts['writes'], counts['errors']
+
+
+def main(argv=sys.argv):
+    """Run the same mix of list page reads and task writes against a
+    scratch SQLite file with each profile, and print the throughput.
+    """
+    args = parse_args(argv)
+    directory = tempfile.mkdtemp()
+    try:
+        print('%-12s %10s %10s %14s' % (
+            'profile', 'reads/s', 'writes/s', 'failed writes'))
+        for profile in ('default', 'production'):
+            path = os.path.join(directory, '%s.sqlite' % profile)
+            settings = {
+                'sqlalchemy.url': 'sqlite:///%s' % path,
+                'todopyramid.sqlite.profile': profile,
+                'todopyramid.sqlite.pool_size': str(
+                    args.readers + args.writers),
+            }
+            reads, writes, errors = run_profile(settings, args)
+            print('%-12s %10.1f %10.1f %14s' % (
+                profile, reads / args.seconds, writes / args.seconds,
+                errors))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,50 @@
+import os
+import sys
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..migrations import LATEST_VERSION
+from ..migrations import migrate
+from ..migrations import pending_migrations
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [--dry-run]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Upgrade an existing SQLite database to the current schema. With
+    `--dry-run` the pending migrations are only listed.
+    """
+    if len(argv) < 2 or argv[2:] not in ([], ['--dry-run']):
+        usage(argv)
+    config_uri = argv[1]
+    dry_run = argv[2:] == ['--dry-run']
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name != 'sqlite':
+        print('Only SQLite databases can be migrated')
+        sys.exit(1)
+    pending = pending_migrations(engine)
+    if not pending:
+        print('The database is up to date (version %s)' % LATEST_VERSION)
+        return
+    if dry_run:
+        for version, description, upgrade in pending:
+            print('%s: %s' % (version, description))
+        return
+
+    def progress(version, description):
+        print('Upgrading to version %s: %s' % (version, description))
+
+    migrate(engine, progress=progress)
+    print('The database is up to date (version %s)' % LATEST_VERSION)
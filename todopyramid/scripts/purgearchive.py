@@ -0,0 +1,59 @@
+from datetime import datetime
+from datetime import timedelta
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..archive import compact
+from ..archive import purge_archive
+from ..database import engine_from_settings
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [--days N] [--vacuum]\n'
+          '(example: "%s production.ini --days 365")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Delete the completed tasks that are older than the retention
+    period from the archive. The period is given in days with `--days`,
+    or set with `todopyramid.archive.retention_days`, where 0 keeps the
+    archive forever. With `--vacuum` the database file is compacted
+    afterwards.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    args = argv[2:]
+    vacuum = '--vacuum' in args
+    if vacuum:
+        args.remove('--vacuum')
+    days = None
+    if args:
+        if len(args) != 2 or args[0] != '--days':
+            usage(argv)
+        try:
+            days = int(args[1])
+        except ValueError:
+            usage(argv)
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    if days is None:
+        days = int(settings.get('todopyramid.archive.retention_days', 0))
+    engine = engine_from_settings(settings)
+    if days > 0:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        purged = purge_archive(engine, cutoff)
+        print('Purged %s tasks completed before %s' % (
+            purged, cutoff.strftime('%Y-%m-%d')))
+    else:
+        print('No retention period set, the archive is kept')
+    if vacuum:
+        compact(engine)
+        print('Compacted the database')
@@ -0,0 +1,38 @@
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..database import engine_from_settings
+from ..models import create_search_index
+from ..search import rebuild_search_index
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Create the full text search index if it is missing, and fill it
+    from the tasks in the database.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_settings(settings)
+    with engine.begin() as connection:
+        if not create_search_index(connection):
+            print('The database does not support full text search, '
+                  'searches scan the tasks instead')
+            sys.exit(1)
+        rebuild_search_index(connection)
+        count = connection.execute('SELECT count(*) FROM tasksearch').scalar()
+    print('Indexed %s tasks' % count)
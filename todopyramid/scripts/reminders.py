@@ -0,0 +1,34 @@
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..database import engine_from_settings
+from ..reminders import scheduler_from_settings
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Send reminders for tasks as they come due, through the notifier
+    set with `todopyramid.reminders.notifier`, until interrupted.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_settings(settings)
+    scheduler = scheduler_from_settings(engine, settings)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -0,0 +1,211 @@
+import binascii
+import re
+
+from sqlalchemy import or_
+from sqlalchemy import text
+
+from .models import DBSession
+from .models import Tag
+from .models import TodoItem
+
+# Words of the search, at most MAX_TERMS of them
+TERM = re.compile(r'\w+', re.UNICODE)
+MAX_TERMS = 10
+
+# Matches in the task name count for more than matches in the tags, and
+# the user column, which every task of the user matches, does not count
+RANKED = (
+    'SELECT rowid AS id, bm25(tasksearch, 2.0, 1.0, 0.0) AS score '
+    'FROM tasksearch WHERE tasksearch MATCH :query'
+)
+FIRST_PAGE = text(
+    'SELECT id, score FROM (' + RANKED + ') '
+    'ORDER BY score, id LIMIT :limit'
+)
+NEXT_PAGE = text(
+    'SELECT id, score FROM (' + RANKED + ') '
+    'WHERE score > :score OR (score = :score AND id > :id) '
+    'ORDER BY score, id LIMIT :limit'
+)
+PREV_PAGE = text(
+    'SELECT id, score FROM (' + RANKED + ') '
+    'WHERE score < :score OR (score = :score AND id < :id) '
+    'ORDER BY score DESC, id DESC LIMIT :limit'
+)
+MATCH_COUNT = text(
+    'SELECT count(*) FROM tasksearch WHERE tasksearch MATCH :query')
+
+
+def search_terms(search_text):
+    """Split a search into lower case words. Anything else the user
+    typed is dropped, so the FTS5 query syntax can not be misused.
+    """
+    return TERM.findall(search_text.lower())[:MAX_TERMS]
+
+
+def user_token(user_id):
+    """The single token a user's tasks are indexed under. It is the hex
+    of the email, as the tokenizer would split the email itself, and
+    matches what the triggers store with SQLite's hex().
+    """
+    return binascii.hexlify(user_id.encode('utf-8')).decode('ascii').upper()
+
+
+def match_query(terms, user_id):
+    """An FTS5 query matching the user's tasks that have all of the terms
+    in their name or tags, the last one as a prefix so that results show
+    up while typing. Filtering on the user inside the match keeps the
+    index from reading the matches of every other user.
+    """
+    parts = ['"%s"' % term for term in terms]
+    parts[-1] += '*'
+    return 'user : "%s" AND {task tags} : (%s)' % (
+        user_token(user_id), ' '.join(parts))
+
+
+def has_search_index(connection):
+    """Check if the database has the full text index.
+    """
+    if connection.dialect.name != 'sqlite':
+        return False
+    row = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'tasksearch'").first()
+    return row is not None
+
+
+def rebuild_search_index(connection):
+    """Fill the full text index from the tasks, for databases that had
+    tasks before the index was added, or to repair it.
+    """
+    connection.execute('DELETE FROM tasksearch')
+    connection.execute(
+        'INSERT INTO tasksearch (rowid, task, tags, user) '
+        'SELECT id, task, coalesce(('
+        "SELECT group_concat(tag_id, ' ') FROM todoitemtag "
+        "WHERE todo_id = todoitems.id), ''), hex(user) FROM todoitems"
+    )
+    connection.execute("INSERT INTO tasksearch (tasksearch) "
+                       "VALUES ('optimize')")
+
+
+class SearchPage(object):
+    """One page of search results, used like `paging.Page` by the grid
+    pager. The cursors are made by the search that found the page.
+    """
+
+    def __init__(self, items, total, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.total = total
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.has_prev = prev_cursor is not None
+        self.has_next = next_cursor is not None
+
+
+def encode_rank_cursor(score, todo_id):
+    return '%r:%d' % (score, todo_id)
+
+
+def decode_rank_cursor(cursor):
+    """Reverse `encode_rank_cursor`. Returns None for a cursor that can
+    not be read, so a tampered link shows the first page.
+    """
+    try:
+        score, todo_id = cursor.rsplit(':', 1)
+        return float(score), int(todo_id)
+    except ValueError:
+        return None
+
+
+def load_tasks(user_id, ids):
+    """The tasks with the given ids, in the same order.
+    """
+    tasks = {}
+    if ids:
+        qry = DBSession.query(TodoItem).filter(
+            TodoItem.id.in_(ids), TodoItem.user == user_id)
+        tasks = dict((item.id, item) for item in qry)
+    return [tasks[todo_id] for todo_id in ids if todo_id in tasks]
+
+
+def full_text_search(user_id, terms, page_size, after=None, before=None):
+    """Search the index, best match first. The pages are cut by keyset on
+    the rank and id of the last row of the page before, so a page deep
+    into the results is not counted off from the first one.
+    """
+    params = dict(query=match_query(terms, user_id), limit=page_size + 1)
+    forward = True
+    cursor = after and decode_rank_cursor(after)
+    if not cursor and before:
+        cursor = decode_rank_cursor(before)
+        forward = cursor is None
+    if cursor is None:
+        qry = FIRST_PAGE
+    else:
+        params['score'], params['id'] = cursor
+        qry = NEXT_PAGE if forward else PREV_PAGE
+    rows = DBSession.execute(qry, params).fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if forward:
+        has_prev, has_next = cursor is not None, more
+    else:
+        # Going back, the page the link was on comes next
+        rows.reverse()
+        has_prev, has_next = more, True
+    total = DBSession.execute(MATCH_COUNT, params).scalar()
+    prev_cursor = next_cursor = None
+    if rows and has_prev:
+        prev_cursor = encode_rank_cursor(rows[0].score, rows[0].id)
+    if rows and has_next:
+        next_cursor = encode_rank_cursor(rows[-1].score, rows[-1].id)
+    items = load_tasks(user_id, [row.id for row in rows])
+    return SearchPage(items, total, prev_cursor, next_cursor)
+
+
+def like_search(user_id, terms, page_size, after=None, before=None):
+    """The fallback for databases without the full text index. Each
+    term has to be part of the task name or of one of its tags. The
+    results are not ranked, the tasks that are due first come first.
+    The cursors are offsets, as the results are only ever paged through
+    a few pages deep.
+    """
+    offset = 0
+    try:
+        if after:
+            offset = max(int(after), 0)
+        elif before:
+            offset = max(int(before) - page_size, 0)
+    except ValueError:
+        offset = 0
+    qry = DBSession.query(TodoItem).filter(TodoItem.user == user_id)
+    for term in terms:
+        pattern = u'%' + term.replace(u'_', u'\\_') + u'%'
+        qry = qry.filter(or_(
+            TodoItem.task.ilike(pattern, escape=u'\\'),
+            TodoItem.tags.any(Tag.name.like(pattern, escape=u'\\')),
+        ))
+    total = qry.count()
+    qry = qry.order_by(TodoItem.due_date, TodoItem.id)
+    items = qry.limit(page_size + 1).offset(offset).all()
+    prev_cursor = next_cursor = None
+    if offset > 0:
+        prev_cursor = str(offset)
+    if len(items) > page_size:
+        next_cursor = str(offset + page_size)
+    return SearchPage(items[:page_size], total, prev_cursor, next_cursor)
+
+
+def search_tasks(user_id, search_text, page_size, after=None, before=None,
+                 full_text=True):
+    """Search a user's tasks for the words of `search_text`, best match
+    first. `after` and `before` are the cursors of the next and previous
+    links of another page. With `full_text` the index is used, otherwise
+    the tasks are scanned with LIKE.
+    """
+    terms = search_terms(search_text)
+    if not terms:
+        return SearchPage([], 0)
+    search = full_text_search if full_text else like_search
+    return search(user_id, terms, page_size, after=after, before=before)
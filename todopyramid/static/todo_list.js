@@ -1,5 +1,10 @@
 $(function() {
 
+    // Send the session token with the requests that change tasks
+    $.ajaxSetup({
+        headers: {'X-CSRF-Token': $('meta[name="csrf-token"]').attr('content')}
+    });
+
     // Show the fancy version of the due date
     $('.due-date').each(function() {
         var due_date = $(this).text();
@@ -47,41 +52,69 @@ $(function() {
         });
     });
 
+    // Complete a batch of tasks in one request. The tasks are moved to
+    // the archive, and the rows of the ones that were are removed.
+    function complete_tasks(rows, message) {
+        var ids = rows.map(function() {
+            return $(this).find('ul.dropdown-menu').attr('id');
+        }).get();
+        $.post(
+            '/complete.tasks',
+            {'ids': ids.join(',')},
+            function(json) {
+                if (json) {
+                    // Remove the rows
+                    $.each(json.deleted, function(i, todo_id) {
+                        $(document.getElementById(String(todo_id))).closest('tr').remove();
+                    });
+                    // Display a confirmation message
+                    var flash = $('div.alert.hide').clone();
+                    flash.html(flash.html() + message);
+                    flash.removeClass('hide');
+                    flash.addClass('alert-success');
+                    $('#flash-messages').append(flash);
+                    flash.show();
+                    // Change the count on the page
+                    var count = $('.count');
+                    var new_count = parseInt(count.text(), 10) - json.deleted.length;
+                    count.text(new_count);
+                    // Remove the table if we completed the last item
+                    if (new_count === 0) {
+                        $('.table').hide();
+                        $('.todo-complete-selected').hide();
+                        $('#content').append('<p>All done, nice work!</p>');
+                    }
+                }
+            },
+            'json'
+        );
+    }
+
     // Compete a todo task when the link is clicked
     $("a.todo-complete").click(function(e) {
         e.preventDefault();
-        var todo_id = $(this).closest('ul').attr('id');
         var task = $(this).closest('tr');
         var task_name = task.children().first().text();
-        var confirm_text = "<p>Confirm completion of <b><i>" + task_name + "</i></b></p><p>This action is not reversible and your task will be <b>deleted</b></p>";
+        var confirm_text = "<p>Confirm completion of <b><i>" + task_name + "</i></b></p><p>Your task will be moved to the <b>archive</b></p>";
         bootbox.confirm(confirm_text, function(complete_item) {
             if (complete_item) {
-                $.getJSON(
-                    '/delete.task',
-                    {'id': todo_id},
-                    function(json) {
-                        if (json) {
-                            // Delete the row
-                            task.remove();
-                            // Display a confirmation message
-                            var flash = $('div.alert.hide').clone();
-                            flash.html(flash.html() + "<b><i>" + task_name + "</i></b> was deleted");
-                            flash.removeClass('hide');
-                            flash.addClass('alert-error');
-                            $('#flash-messages').append(flash);
-                            flash.show();
-                            // Change the count on the page
-                            var count = $('.count');
-                            var new_count = parseInt(count.text(), 10) - 1;
-                            count.text(new_count);
-                            // Remove the table if we deleted the last item
-                            if (new_count === 0) {
-                                $('.table').hide();
-                                $('#content').append('<p>All done, nice work!</p>');
-                            }
-                        }
-                    }
-                );
+                complete_tasks(task, "<b><i>" + task_name + "</i></b> was completed");
+            }
+        });
+    });
+
+    // Complete all of the selected tasks at once
+    $("a.todo-complete-selected").click(function(e) {
+        e.preventDefault();
+        var tasks = $('input.todo-select:checked').closest('tr');
+        if (tasks.length === 0) {
+            return;
+        }
+        var label = tasks.length === 1 ? " task" : " tasks";
+        var confirm_text = "<p>Confirm completion of <b>" + tasks.length + label + "</b></p><p>Your tasks will be moved to the <b>archive</b></p>";
+        bootbox.confirm(confirm_text, function(complete_items) {
+            if (complete_items) {
+                complete_tasks(tasks, "<b>" + tasks.length + label + "</b> completed");
             }
         });
     });
@@ -0,0 +1,131 @@
+from bisect import bisect_left
+from datetime import datetime
+from datetime import timedelta
+import random
+
+import transaction
+
+from .database import locked_retries
+from .importer import write_batch
+from .models import DBSession
+from .models import TodoUser
+
+WORDS = [
+    u'grail', u'quest', u'knight', u'rabbit', u'shrubbery', u'swallow',
+    u'coconut', u'castle', u'bridge', u'witch', u'herring', u'tim',
+    u'camelot', u'lancelot', u'robin', u'galahad', u'bedevere', u'arthur',
+    u'french', u'taunt', u'holy', u'hand', u'grenade', u'ni', u'cave',
+    u'sword', u'lake', u'peasant', u'king', u'dennis', u'spam', u'parrot',
+]
+
+
+class ZipfSampler(object):
+    """Pick from `values` with the k-th value drawn in proportion to
+    1 / k ** `exponent`, the long tail real tag usage has: a few tags
+    are on most tasks and most tags are on a few.
+    """
+
+    def __init__(self, values, exponent=1.1, rng=random):
+        self.values = values
+        self.rng = rng
+        total = 0.0
+        self.cumulative = []
+        for rank in range(1, len(values) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def sample(self):
+        point = self.rng.random() * self.cumulative[-1]
+        index = bisect_left(self.cumulative, point)
+        return self.values[min(index, len(self.values) - 1)]
+
+    def sample_distinct(self, count):
+        """Up to `count` different values. Fewer are returned when the
+        popular values keep coming up, as happens with real tags.
+        """
+        picked = []
+        for i in range(count * 3):
+            if len(picked) == count:
+                break
+            value = self.sample()
+            if value not in picked:
+                picked.append(value)
+        return picked
+
+
+def tag_vocabulary(size):
+    """`size` tag names, the most common first.
+    """
+    tags = []
+    for i in range(size):
+        word = WORDS[i % len(WORDS)]
+        tags.append(word if i < len(WORDS) else u'%s%s' % (
+            word, i // len(WORDS)))
+    return tags
+
+
+class TaskGenerator(object):
+    """Make (task, due_date, tags) rows like the ones `write_batch`
+    inserts. Due dates are spread evenly from `due_days` days ago to
+    `due_days` days ahead, and `no_due_ratio` of the tasks have none.
+    Each task has up to `max_tags` tags from a Zipf distribution over a
+    vocabulary of `tag_count` tags.
+    """
+
+    def __init__(self, rng, tag_count=200, exponent=1.1, max_tags=4,
+                 due_days=90, no_due_ratio=0.2, now=None):
+        self.rng = rng
+        self.tags = ZipfSampler(tag_vocabulary(tag_count), exponent, rng)
+        self.max_tags = max_tags
+        self.due_seconds = due_days * 24 * 3600
+        self.no_due_ratio = no_due_ratio
+        self.now = now or datetime.utcnow().replace(microsecond=0)
+
+    def task(self, number):
+        rng = self.rng
+        name = u' '.join(rng.choice(WORDS) for i in range(rng.randint(2, 6)))
+        due_date = None
+        if rng.random() >= self.no_due_ratio:
+            due_date = self.now + timedelta(seconds=rng.randint(
+                -self.due_seconds, self.due_seconds))
+        tags = self.tags.sample_distinct(rng.randint(0, self.max_tags))
+        return u'%s %s' % (name.capitalize(), number), due_date, tags
+
+    def tasks(self, count):
+        for number in range(1, count + 1):
+            yield self.task(number)
+
+
+def generate_data(user_count, min_tasks, max_tasks, generator, rng,
+                  batch_size=1000, progress=None):
+    """Create `user_count` users with between `min_tasks` and `max_tasks`
+    tasks each. The tasks are written with the bulk insert of the
+    importer, `batch_size` to a transaction, and `progress` is called
+    with the user id and the number of tasks after each user. Returns
+    the number of tasks created.
+    """
+    created = 0
+    with transaction.manager:
+        start = DBSession.query(TodoUser).count()
+    for number in range(start + 1, start + user_count + 1):
+        user_id = u'user%05d@example.com' % number
+        with transaction.manager:
+            DBSession.add(TodoUser(user_id, u'User', u'%05d' % number,
+                                   time_zone=u'UTC'))
+        batch = []
+        task_count = rng.randint(min_tasks, max_tasks)
+        for row in generator.tasks(task_count):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                for attempt in locked_retries():
+                    with attempt:
+                        write_batch(user_id, batch)
+                batch = []
+        if batch:
+            for attempt in locked_retries():
+                with attempt:
+                    write_batch(user_id, batch)
+        created += task_count
+        if progress is not None:
+            progress(user_id, task_count)
+    return created
@@ -0,0 +1,71 @@
+from collections import namedtuple
+
+from sqlalchemy import and_
+from sqlalchemy import distinct
+from sqlalchemy import func
+from sqlalchemy import select
+
+from .models import TodoItem
+from .models import normalize_tags
+from .models import todoitemtag_table
+
+# The most tags a tag page can be filtered on
+MAX_TAGS = 10
+
+TagFilter = namedtuple('TagFilter', ['included', 'excluded', 'match_all'])
+
+
+def parse_tag_filter(expression):
+    """Parse the tags of a tag page url. Tags joined with `+` all have
+    to be on a task, and of tags joined with `,` any one of them. A tag
+    starting with `-` must not be on a task, so `quest+knight,-rabbit`
+    is not allowed but `quest+knight+-rabbit` is. Returns None for an
+    expression that mixes `+` and `,`, or has no tag to include.
+    """
+    if '+' in expression and ',' in expression:
+        return None
+    match_all = ',' not in expression
+    parts = expression.split('+' if match_all else ',')
+    included = normalize_tags(
+        [part for part in parts if not part.startswith('-')])
+    excluded = normalize_tags(
+        [part[1:] for part in parts if part.startswith('-')])
+    if not included or len(included) + len(excluded) > MAX_TAGS:
+        return None
+    if len(included) == 1:
+        match_all = True
+    return TagFilter(included, excluded, match_all)
+
+
+def tagged_tasks(user_id, tag_names):
+    """Select the ids of the user's tasks with any of the tags, as a
+    pass over the index on the association table for each tag.
+    """
+    table = todoitemtag_table
+    todo_table = TodoItem.__table__
+    qry = select([table.c.todo_id]).select_from(
+        table.join(todo_table, todo_table.c.id == table.c.todo_id))
+    return qry.where(and_(
+        todo_table.c.user == user_id,
+        table.c.tag_id.in_(tag_names),
+    ))
+
+
+def tag_filter_clause(user_id, tag_filter):
+    """Return a clause that picks the tasks of a user passing a filter,
+    as one query. When a task has to have all of the included tags, the
+    tagged tasks are grouped and a task passes when it was found once
+    for each of the tags. Tasks with excluded tags are subtracted with
+    NOT IN.
+    """
+    table = todoitemtag_table
+    matching = tagged_tasks(user_id, tag_filter.included)
+    if tag_filter.match_all and len(tag_filter.included) > 1:
+        matching = matching.group_by(table.c.todo_id).having(
+            func.count(distinct(table.c.tag_id)) ==
+            len(tag_filter.included))
+    clause = TodoItem.id.in_(matching)
+    if tag_filter.excluded:
+        excluded = tagged_tasks(user_id, tag_filter.excluded)
+        clause = and_(clause, ~TodoItem.id.in_(excluded))
+    return clause
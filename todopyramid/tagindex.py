@@ -0,0 +1,100 @@
+from bisect import bisect_left
+import heapq
+import sys
+import threading
+
+from .cache import LRUCache
+from .models import DBSession
+from .models import UserTag
+
+
+class UserTagIndex(object):
+    """A prefix index over the tags of a single user. The tag names are
+    kept in a sorted list so that all the tags starting with a term can
+    be found with two binary searches.
+    """
+
+    def __init__(self, tag_counts):
+        self.counts = dict(tag_counts)
+        self.names = sorted(self.counts)
+
+    def complete(self, term, limit):
+        """Return up to `limit` tags starting with `term`, the most used
+        ones first.
+        """
+        start = bisect_left(self.names, term)
+        end = bisect_left(self.names, term + u'\uffff', start)
+        return heapq.nsmallest(
+            limit,
+            self.names[start:end],
+            key=lambda name: (-self.counts[name], name),
+        )
+
+    def sizeof(self):
+        """Approximate the memory used by the index, in bytes.
+        """
+        size = sys.getsizeof(self.names) + sys.getsizeof(self.counts)
+        for name in self.names:
+            size += sys.getsizeof(name)
+        return size
+
+
+class TagIndex(object):
+    """Autocompletion for tags, scoped to each user's own tags. The
+    per-user indexes are built lazily from the tag counters and kept in
+    an LRU cache bounded by `max_bytes`, so the database is only hit the
+    first time a user autocompletes after a change to their tags.
+
+    The index lives in the process, which is how the app is served with
+    waitress. Write paths must call `invalidate` once the transaction
+    changing a user's tags has been committed. An index whose load
+    overlapped an invalidation is used for that request but not cached,
+    as it may predate the change.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, limit=10):
+        self.limit = limit
+        self.cache = LRUCache(
+            max_bytes=max_bytes, sizeof=lambda index: index.sizeof())
+        # The users whose index is being loaded, with the number of
+        # loads and a generation bumped by each invalidation. Users are
+        # dropped once their last load is done, so only the loads in
+        # flight are kept.
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def load(self, user_id):
+        """Build the index for a user from their tag counters.
+        """
+        qry = DBSession.query(UserTag.tag_id, UserTag.task_count)
+        qry = qry.filter(UserTag.user == user_id)
+        return UserTagIndex(qry.all())
+
+    def complete(self, user_id, term, limit=None):
+        """Return the names of the user's tags that start with `term`,
+        ranked by how many tasks use them.
+        """
+        index = self.cache.get(user_id)
+        if index is None:
+            with self.lock:
+                loads = self.loading.setdefault(user_id, [0, 0])
+                loads[0] += 1
+                generation = loads[1]
+            try:
+                index = self.load(user_id)
+            finally:
+                with self.lock:
+                    loads[0] -= 1
+                    if not loads[0]:
+                        del self.loading[user_id]
+                    if index is not None and loads[1] == generation:
+                        self.cache.set(user_id, index)
+        term = term.strip().lower()
+        return index.complete(term, limit or self.limit)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            loads = self.loading.get(user_id)
+            if loads is not None:
+                loads[1] += 1
+            self.cache.invalidate(user_id)
@@ -0,0 +1,177 @@
+from datetime import datetime
+
+from pyramid.threadlocal import get_current_registry
+from sqlalchemy import and_
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from .models import ArchivedTask
+from .models import DBSession
+from .models import TodoItem
+from .models import normalize_tags
+from .models import todoitemtag_table
+from .utils import universify_datetime
+
+
+def captured_values(captured):
+    """Turn the values deserialized by the TodoSchema into the task
+    name, a list of normalized tags and a naive UTC due date, ready to
+    be stored.
+    """
+    tags = captured.get('tags', [])
+    if tags:
+        tags = normalize_tags(tags.split(','))
+    due_date = captured.get('due_date')
+    if due_date is not None:
+        # Convert back to UTC for storage
+        due_date = universify_datetime(due_date)
+    return captured['name'], tags, due_date
+
+
+def reminder_scheduler():
+    """The reminder scheduler running in this process, if any. It is
+    told about the tasks that are saved and deleted, so that reminders
+    follow edits right away.
+    """
+    return getattr(get_current_registry(), 'reminders', None)
+
+
+def after_commit(func, *args):
+    """Call `func` once the current transaction has committed, so that a
+    transaction that is aborted or retried leaves no trace.
+    """
+    def hook(committed, *args):
+        if committed:
+            func(*args)
+
+    transaction.get().addAfterCommitHook(hook, args)
+
+
+def save_task(user, name, tags, due_date, task_id=None):
+    """Create a task for a user, or update it when `task_id` is one of
+    their tasks. The user's counters and revision are kept up to date,
+    so this has to be called within a transaction. Returns the task,
+    whether it was created, and the tags that were added and removed.
+    """
+    DBSession.add(user)
+    task = None
+    if task_id is not None:
+        task = DBSession.query(TodoItem).filter(
+            TodoItem.id == task_id,
+            TodoItem.user == user.email,
+        ).first()
+    created = task is None
+    if created:
+        task = TodoItem(
+            user=user.email,
+            task=name,
+            tags=tags,
+            due_date=due_date,
+        )
+        DBSession.add(task)
+        added_tags, removed_tags = tags, []
+    else:
+        # Update in place so only the changed tags are written
+        task.task = name
+        task.due_date = due_date
+        added_tags, removed_tags = task.set_tags(tags)
+        task.touch()
+    # Keep the task and tag counters up to date
+    user.update_counts(
+        tasks=1 if created else 0,
+        added_tags=added_tags,
+        removed_tags=removed_tags,
+    )
+    user.touch()
+    scheduler = reminder_scheduler()
+    if scheduler is not None:
+        if created:
+            # A new task needs its id to be scheduled
+            DBSession.flush()
+        after_commit(scheduler.tasks_changed, [(task.id, due_date)])
+    return task, created, added_tags, removed_tags
+
+
+def delete_task(user, todo_id):
+    """Delete one of a user's tasks, within a transaction. Returns the
+    tags the task had, or None if the user has no such task.
+    """
+    deleted, tags = delete_tasks(user, [todo_id])
+    if not deleted:
+        return None
+    return tags
+
+
+def delete_tasks(user, todo_ids, archive=False, chunk_size=500):
+    """Delete a batch of a user's tasks, within a transaction. Ids of
+    tasks that are not the user's are ignored. The tasks and their tag
+    associations are removed with set based deletes that only match the
+    user's tasks, sent in chunks to stay under SQLite's bound parameter
+    limit. With `archive`, the tasks are copied to the archive first, as
+    part of the same transaction. Returns the sorted ids of the deleted
+    tasks, and the tags they had with a tag listed once for each task.
+    """
+    ids = sorted(set(todo_ids))
+    deleted = []
+    tags = []
+    todo_table = TodoItem.__table__
+    mine = todo_table.c.user == user.email
+    now = datetime.utcnow()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        # Find which of the ids are the user's, along with their tags
+        qry = DBSession.query(
+            todo_table.c.id,
+            todo_table.c.task,
+            todo_table.c.due_date,
+            todoitemtag_table.c.tag_id,
+        )
+        qry = qry.outerjoin(
+            todoitemtag_table,
+            todoitemtag_table.c.todo_id == todo_table.c.id,
+        )
+        qry = qry.filter(mine, todo_table.c.id.in_(chunk))
+        owned = {}
+        for todo_id, task, due_date, tag_name in qry:
+            task_tags = owned.setdefault(todo_id, (task, due_date, []))[2]
+            if tag_name is not None:
+                task_tags.append(tag_name)
+                tags.append(tag_name)
+        if not owned:
+            continue
+        if archive:
+            DBSession.execute(ArchivedTask.__table__.insert(), [
+                dict(
+                    todo_id=todo_id,
+                    user=user.email,
+                    task=task,
+                    tags=u','.join(sorted(task_tags)),
+                    due_date=due_date,
+                    completed=now,
+                )
+                for todo_id, (task, due_date, task_tags)
+                in sorted(owned.items())
+            ])
+        owned = sorted(owned)
+        DBSession.execute(todoitemtag_table.delete().where(
+            todoitemtag_table.c.todo_id.in_(owned)))
+        DBSession.execute(todo_table.delete().where(
+            and_(mine, todo_table.c.id.in_(owned))))
+        deleted.extend(owned)
+    if not deleted:
+        return deleted, tags
+    mark_changed(DBSession())
+    scheduler = reminder_scheduler()
+    if scheduler is not None:
+        after_commit(scheduler.tasks_deleted, list(deleted))
+    DBSession.add(user)
+    user.update_counts(tasks=-len(deleted), removed_tags=tags)
+    user.touch()
+    return deleted, sorted(tags)
+
+
+def complete_tasks(user, todo_ids):
+    """Complete a batch of a user's tasks by moving them to the archive.
+    Returns the same as `delete_tasks`.
+    """
+    return delete_tasks(user, todo_ids, archive=True)
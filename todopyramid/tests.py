@@ -1,3 +1,4 @@
+import os
 import unittest
 import transaction
 
@@ -23,3 +24,1689 @@ class TestTodoItem(unittest.TestCase):
         self.assertEqual(model.user, 'bob')
         self.assertEqual(model.task, 'time for a beverage')
 
+
+class TestLoadSortedTags(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy import event
+        from .instrumentation import count_query
+        from .models import Base
+        from .models import DBSession
+        self.request = testing.DummyRequest()
+        self.config = testing.setUp(request=self.request)
+        self.engine = create_engine('sqlite://')
+        event.listen(self.engine, 'before_cursor_execute', count_query)
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _add_tasks(self, count):
+        from .models import DBSession
+        from .models import TodoItem
+        with transaction.manager:
+            for i in range(count):
+                DBSession.add(TodoItem(
+                    user=u'bob',
+                    task=u'task %s' % i,
+                    tags=[u'zebra', u' Apple', u'mango'],
+                ))
+        return [item.id for item in DBSession.query(TodoItem)]
+
+    def test_tags_sorted_per_task(self):
+        from .models import load_sorted_tags
+        ids = self._add_tasks(2)
+        tag_map = load_sorted_tags(ids + [999])
+        self.assertEqual(tag_map[ids[0]], [u'apple', u'mango', u'zebra'])
+        self.assertEqual(tag_map[ids[1]], [u'apple', u'mango', u'zebra'])
+        self.assertEqual(tag_map[999], [])
+
+    def test_query_count_is_fixed(self):
+        from .models import load_sorted_tags
+        ids = self._add_tasks(40)
+        self.request.query_count = 0
+        load_sorted_tags(ids[:4])
+        few = self.request.query_count
+        self.request.query_count = 0
+        load_sorted_tags(ids)
+        self.assertEqual(self.request.query_count, few)
+        self.assertEqual(few, 1)
+
+
+class TestPaginate(unittest.TestCase):
+    database_url = 'sqlite://'
+
+    def setUp(self):
+        from datetime import datetime
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoItem
+        self.config = testing.setUp()
+        self.engine = engine = create_engine(self.database_url)
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        names = [u'apple', u'Banana', u'cherry', u'apple', u'Date']
+        with transaction.manager:
+            for i in range(23):
+                due_date = None
+                if i % 3:
+                    due_date = datetime(2013, 1, 1 + i % 5)
+                DBSession.add(TodoItem(
+                    user=u'bob',
+                    task=names[i % len(names)],
+                    due_date=due_date,
+                ))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _expected(self, order_col, order_dir):
+        from .models import DBSession
+        from .models import TodoItem
+        items = DBSession.query(TodoItem).all()
+        reverse = order_dir == 'desc'
+        if order_col == 'task':
+            items.sort(key=lambda x: (x.task.lower(), x.id), reverse=reverse)
+        else:
+            dated = [x for x in items if x.due_date is not None]
+            undated = [x for x in items if x.due_date is None]
+            dated.sort(key=lambda x: (x.due_date, x.id), reverse=reverse)
+            undated.sort(key=lambda x: x.id, reverse=reverse)
+            items = dated + undated
+        return [item.id for item in items]
+
+    def _walk(self, order_col, order_dir, dialect=None):
+        from .models import DBSession
+        from .models import TodoItem
+        from .paging import paginate
+        query = DBSession.query(TodoItem)
+        pages = [paginate(query, order_col, order_dir, 5, dialect=dialect)]
+        while pages[-1].has_next:
+            pages.append(paginate(query, order_col, order_dir, 5,
+                                  after=pages[-1].next_cursor,
+                                  dialect=dialect))
+        return pages
+
+    def _dialects(self):
+        """The sort styles of the other backends, all of which SQLite can
+        run: an old SQLite without NULLS LAST, and PostgreSQL sorting by
+        lower() with NULLS LAST.
+        """
+        from sqlalchemy.dialects import postgresql
+
+        class OldSQLite(object):
+            name = 'sqlite'
+
+            class dbapi(object):
+                sqlite_version_info = (3, 7, 17)
+
+        return [None, OldSQLite(), postgresql.dialect()]
+
+    def test_pages_follow_sort_order(self):
+        for dialect in self._dialects():
+            for order_col in ('due_date', 'task'):
+                for order_dir in ('asc', 'desc'):
+                    pages = self._walk(order_col, order_dir, dialect)
+                    ids = [item.id for page in pages for item in page.items]
+                    self.assertEqual(
+                        ids, self._expected(order_col, order_dir))
+                    self.assertEqual(len(pages), 5)
+                    self.assertFalse(pages[0].has_prev)
+                    self.assertTrue(pages[-1].has_prev)
+
+    def test_sort_style(self):
+        from sqlalchemy.dialects import postgresql
+        from .models import DBSession
+        from .models import TodoItem
+        from .paging import order_clauses
+        from .paging import sort_keys
+        from .paging import sort_params
+        from .paging import sort_style
+        dialect = postgresql.dialect()
+        case_style, native_nulls = sort_style(dialect)
+        self.assertEqual((case_style, native_nulls), ('lower', True))
+        query = DBSession.query(TodoItem.id)
+        for order_col in ('due_date', 'task'):
+            keys = sort_keys(order_col, case_style)
+            sql = str(query.order_by(*order_clauses(
+                keys, True, native_nulls=native_nulls)).statement.compile(
+                    dialect=dialect))
+            self.assertTrue('CASE' not in sql)
+            self.assertTrue('NOCASE' not in sql)
+            if order_col == 'due_date':
+                self.assertTrue('due_date DESC NULLS LAST' in sql)
+        self.assertTrue('lower(todoitems.task) DESC' in sql)
+        self.assertRaises(ValueError, sort_keys, 'user')
+        self.assertEqual(sort_params('user', 'sideways'), ('due_date', 'asc'))
+        self.assertEqual(sort_params('task', 'desc'), ('task', 'desc'))
+
+    def test_previous_pages(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .paging import paginate
+        query = DBSession.query(TodoItem)
+        for dialect in self._dialects():
+            for order_col in ('due_date', 'task'):
+                for order_dir in ('asc', 'desc'):
+                    pages = self._walk(order_col, order_dir, dialect)
+                    for i in range(len(pages) - 1, 0, -1):
+                        prev = paginate(query, order_col, order_dir, 5,
+                                        before=pages[i].prev_cursor,
+                                        dialect=dialect)
+                        self.assertEqual(
+                            [item.id for item in prev.items],
+                            [item.id for item in pages[i - 1].items],
+                        )
+                        self.assertEqual(prev.has_prev, i > 1)
+                        self.assertTrue(prev.has_next)
+
+    def test_bad_cursor_shows_first_page(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .paging import paginate
+        query = DBSession.query(TodoItem)
+        page = paginate(query, 'task', 'asc', 5, after='not-a-cursor')
+        self.assertFalse(page.has_prev)
+        self.assertEqual(
+            [item.id for item in page.items],
+            self._expected('task', 'asc')[:5],
+        )
+
+    def test_cursor_value_types(self):
+        import json
+        from base64 import urlsafe_b64encode
+        from .models import DBSession
+        from .models import TodoItem
+        from .paging import paginate
+        query = DBSession.query(TodoItem)
+        for order_col, values in [
+            ('task', [[1], 1]),
+            ('task', [{'a': 1}, 1]),
+            ('task', [None, 1]),
+            ('task', [u'apple', u'1']),
+            ('task', [u'apple', 2 ** 64]),
+            ('due_date', [[1], 1]),
+            ('due_date', [5, 1]),
+        ]:
+            token = urlsafe_b64encode(json.dumps(values).encode('utf-8'))
+            page = paginate(query, order_col, 'asc', 5,
+                            after=token.decode('ascii'))
+            self.assertFalse(page.has_prev)
+            self.assertEqual([item.id for item in page.items],
+                             self._expected(order_col, 'asc')[:5])
+
+
+@unittest.skipUnless(os.environ.get('TODOPYRAMID_TEST_POSTGRESQL'),
+                     'TODOPYRAMID_TEST_POSTGRESQL is not set to a test '
+                     'database url')
+class TestPaginatePostgreSQL(TestPaginate):
+    """Runs the paging tests against a real PostgreSQL database, which
+    is emptied after each test.
+    """
+    database_url = os.environ.get('TODOPYRAMID_TEST_POSTGRESQL')
+
+    def tearDown(self):
+        from .models import Base
+        TestPaginate.tearDown(self)
+        Base.metadata.drop_all(self.engine)
+
+    def _dialects(self):
+        return [None]
+
+
+class TestCounters(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .scripts.initializedb import create_dummy_content
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            create_dummy_content(u'bob')
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _user(self):
+        from .models import DBSession
+        from .models import TodoUser
+        return DBSession.query(TodoUser).filter(TodoUser.email == u'bob').one()
+
+    def test_dummy_content_counted(self):
+        from .scripts.counters import check_counts
+        user = self._user()
+        self.assertEqual(user.task_count, 7)
+        self.assertEqual(user.tag_count(u'quest'), 7)
+        self.assertEqual(user.tag_count(u'rabbit'), 2)
+        self.assertEqual(user.tag_count(u'missing'), 0)
+        self.assertEqual(check_counts(user), [])
+
+    def test_update_counts(self):
+        with transaction.manager:
+            user = self._user()
+            user.update_counts(
+                tasks=-1,
+                added_tags=[u'grail', u'quest'],
+                removed_tags=[u'ni', u'quest'],
+            )
+        user = self._user()
+        self.assertEqual(user.task_count, 6)
+        self.assertEqual(user.tag_count(u'grail'), 1)
+        self.assertEqual(user.tag_count(u'quest'), 7)
+        tags = [row.tag_id for row in user.user_tags]
+        self.assertEqual(
+            tags, [u'discuss', u'grail', u'knight', u'quest', u'rabbit'])
+
+    def test_recount_fixes_counters(self):
+        from .scripts.counters import check_counts
+        with transaction.manager:
+            self._user().update_counts(tasks=3, added_tags=[u'grail'])
+        user = self._user()
+        self.assertEqual(
+            check_counts(user), [('tasks', 10, 7), (u'grail', 1, 0)])
+        with transaction.manager:
+            self._user().recount()
+        self.assertEqual(check_counts(self._user()), [])
+
+    def test_delete_tasks(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        from .models import todoitemtag_table
+        from .scripts.counters import check_counts
+        from .tasks import delete_tasks
+        with transaction.manager:
+            DBSession.add(TodoUser(u'alice'))
+            DBSession.add(TodoItem(u'alice', u'Not yours', [u'quest']))
+        ids = [item.id for item in self._user().todo_list]
+        other = DBSession.query(TodoItem).filter(
+            TodoItem.user == u'alice').one().id
+        with transaction.manager:
+            deleted, tags = delete_tasks(
+                self._user(), ids[:3] + [other, 12345], chunk_size=2)
+        self.assertEqual(deleted, sorted(ids[:3]))
+        self.assertTrue(u'quest' in tags)
+        user = self._user()
+        self.assertEqual(user.task_count, 4)
+        self.assertEqual(check_counts(user), [])
+        self.assertEqual(DBSession.query(TodoItem).get(other).task,
+                         u'Not yours')
+        orphans = DBSession.query(todoitemtag_table).filter(
+            todoitemtag_table.c.todo_id.in_(ids[:3]))
+        self.assertEqual(orphans.count(), 0)
+
+    def test_touch_bumps_revision(self):
+        revision = self._user().revision
+        with transaction.manager:
+            self._user().touch()
+        with transaction.manager:
+            self._user().touch()
+        user = self._user()
+        self.assertEqual(user.revision, revision + 2)
+        self.assertTrue(user.modified is not None)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        from .cache import LRUCache
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_memory_budget(self):
+        from .cache import LRUCache
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.set('c', 'xxxx')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+        cache.set('d', 'x' * 11)
+        self.assertFalse('d' in cache)
+        cache.invalidate('c')
+        self.assertEqual(cache.size, 4)
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .scripts.initializedb import create_dummy_content
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            create_dummy_content(u'bob')
+            DBSession.add(TodoUser(u'tim'))
+            DBSession.flush()
+            tim = DBSession.query(TodoUser).get(u'tim')
+            tim.update_counts(added_tags=[u'quiz', u'dragon'])
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_scoped_and_ranked(self):
+        from .tagindex import TagIndex
+        tag_index = TagIndex()
+        self.assertEqual(tag_index.complete(u'bob', u'q'), [u'quest'])
+        self.assertEqual(tag_index.complete(u'tim', u'Q'), [u'quiz'])
+        self.assertEqual(
+            tag_index.complete(u'bob', u''),
+            [u'quest', u'discuss', u'knight', u'rabbit', u'ni'],
+        )
+        self.assertEqual(
+            tag_index.complete(u'bob', u'', limit=2), [u'quest', u'discuss'])
+
+    def test_cached_until_invalidated(self):
+        from .models import DBSession
+        from .models import TodoUser
+        from .tagindex import TagIndex
+        tag_index = TagIndex()
+        tag_index.complete(u'tim', u'dr')
+        with transaction.manager:
+            tim = DBSession.query(TodoUser).get(u'tim')
+            tim.update_counts(added_tags=[u'drawbridge'] * 2)
+        self.assertEqual(tag_index.complete(u'tim', u'dr'), [u'dragon'])
+        tag_index.invalidate(u'tim')
+        self.assertEqual(
+            tag_index.complete(u'tim', u'dr'), [u'drawbridge', u'dragon'])
+
+    def test_load_racing_invalidate(self):
+        from .tagindex import TagIndex
+
+        class RacingTagIndex(TagIndex):
+            racing = True
+
+            def load(self, user_id):
+                index = TagIndex.load(self, user_id)
+                if self.racing:
+                    # A write commits and invalidates while the load runs
+                    self.invalidate(user_id)
+                return index
+
+        tag_index = RacingTagIndex()
+        self.assertEqual(tag_index.complete(u'tim', u'dr'), [u'dragon'])
+        self.assertFalse(u'tim' in tag_index.cache)
+        tag_index.racing = False
+        tag_index.complete(u'tim', u'dr')
+        self.assertTrue(u'tim' in tag_index.cache)
+        tag_index.invalidate(u'bob')
+        self.assertEqual(tag_index.loading, {})
+
+
+class TestTagWrites(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoItem
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoItem(
+                user=u'bob', task=u'go do stuff', tags=[u'a', u'B', u'b']))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _task(self):
+        from .models import DBSession
+        from .models import TodoItem
+        return DBSession.query(TodoItem).one()
+
+    def test_apply_tags(self):
+        from .models import load_sorted_tags
+        task = self._task()
+        self.assertEqual(load_sorted_tags([task.id])[task.id], [u'a', u'b'])
+
+    def test_set_tags_writes_the_difference(self):
+        from .models import DBSession
+        from .models import Tag
+        from .models import load_sorted_tags
+        with transaction.manager:
+            added, removed = self._task().set_tags([u'b', u'c', u' C'])
+        self.assertEqual((added, removed), ([u'c'], [u'a']))
+        task = self._task()
+        self.assertEqual(load_sorted_tags([task.id])[task.id], [u'b', u'c'])
+        names = [tag.name for tag in DBSession.query(Tag).order_by(Tag.name)]
+        self.assertEqual(names, [u'a', u'b', u'c'])
+
+    def test_set_tags_unchanged(self):
+        with transaction.manager:
+            result = self._task().set_tags([u'b', u'a'])
+        self.assertEqual(result, ([], []))
+
+
+class TestImportTasks(unittest.TestCase):
+    database_url = 'sqlite://'
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        self.config = testing.setUp()
+        self.engine = engine = create_engine(self.database_url)
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob', time_zone=u'UTC'))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_ids_from_database(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        from .tasks import save_task
+        data = '\n'.join('{"name": "task %s", "tags": "a"}' % i
+                         for i in range(5))
+        self._import(data, 'jsonl')
+        with transaction.manager:
+            user = DBSession.query(TodoUser).one()
+            task = save_task(user, u'after', [u'a'], None)[0]
+            DBSession.flush()
+            todo_id = task.id
+        ids = [row.id for row in DBSession.query(TodoItem.id)]
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(max(ids), todo_id)
+
+    def _import(self, data, format, batch_size=2):
+        import io
+        from .importer import import_tasks
+        from .importer import read_records
+        stream = io.BytesIO(data.encode('utf-8'))
+        return import_tasks(
+            u'bob', read_records(stream, format), batch_size=batch_size)
+
+    def test_jsonl(self):
+        from datetime import datetime
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        from .models import load_sorted_tags
+        from .scripts.counters import check_counts
+        data = '\n'.join([
+            '{"name": "one", "tags": ["A", "b"]}',
+            '{"name": "two", "tags": "b,c", '
+            '"due_date": "2013-01-02T03:04:05"}',
+            'not json',
+            '{"tags": "a"}',
+            '',
+            '{"task": "three"}',
+        ])
+        report = self._import(data, 'jsonl')
+        self.assertEqual(report.imported, 3)
+        self.assertEqual(report.error_count, 2)
+        self.assertEqual([line for line, error in report.errors], [3, 4])
+        items = DBSession.query(TodoItem).order_by(TodoItem.id).all()
+        self.assertEqual(
+            [item.task for item in items], [u'one', u'two', u'three'])
+        self.assertEqual(items[1].due_date, datetime(2013, 1, 2, 3, 4, 5))
+        tag_map = load_sorted_tags([item.id for item in items])
+        self.assertEqual(tag_map[items[0].id], [u'a', u'b'])
+        self.assertEqual(tag_map[items[1].id], [u'b', u'c'])
+        user = DBSession.query(TodoUser).one()
+        self.assertEqual(user.task_count, 3)
+        self.assertEqual(check_counts(user), [])
+
+    def test_csv(self):
+        from .models import DBSession
+        from .models import TodoItem
+        data = u'name,tags,due_date\r\nfirst,"x,y",\r\nsecond,,bogus\r\n'
+        report = self._import(data, 'csv')
+        self.assertEqual(report.imported, 1)
+        self.assertEqual(report.errors[0][0], 3)
+        self.assertEqual(DBSession.query(TodoItem).one().task, u'first')
+
+
+@unittest.skipUnless(os.environ.get('TODOPYRAMID_TEST_POSTGRESQL'),
+                     'TODOPYRAMID_TEST_POSTGRESQL is not set to a test '
+                     'database url')
+class TestImportTasksPostgreSQL(TestImportTasks):
+    """Runs the import tests against PostgreSQL, where the ids come
+    back from one INSERT ... RETURNING for each batch.
+    """
+    database_url = os.environ.get('TODOPYRAMID_TEST_POSTGRESQL')
+
+    def tearDown(self):
+        from .models import Base
+        TestImportTasks.tearDown(self)
+        Base.metadata.drop_all(self.engine)
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        from datetime import datetime
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoItem
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoItem(
+                user=u'bob',
+                task=u'Find a shrubbery; a nice one, not too expensive',
+                tags=[u'quest', u'ni'],
+                due_date=datetime(2013, 1, 2, 15, 0),
+            ))
+            DBSession.add(TodoItem(user=u'bob', task=u'Cross the bridge'))
+            DBSession.add(TodoItem(user=u'tim', task=u'Guard the cave'))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _export(self, exporter_class):
+        from .exporter import export_app_iter
+        exporter = exporter_class(u'US/Eastern')
+        chunks = export_app_iter(u'bob', exporter, chunk_size=1)
+        return b''.join(chunks).decode('utf-8')
+
+    def test_jsonl(self):
+        import json
+        from .exporter import JSONLExporter
+        lines = self._export(JSONLExporter).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            dict(
+                id=1,
+                name=u'Find a shrubbery; a nice one, not too expensive',
+                tags=[u'ni', u'quest'],
+                due_date=u'2013-01-02T10:00:00-05:00',
+            ),
+            dict(id=2, name=u'Cross the bridge', tags=[], due_date=None),
+        ])
+
+    def test_csv(self):
+        from .exporter import CSVExporter
+        self.assertEqual(self._export(CSVExporter).splitlines(), [
+            u'id,name,tags,due_date',
+            u'1,"Find a shrubbery; a nice one, not too expensive",'
+            u'"ni,quest",2013-01-02T10:00:00-05:00',
+            u'2,Cross the bridge,,',
+        ])
+
+    def test_icalendar(self):
+        from .exporter import ICalendarExporter
+        lines = self._export(ICalendarExporter).split(u'\r\n')
+        self.assertEqual(lines[0], u'BEGIN:VCALENDAR')
+        self.assertEqual(lines[-2:], [u'END:VCALENDAR', u''])
+        self.assertEqual(lines.count(u'BEGIN:VTODO'), 2)
+        self.assertTrue(u'SUMMARY:Find a shrubbery\\; a nice one\\, '
+                        u'not too expensive' in lines)
+        self.assertTrue(u'CATEGORIES:ni,quest' in lines)
+        self.assertTrue(u'DUE:20130102T150000Z' in lines)
+
+
+class TestTimezoneConverter(unittest.TestCase):
+    def test_format_and_past_due(self):
+        from datetime import datetime
+        from .utils import TimezoneConverter
+        now = datetime(2013, 1, 2, 12, 0)
+        converter = TimezoneConverter('US/Eastern', now=now)
+        due_date = datetime(2013, 1, 2, 15, 30)
+        self.assertEqual(converter.format(due_date), '2013-01-02 10:30:00')
+        self.assertEqual(converter.format(due_date), '2013-01-02 10:30:00')
+        self.assertEqual(converter.formatted.hits, 1)
+        self.assertFalse(converter.past_due(due_date))
+        self.assertTrue(converter.past_due(datetime(2013, 1, 2, 11, 59)))
+        self.assertFalse(converter.past_due(None))
+        self.assertEqual(
+            converter.format_all([due_date, None, due_date]),
+            {due_date: '2013-01-02 10:30:00'},
+        )
+
+    def test_universify_round_trip(self):
+        from datetime import datetime
+        from .utils import TimezoneConverter
+        converter = TimezoneConverter('Europe/Paris')
+        due_date = datetime(2013, 7, 1, 8, 0)
+        local = converter.localize(due_date)
+        self.assertEqual(local.hour, 10)
+        self.assertEqual(converter.universify(local), due_date)
+
+
+class TestFragmentCache(unittest.TestCase):
+    def _check_backend(self, cache):
+        key = ('row', 1, None, 'US/Eastern', False, None)
+        self.assertEqual(cache.get_many([key]), {})
+        cache.set_many({key: u'<td>Find a shrubbery</td>'})
+        self.assertEqual(cache.get(key), u'<td>Find a shrubbery</td>')
+        self.assertEqual(cache.get(key[:-1] + (u'ni',)), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_memory(self):
+        from .fragments import MemoryFragmentCache
+        self._check_backend(MemoryFragmentCache(max_bytes=1024 * 1024))
+
+    def test_file(self):
+        import shutil
+        import tempfile
+        from .fragments import FileFragmentCache
+        directory = tempfile.mkdtemp()
+        try:
+            self._check_backend(FileFragmentCache(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_from_settings(self):
+        from .fragments import MemoryFragmentCache
+        from .fragments import fragment_cache_from_settings
+        cache = fragment_cache_from_settings({})
+        self.assertTrue(isinstance(cache, MemoryFragmentCache))
+        settings = {'todopyramid.fragment_cache': 'none'}
+        self.assertEqual(fragment_cache_from_settings(settings), None)
+        self.assertRaises(ValueError, fragment_cache_from_settings,
+                          {'todopyramid.fragment_cache': 'shrubbery'})
+
+
+class TestTodoGrid(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _items(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from .models import TodoItem
+        now = datetime.utcnow()
+        due_dates = [now - timedelta(days=2), None, now + timedelta(days=3),
+                     None]
+        items = []
+        tag_map = {}
+        for i, due_date in enumerate(due_dates):
+            item = TodoItem(u'bob', u'Say <"Ni"> & run %s' % i,
+                            due_date=due_date)
+            item.id = i + 1
+            item.modified = now
+            items.append(item)
+            tag_map[item.id] = [u'a&b', u'quest', u'x<y>'][:i]
+        return items, tag_map
+
+    def _render(self, grid_class, selected_tag, **kw):
+        from pyramid.request import Request
+        items, tag_map = self._items()
+        request = Request.blank('/list?order_col=task&order_dir=desc')
+        grid = grid_class(
+            request, selected_tag, u'US/Eastern', items,
+            ['task', 'tags', 'due_date', ''],
+            url=lambda _query=None: '/list', tag_map=tag_map, **kw)
+        return grid.__html__()
+
+    def test_compiled_grid_matches(self):
+        try:
+            from .grid import CompiledTodoGrid
+            from .grid import TodoGrid
+        except ImportError:
+            raise unittest.SkipTest('webhelpers is not importable')
+        from .fragments import MemoryFragmentCache
+        for selected_tag in [None, u'quest', [u'a&b', u'x<y>']]:
+            html = self._render(TodoGrid, selected_tag)
+            self.assertEqual(
+                self._render(CompiledTodoGrid, selected_tag), html)
+            cache = MemoryFragmentCache()
+            for i in range(2):
+                self.assertEqual(self._render(
+                    CompiledTodoGrid, selected_tag, fragment_cache=cache),
+                    html)
+        self.assertTrue('badge-important' in html)
+        self.assertTrue('&lt;&#34;Ni&#34;&gt; &amp; run' in html)
+        self.assertTrue('label label-warning' in html)
+        self.assertFalse('<"Ni">' in html)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .scripts.initializedb import create_dummy_content
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            create_dummy_content(u'bob')
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _user(self):
+        from .models import DBSession
+        from .models import TodoUser
+        return DBSession.query(TodoUser).get(u'bob')
+
+    def _complete(self, count):
+        from .tasks import complete_tasks
+        ids = sorted(item.id for item in self._user().todo_list)[:count]
+        with transaction.manager:
+            completed, tags = complete_tasks(self._user(), ids)
+        return completed
+
+    def test_complete_moves_tasks(self):
+        from .models import ArchivedTask
+        from .models import DBSession
+        from .scripts.counters import check_counts
+        completed = self._complete(2)
+        self.assertEqual(len(completed), 2)
+        user = self._user()
+        self.assertEqual(user.task_count, 5)
+        self.assertEqual(check_counts(user), [])
+        archived = DBSession.query(ArchivedTask).order_by(ArchivedTask.id)
+        self.assertEqual([a.todo_id for a in archived], completed)
+        self.assertTrue(u'quest' in archived[0].tag_list)
+
+    def test_paging(self):
+        from .archive import archive_page
+        completed = self._complete(5)
+        page = archive_page(u'bob', 2)
+        self.assertEqual(len(page.items), 2)
+        self.assertEqual(page.prev_id, None)
+        seen = [item.todo_id for item in page.items]
+        while page.next_id is not None:
+            page = archive_page(u'bob', 2, after=page.next_id)
+            seen.extend(item.todo_id for item in page.items)
+        self.assertEqual(seen, list(reversed(completed)))
+        back = archive_page(u'bob', 2, before=page.prev_id)
+        self.assertEqual([item.todo_id for item in back.items],
+                         list(reversed(completed))[2:4])
+        self.assertEqual(archive_page(u'alice', 2).items, [])
+
+    def test_purge(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from .archive import purge_archive
+        from .models import ArchivedTask
+        from .models import DBSession
+        self._complete(5)
+        with transaction.manager:
+            old = DBSession.query(ArchivedTask).order_by(ArchivedTask.id)
+            for item in old.limit(3):
+                item.completed -= timedelta(days=400)
+        cutoff = datetime.utcnow() - timedelta(days=365)
+        self.assertEqual(purge_archive(self.engine, cutoff, chunk_size=2), 3)
+        self.assertEqual(DBSession.query(ArchivedTask).count(), 2)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .scripts.initializedb import create_dummy_content
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            DBSession.add(TodoUser(u'alice'))
+            create_dummy_content(u'bob')
+            create_dummy_content(u'alice')
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _search(self, search_text, full_text=True, **kw):
+        from .search import search_tasks
+        page = search_tasks(u'bob', search_text, 100, full_text=full_text,
+                            **kw)
+        return [item.task for item in page.items]
+
+    def test_search_terms(self):
+        from .search import match_query
+        from .search import search_terms
+        terms = search_terms(u'Holy "Grail" OR NEAR(')
+        self.assertEqual(terms, [u'holy', u'grail', u'or', u'near'])
+        self.assertEqual(match_query(terms[:2], u'bob'),
+                         u'user : "626F62" AND {task tags} : '
+                         u'("holy" "grail"*)')
+
+    def test_ranked_and_fallback(self):
+        tasks = self._search(u'knight')
+        # A match in the name ranks above a match in the tags only
+        self.assertEqual(tasks, [
+            u'Recruit Knights of the Round Table', u'Find a shrubbery'])
+        self.assertEqual(sorted(self._search(u'knight', full_text=False)),
+                         sorted(tasks))
+        self.assertEqual(self._search(u'grail hol'),
+                         [u'Search for the holy grail'])
+        self.assertEqual(self._search(u'grail hol', full_text=False),
+                         [u'Search for the holy grail'])
+        self.assertEqual(self._search(u'"'), [])
+
+    def test_paging(self):
+        from .search import search_tasks
+        for full_text in (True, False):
+            pages = [search_tasks(u'bob', u'quest', 3, full_text=full_text)]
+            while pages[-1].has_next:
+                pages.append(search_tasks(
+                    u'bob', u'quest', 3, after=pages[-1].next_cursor,
+                    full_text=full_text))
+            self.assertEqual([len(page.items) for page in pages], [3, 3, 1])
+            self.assertEqual(pages[0].total, 7)
+            self.assertEqual(pages[0].prev_cursor, None)
+            ids = [item.id for page in pages for item in page.items]
+            self.assertEqual(len(set(ids)), 7)
+            back = search_tasks(u'bob', u'quest', 3,
+                                before=pages[2].prev_cursor,
+                                full_text=full_text)
+            self.assertEqual([item.id for item in back.items], ids[3:6])
+            first = search_tasks(u'bob', u'quest', 3,
+                                 before=back.prev_cursor, full_text=full_text)
+            self.assertEqual([item.id for item in first.items], ids[:3])
+            self.assertFalse(first.has_prev)
+            self.assertEqual(first.next_cursor, pages[0].next_cursor)
+        page = search_tasks(u'bob', u'quest', 3, after=u'ni')
+        self.assertEqual(page.prev_cursor, None)
+
+    def test_scoped_to_user(self):
+        from .models import DBSession
+        from .models import TodoItem
+        with transaction.manager:
+            DBSession.add(TodoItem(u'alice', u'Find the holy hand grenade'))
+        self.assertEqual(self._search(u'grenade'), [])
+        self.assertEqual(self._search(u'grenade', full_text=False), [])
+
+    def test_index_follows_changes(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        from .search import rebuild_search_index
+        from .tasks import delete_tasks
+        with transaction.manager:
+            item = DBSession.query(TodoItem).filter(
+                TodoItem.user == u'bob',
+                TodoItem.task == u'Find a shrubbery',
+            ).one()
+            item.task = u'Find another shrubbery'
+            item.set_tags([u'ni'])
+        self.assertEqual(self._search(u'another'),
+                         [u'Find another shrubbery'])
+        self.assertEqual(self._search(u'knight'),
+                         [u'Recruit Knights of the Round Table'])
+        renamed = DBSession.query(TodoItem).filter(
+            TodoItem.task == u'Find another shrubbery').one().id
+        with transaction.manager:
+            user = DBSession.query(TodoUser).get(u'bob')
+            delete_tasks(user, [renamed])
+        self.assertEqual(self._search(u'another'), [])
+        with self.engine.begin() as connection:
+            rebuild_search_index(connection)
+        self.assertEqual(len(self._search(u'quest')), 6)
+        self.assertEqual(self._search(u'knight'),
+                         [u'Recruit Knights of the Round Table'])
+
+
+class TestFormCache(unittest.TestCase):
+    def test_render_on_miss_only(self):
+        from .formcache import FormCache
+        rendered = []
+
+        def render(html):
+            def render():
+                rendered.append(html)
+                return html, ['deform:static/form.css'], []
+            return render
+
+        cache = FormCache(max_entries=2)
+        form = cache.get(u'UTC', None, render(u'<form/>'))
+        self.assertEqual(form.html, u'<form/>')
+        self.assertEqual(form.css, ['deform:static/form.css'])
+        cache.get(u'UTC', None, render(u'<form/>'))
+        cache.get(u'UTC', u'quest', render(u'<form>quest</form>'))
+        cache.get(u'US/Eastern', None, render(u'<form>est</form>'))
+        self.assertEqual(len(rendered), 3)
+        # The least recently used form was evicted
+        cache.get(u'UTC', None, render(u'<form/>'))
+        self.assertEqual(len(rendered), 4)
+
+
+class TestAssets(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.config = testing.setUp()
+        self.config.add_route('bundle', '/bundles/{filename}')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        testing.tearDown()
+
+    def test_build_and_serve(self):
+        import gzip
+        import io
+        from pyramid.request import Request
+        from .assets import Assets
+        from .assets import build_bundles
+        from .assets import bundle_view
+        bundles = {
+            'app.css': [
+                'todopyramid:static/bootglyph/css/icon.css',
+                'todopyramid:static/main.css',
+            ],
+            'app.js': ['todopyramid:static/todo_list.js'],
+        }
+        manifest = build_bundles(self.directory, bundles)
+        self.assertEqual(sorted(manifest), ['app.css', 'app.js'])
+        self.assertEqual(build_bundles(self.directory, bundles), manifest)
+        with open(os.path.join(self.directory, manifest['app.css'])) as f:
+            css = f.read()
+        self.assertTrue(
+            'url("../static/bootglyph/img/glyphicons-halflings.png")' in css)
+        self.assertFalse('/*' in css)
+        assets = Assets(bundles, self.directory, manifest)
+        self.config.registry.assets = assets
+        request = testing.DummyRequest()
+        self.assertEqual(
+            assets.urls(request, 'app.css'),
+            ['http://example.com/bundles/%s' % manifest['app.css']])
+        self.assertEqual(
+            assets.unbundled(['todopyramid:static/main.css', 'extra.css'],
+                             ['app.css']),
+            ['extra.css'])
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+        request.registry = self.config.registry
+        request.matchdict = {'filename': manifest['app.js']}
+        response = bundle_view(request)
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertTrue('immutable' in response.headers['Cache-Control'])
+        body = b''.join(response.app_iter)
+        response.app_iter.close()
+        path = os.path.join(self.directory, manifest['app.js'])
+        with open(path, 'rb') as f:
+            self.assertEqual(
+                gzip.GzipFile(fileobj=io.BytesIO(body)).read(), f.read())
+
+    def test_minify_utf8_css(self):
+        from .assets import minify_css
+        css = u'a:after {\n  content: "\xe0 \u2026 \u0145";\n}\n'
+        minified = minify_css(css.encode('utf-8').decode('latin-1'))
+        self.assertEqual(minified.encode('latin-1').decode('utf-8'),
+                         u'a:after{content: "\xe0 \u2026 \u0145";}')
+
+    def test_earlier_builds(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from pyramid.request import Request
+        from .assets import Assets
+        from .assets import build_bundles
+        from .assets import bundle_view
+        bundles = {'app.css': ['todopyramid:static/main.css']}
+        old = build_bundles(self.directory, bundles)
+        bundles['app.css'].append('todopyramid:static/bootglyph/css/icon.css')
+        new = build_bundles(self.directory, bundles)
+        self.assertNotEqual(old, new)
+        self.assertNotEqual(Assets(bundles, self.directory, old).version,
+                            Assets(bundles, self.directory, new).version)
+        self.config.registry.assets = Assets(bundles, self.directory, new)
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        request.matchdict = {'filename': old['app.css']}
+        response = bundle_view(request)
+        self.assertEqual(response.content_type, 'text/css')
+        response.app_iter.close()
+        for filename in ['manifest.json', 'app.000000000000.css',
+                         '..%s' % old['app.css']]:
+            request = testing.DummyRequest(matchdict={'filename': filename})
+            self.assertRaises(HTTPNotFound, bundle_view, request)
+
+    def test_unbuilt_bundles(self):
+        from .assets import Assets
+        from .assets import bundle_view
+        from pyramid.httpexceptions import HTTPNotFound
+        self.config.add_static_view('static', 'todopyramid:static')
+        assets = Assets({'app.css': ['todopyramid:static/main.css']})
+        self.config.registry.assets = assets
+        request = testing.DummyRequest()
+        self.assertEqual(assets.urls(request, 'app.css'),
+                         ['http://example.com/static/main.css'])
+        self.assertEqual(
+            assets.unbundled(['todopyramid:static/main.css'], ['app.css']),
+            ['todopyramid:static/main.css'])
+        request = testing.DummyRequest(matchdict={'filename': 'app.css'})
+        self.assertRaises(HTTPNotFound, bundle_view, request)
+
+
+class TestProfileCache(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob', u'Brave Sir', u'Robin'))
+        self.now = 1000
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _rename(self, first_name):
+        from .models import DBSession
+        from .models import TodoUser
+        with transaction.manager:
+            user = DBSession.query(TodoUser).get(u'bob')
+            user.first_name = first_name
+
+    def test_ttl_and_invalidate(self):
+        from .profiles import ProfileCache
+        cache = ProfileCache(ttl=60, clock=lambda: self.now)
+        profile = cache.get(u'bob')
+        self.assertEqual(profile.time_zone, u'US/Eastern')
+        self.assertTrue(profile.profile_complete)
+        self._rename(u'')
+        self.assertEqual(cache.get(u'bob').first_name, u'Brave Sir')
+        self.now += 61
+        self.assertFalse(cache.get(u'bob').profile_complete)
+        self._rename(u'Sir')
+        cache.invalidate(u'bob')
+        self.assertEqual(cache.get(u'bob').first_name, u'Sir')
+        self.assertEqual(cache.get(u'nobody'), None)
+
+    def test_default_time_zone(self):
+        from .profiles import Profile
+        from .profiles import profile_time_zone
+        self.assertEqual(profile_time_zone(None), u'US/Eastern')
+        profile = Profile(u'bob', u'Brave Sir', u'Robin', None, True)
+        self.assertEqual(profile_time_zone(profile), u'US/Eastern')
+        profile = profile._replace(time_zone=u'Europe/London')
+        self.assertEqual(profile_time_zone(profile), u'Europe/London')
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        self.engine = create_engine('sqlite://')
+        # The schema from before any of the migrations
+        for statement in [
+            'CREATE TABLE users (email TEXT PRIMARY KEY, first_name TEXT, '
+            'last_name TEXT, time_zone TEXT)',
+            'CREATE TABLE tags (name TEXT PRIMARY KEY, todoitem_id INTEGER)',
+            'CREATE TABLE todoitems (id INTEGER PRIMARY KEY, '
+            'task TEXT NOT NULL, due_date DATETIME, user INTEGER NOT NULL)',
+            'CREATE TABLE todoitemtag (tag_id INTEGER, todo_id INTEGER)',
+            "INSERT INTO users VALUES ('bob', 'Brave Sir', 'Robin', "
+            "'US/Eastern')",
+            "INSERT INTO tags VALUES ('quest', NULL), ('ni', NULL), "
+            "('2024', NULL)",
+            "INSERT INTO todoitems VALUES (1, 'Run away', NULL, 'bob'), "
+            "(2, 'Find a shrubbery', NULL, 'bob')",
+            "INSERT INTO todoitemtag VALUES ('quest', 1), ('quest', 2), "
+            "('ni', 2), ('2024', 2)",
+        ]:
+            self.engine.execute(statement)
+
+    def test_migrate(self):
+        from sqlalchemy import inspect
+        from .migrations import LATEST_VERSION
+        from .migrations import migrate
+        from .migrations import pending_migrations
+        self.assertEqual(migrate(self.engine), LATEST_VERSION)
+        self.assertEqual(pending_migrations(self.engine), [])
+        self.assertEqual(migrate(self.engine), 0)
+        rows = self.engine.execute(
+            'SELECT task_count, revision FROM users').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(2, 0)])
+        rows = self.engine.execute(
+            'SELECT tag_id, task_count FROM usertags ORDER BY tag_id')
+        self.assertEqual([tuple(row) for row in rows],
+                         [(u'2024', 1), (u'ni', 1), (u'quest', 2)])
+        indexes = [i['name'] for i in inspect(self.engine).get_indexes(
+            'todoitems')]
+        self.assertTrue('ix_todoitems_user_due_date' in indexes)
+        self.assertTrue('ix_todoitems_user_task' in indexes)
+
+    def test_numeric_tags(self):
+        from .migrations import migrate
+        from .models import DBSession
+        from .models import TodoUser
+        from .models import load_sorted_tags
+        from .search import search_tasks
+        from .tasks import complete_tasks
+        migrate(self.engine)
+        types = self.engine.execute(
+            'SELECT DISTINCT typeof(tag_id) FROM todoitemtag').fetchall()
+        self.assertEqual([tuple(row) for row in types], [(u'text',)])
+        DBSession.configure(bind=self.engine)
+        try:
+            self.assertEqual(load_sorted_tags([2])[2],
+                             [u'2024', u'ni', u'quest'])
+            self.assertEqual(
+                [item.id for item in search_tasks(u'bob', u'2024', 10).items],
+                [2])
+            with transaction.manager:
+                user = DBSession.query(TodoUser).get(u'bob')
+                self.assertEqual(complete_tasks(user, [2])[0], [2])
+        finally:
+            DBSession.remove()
+
+    def test_new_database_is_stamped(self):
+        from sqlalchemy import create_engine
+        from .migrations import create_schema
+        from .migrations import pending_migrations
+        engine = create_engine('sqlite://')
+        create_schema(engine)
+        self.assertEqual(pending_migrations(engine), [])
+        create_schema(self.engine)
+        self.assertNotEqual(pending_migrations(self.engine), [])
+
+
+class TestDatabase(unittest.TestCase):
+    def test_production_profile(self):
+        import shutil
+        import tempfile
+        from .database import engine_from_settings
+        directory = tempfile.mkdtemp()
+        try:
+            engine = engine_from_settings({
+                'sqlalchemy.url': 'sqlite:///%s/test.sqlite' % directory,
+                'todopyramid.sqlite.profile': 'production',
+                'todopyramid.sqlite.pragma.busy_timeout': '1234',
+            })
+            self.assertEqual(engine.pool.size(), 4)
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute(
+                    'PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.execute(
+                    'PRAGMA busy_timeout').scalar(), 1234)
+            engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_locked_retries(self):
+        import sqlite3
+        from sqlalchemy.exc import OperationalError
+        from .database import locked_retries
+        locked = OperationalError(
+            'UPDATE', {}, sqlite3.OperationalError('database is locked'))
+        calls = []
+        for attempt in locked_retries(3, delay=0):
+            with attempt:
+                calls.append(1)
+                if len(calls) < 3:
+                    raise locked
+        self.assertEqual(len(calls), 3)
+
+        def always_locked():
+            for attempt in locked_retries(2, delay=0):
+                with attempt:
+                    raise locked
+        self.assertRaises(OperationalError, always_locked)
+
+
+class TestTaskAPI(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .profiles import ProfileCache
+        from .tagindex import TagIndex
+        self.config = testing.setUp()
+        self.config.testing_securitypolicy(userid=u'bob')
+        self.config.add_route('api.task', '/api/tasks/{id}')
+        self.config.registry.profile_cache = ProfileCache()
+        self.config.registry.tag_index = TagIndex()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob', time_zone=u'Europe/Paris'))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _api(self, **kw):
+        from .api import TaskAPI
+        return TaskAPI(None, testing.DummyRequest(**kw))
+
+    def test_create_update_delete(self):
+        from .models import DBSession
+        from .models import TodoUser
+        api = self._api(json_body=dict(
+            name=u'Find a shrubbery',
+            tags=[u'Quest', u'ni'],
+            due_date=u'2013-01-02T16:00:00+01:00',
+        ))
+        created = api.create_task()
+        self.assertEqual(api.request.response.status_int, 201)
+        self.assertEqual(created['tags'], [u'ni', u'quest'])
+        self.assertEqual(created['due_date'], u'2013-01-02T16:00:00+01:00')
+        task_id = created['id']
+        api = self._api(
+            matchdict={'id': str(task_id)},
+            json_body=dict(name=u'Find another shrubbery', tags=u'quest'),
+        )
+        updated = api.update_task()
+        self.assertEqual(updated['tags'], [u'quest'])
+        self.assertEqual(updated['due_date'], None)
+        user = DBSession.query(TodoUser).get(u'bob')
+        self.assertEqual((user.task_count, user.tag_count(u'ni')), (1, 0))
+        listed = self._api(params={'fields': 'id,name'}).list_tasks()
+        self.assertEqual(listed['tasks'], [
+            dict(id=task_id, name=u'Find another shrubbery')])
+        self.assertEqual(listed['next'], None)
+        api = self._api(matchdict={'id': str(task_id)})
+        self.assertEqual(api.delete_task().status_int, 204)
+        self.assertEqual(self._api().list_tasks()['tasks'], [])
+        api = self._api(matchdict={'id': str(task_id)})
+        api.delete_task()
+        self.assertEqual(api.request.response.status_int, 404)
+
+    def test_invalid_input(self):
+        api = self._api(json_body=dict(tags=u'quest'))
+        result = api.create_task()
+        self.assertEqual(api.request.response.status_int, 400)
+        self.assertEqual(result, {'error': 'name: Required'})
+        api = self._api(params={'fields': 'id,owner'})
+        self.assertEqual(
+            api.list_tasks(), {'error': 'Unknown fields: owner'})
+
+    def test_missing_user(self):
+        self.config.testing_securitypolicy(userid=u'tim')
+        api = self._api(json_body=dict(name=u'Find a shrubbery'))
+        self.assertEqual(api.create_task(),
+                         {'error': 'No such user, sign in again'})
+        self.assertEqual(api.request.response.status_int, 403)
+
+    def test_csrf_token(self):
+        from pyramid.exceptions import PredicateMismatch
+        from pyramid.renderers import JSON
+        from pyramid.session import SignedCookieSessionFactory
+        from webtest import TestApp
+        self.config.set_session_factory(SignedCookieSessionFactory('s'))
+        self.config.add_renderer('compact_json', JSON())
+        self.config.add_route('api.tasks', '/api/tasks')
+        self.config.scan('todopyramid.api')
+        app = TestApp(self.config.make_wsgi_app())
+        token = app.get('/api/tasks').headers['X-CSRF-Token']
+        self.assertRaises(PredicateMismatch, app.post_json, '/api/tasks',
+                          dict(name=u'Ni'))
+        app.post_json('/api/tasks', dict(name=u'Ni'), status=201,
+                      headers={'X-CSRF-Token': token})
+
+
+class TestTagFilter(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoUser
+        from .scripts.initializedb import create_dummy_content
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            DBSession.add(TodoUser(u'alice'))
+            create_dummy_content(u'bob')
+            create_dummy_content(u'alice')
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _filter(self, expression):
+        from .models import DBSession
+        from .models import TodoItem
+        from .tagfilter import parse_tag_filter
+        from .tagfilter import tag_filter_clause
+        clause = tag_filter_clause(u'bob', parse_tag_filter(expression))
+        qry = DBSession.query(TodoItem.task).filter(
+            TodoItem.user == u'bob', clause)
+        return sorted(row.task for row in qry)
+
+    def test_parse_tag_filter(self):
+        from .tagfilter import parse_tag_filter
+        tag_filter = parse_tag_filter(u'Quest+knight+-rabbit')
+        self.assertEqual(tag_filter.included, [u'quest', u'knight'])
+        self.assertEqual(tag_filter.excluded, [u'rabbit'])
+        self.assertTrue(tag_filter.match_all)
+        self.assertFalse(parse_tag_filter(u'quest,knight').match_all)
+        self.assertTrue(parse_tag_filter(u'quest,-knight').match_all)
+        self.assertEqual(parse_tag_filter(u'quest+knight,ni'), None)
+        self.assertEqual(parse_tag_filter(u'-quest'), None)
+        self.assertEqual(parse_tag_filter(u'+'.join(u'abcdefghijk')), None)
+
+    def test_and_or_not(self):
+        self.assertEqual(self._filter(u'quest+knight'), [
+            u'Find a shrubbery', u'Recruit Knights of the Round Table'])
+        self.assertEqual(self._filter(u'knight,rabbit'), [
+            u'Build a Trojan Rabbit', u'Defeat the Rabbit of Caerbannog',
+            u'Find a shrubbery', u'Recruit Knights of the Round Table'])
+        self.assertEqual(self._filter(u'knight+-discuss'),
+                         [u'Find a shrubbery'])
+        self.assertEqual(self._filter(u'quest+knight+rabbit'), [])
+
+
+class ListNotifier(object):
+    def __init__(self, settings=None):
+        self.reminders = []
+
+    def notify(self, reminders):
+        self.reminders.extend(reminders)
+
+
+class TestReminders(unittest.TestCase):
+    def setUp(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.start = datetime(2030, 1, 1)
+        self.hour = timedelta(hours=1)
+        with transaction.manager:
+            DBSession.add(TodoUser(u'bob'))
+            DBSession.add(TodoItem(u'bob', u'Someday'))
+            for hours in range(1, 6):
+                due_date = self.start + hours * self.hour
+                DBSession.add(TodoItem(u'bob', u'Task %s' % hours,
+                                       due_date=due_date))
+        self.ids = dict(DBSession.query(TodoItem.task, TodoItem.id))
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _scheduler(self, **kw):
+        from .reminders import ReminderScheduler
+        self.notifier = ListNotifier()
+        return ReminderScheduler(self.engine, self.notifier,
+                                 since=self.start, **kw)
+
+    def _sent(self):
+        return [reminder.task for reminder in self.notifier.reminders]
+
+    def test_each_reminder_sent_once(self):
+        scheduler = self._scheduler(refresh=86400)
+        self.assertEqual(scheduler.run_pending(self.start + 2 * self.hour), 2)
+        self.assertEqual(scheduler.run_pending(self.start + 2 * self.hour), 0)
+        self.assertEqual(scheduler.seconds_to_wait(self.start + 2 * self.hour),
+                         3600)
+        self.assertEqual(scheduler.run_pending(self.start + 9 * self.hour), 3)
+        self.assertEqual(self._sent(), [
+            u'Task 1', u'Task 2', u'Task 3', u'Task 4', u'Task 5'])
+
+    def test_small_queue(self):
+        scheduler = self._scheduler(queue_size=2, refresh=86400)
+        scheduler.run_pending(self.start)
+        self.assertEqual(len(scheduler.queue), 2)
+        self.assertEqual(scheduler.run_pending(self.start + 9 * self.hour), 5)
+        self.assertEqual(self._sent()[-1], u'Task 5')
+
+    def test_edits_and_deletes(self):
+        from .models import DBSession
+        from .models import TodoItem
+        from .models import TodoUser
+        from .importer import write_batch
+        from .tasks import delete_tasks
+        from .tasks import save_task
+        scheduler = self._scheduler(refresh=86400)
+        scheduler.run_pending(self.start)
+        self.config.registry.reminders = scheduler
+        with transaction.manager:
+            user = DBSession.query(TodoUser).get(u'bob')
+            delete_tasks(user, [self.ids[u'Task 1']])
+            save_task(user, u'Task 2', [], self.start + 20 * self.hour,
+                      task_id=self.ids[u'Task 2'])
+            save_task(user, u'Soon', [], self.start + self.hour / 2)
+        with transaction.manager:
+            write_batch(u'bob', [(u'Imported', self.start + self.hour, [])])
+        # An aborted delete leaves the queue alone
+        try:
+            with transaction.manager:
+                user = DBSession.query(TodoUser).get(u'bob')
+                delete_tasks(user, [self.ids[u'Task 4']])
+                raise ValueError()
+        except ValueError:
+            pass
+        # A change the scheduler was not told about is still checked
+        with transaction.manager:
+            DBSession.query(TodoItem).filter(
+                TodoItem.id == self.ids[u'Task 3']).delete()
+        self.assertEqual(scheduler.run_pending(self.start + 4 * self.hour), 3)
+        self.assertEqual(self._sent(), [u'Soon', u'Imported', u'Task 4'])
+
+    def test_tasks_added_elsewhere(self):
+        from .models import DBSession
+        from .models import TodoItem
+        scheduler = self._scheduler(refresh=7200)
+        scheduler.run_pending(self.start)
+        # Added by another process, due before the next reminder is sent
+        with transaction.manager:
+            DBSession.add(TodoItem(u'bob', u'Elsewhere',
+                                   due_date=self.start + self.hour / 2))
+        for hours in (1, 1.5, 2, 2.5):
+            scheduler.run_pending(self.start + hours * self.hour)
+        self.assertEqual(self._sent(),
+                         [u'Task 1', u'Elsewhere', u'Task 2'])
+
+    def test_file_notifier(self):
+        import json
+        import tempfile
+        from .reminders import Reminder
+        from .reminders import notifier_from_settings
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            notifier = notifier_from_settings({
+                'todopyramid.reminders.notifier': 'file',
+                'todopyramid.reminders.file': path,
+            })
+            notifier.notify([Reminder(1, u'bob', u'Task 1', self.start)])
+            with open(path) as reminder_file:
+                self.assertEqual(json.loads(reminder_file.read()), dict(
+                    id=1, user=u'bob', task=u'Task 1',
+                    due_date=u'2030-01-01T00:00:00'))
+        finally:
+            os.remove(path)
+        notifier = notifier_from_settings({
+            'todopyramid.reminders.notifier': 'todopyramid.tests.ListNotifier',
+        })
+        self.assertTrue(isinstance(notifier, ListNotifier))
+
+
+class TestSyntheticData(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        from .models import DBSession
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        from .models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_zipf(self):
+        import random
+        from .synthetic import ZipfSampler
+        sampler = ZipfSampler(list('abcdefghij'), 1.1, random.Random(1))
+        samples = [sampler.sample() for i in range(2000)]
+        self.assertTrue(samples.count('a') > samples.count('c') >
+                        samples.count('j') > 0)
+        self.assertEqual(len(set(sampler.sample_distinct(3))), 3)
+
+    def test_generate_data(self):
+        import random
+        from .models import DBSession
+        from .models import TodoUser
+        from .synthetic import TaskGenerator
+        from .synthetic import generate_data
+        rng = random.Random(0)
+        generator = TaskGenerator(rng, tag_count=20, no_due_ratio=0.5)
+        created = generate_data(2, 30, 60, generator, rng, batch_size=25)
+        with transaction.manager:
+            users = DBSession.query(TodoUser).order_by(TodoUser.email).all()
+            self.assertEqual([user.email for user in users], [
+                u'user00001@example.com', u'user00002@example.com'])
+            self.assertEqual(sum(user.task_count for user in users),
+                             created)
+            for user in users:
+                task_count, tag_counts = user.actual_counts()
+                self.assertEqual(task_count, user.task_count)
+                self.assertEqual(tag_counts, dict(
+                    (tag.tag_id, tag.task_count) for tag in user.tag_counts))
+            undated = user.todo_list.filter_by(due_date=None).count()
+            self.assertTrue(0 < undated < user.task_count)
+
+    def test_percentile(self):
+        from .scripts.benchviews import percentile
+        from .scripts.benchviews import summarize
+        timings = [i / 1000.0 for i in range(1, 101)]
+        self.assertEqual(
+            [percentile(timings, pct) for pct in (50, 95, 99)],
+            [0.05, 0.095, 0.099])
+        self.assertEqual(percentile([0.5], 99), 0.5)
+        summary = summarize([0.002, 0.001], [3, 4], None)
+        self.assertEqual((summary['p50_ms'], summary['queries']), (1.0, 3.5))
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        import logging
+        from sqlalchemy import create_engine
+        self.request = testing.DummyRequest(path='/list')
+        self.config = testing.setUp(request=self.request, settings={
+            'todopyramid.server_timing': 'true',
+            'todopyramid.slow_request_ms': '1',
+        })
+        self.engine = create_engine('sqlite://')
+        self.messages = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.messages.append(
+            record.getMessage())
+        logging.getLogger('todopyramid.instrumentation').addHandler(
+            self.handler)
+
+    def tearDown(self):
+        import logging
+        logging.getLogger('todopyramid.instrumentation').removeHandler(
+            self.handler)
+        testing.tearDown()
+
+    def test_timing_tween(self):
+        import json
+        import time
+        from pyramid.response import Response
+        from .instrumentation import setup_timing
+        from .instrumentation import timing_tween_factory
+        setup_timing(self.config, self.engine)
+
+        def handler(request):
+            self.engine.execute('SELECT 1')
+            self.engine.execute('SELECT 2')
+            time.sleep(0.002)
+            return Response('ok')
+
+        tween = timing_tween_factory(handler, self.config.registry)
+        response = tween(self.request)
+        header = response.headers['Server-Timing']
+        self.assertTrue(header.startswith('db;dur='))
+        self.assertTrue('desc="2 queries"' in header)
+        self.assertTrue('total;dur=' in header)
+        self.assertEqual(len(self.messages), 1)
+        record = json.loads(self.messages[0].split(' ', 2)[2])
+        self.assertEqual(record['path'], '/list')
+        self.assertEqual(record['queries'], 2)
+        self.assertTrue(
+            record['slowest_statement'] in ('SELECT 1', 'SELECT 2'))
+        self.assertTrue(record['total_ms'] >= 2)
+
+    def test_failed_request(self):
+        import json
+        import time
+        from pyramid.events import BeforeRender
+        from .instrumentation import start_render_timer
+        from .instrumentation import timing_tween_factory
+
+        def handler(request):
+            start_render_timer(BeforeRender({'request': request}))
+            started = request.timings.render_start
+            self.assertNotEqual(started, None)
+            start_render_timer(BeforeRender({'request': request}))
+            self.assertEqual(request.timings.render_start, started)
+            time.sleep(0.002)
+            raise ValueError('Ni')
+
+        tween = timing_tween_factory(handler, self.config.registry)
+        self.assertRaises(ValueError, tween, self.request)
+        self.assertEqual(len(self.messages), 1)
+        record = json.loads(self.messages[0].split(' ', 2)[2])
+        self.assertEqual(record['status'], None)
+        self.assertTrue(record['total_ms'] >= 2)
+
+    def test_disabled(self):
+        from sqlalchemy import event
+        from .instrumentation import setup_timing
+        from .instrumentation import start_query_timer
+        config = testing.setUp(settings={})
+        setup_timing(config, self.engine)
+        self.assertFalse(event.contains(
+            self.engine, 'before_cursor_execute', start_query_timer))
@@ -1,21 +1,87 @@
+from datetime import datetime
+
 import pytz
 
+from .cache import LRUCache
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_timezones = {}
+
+
+def get_timezone(tz_name):
+    """Return the pytz timezone for a name, looking each name up only
+    once per process.
+    """
+    try:
+        return _timezones[tz_name]
+    except KeyError:
+        timezone = _timezones[tz_name] = pytz.timezone(tz_name)
+        return timezone
+
 
 def localize_datetime(dt, tz_name):
     """Provide a timzeone-aware object for a given datetime and timezone name
     """
     assert dt.tzinfo == None
-    utc = pytz.timezone('UTC')
-    aware = utc.localize(dt)
-    timezone = pytz.timezone(tz_name)
-    tz_aware_dt = aware.astimezone(timezone)
+    aware = pytz.utc.localize(dt)
+    tz_aware_dt = aware.astimezone(get_timezone(tz_name))
     return tz_aware_dt
 
 
 def universify_datetime(dt):
     """Makes a datetime object a naive object
     """
-    utc = pytz.timezone('UTC')
-    utc_dt = dt.astimezone(utc)
+    utc_dt = dt.astimezone(pytz.utc)
     utc_dt = utc_dt.replace(tzinfo=None)
     return utc_dt
+
+
+class TimezoneConverter(object):
+    """Localizes and formats the due dates of one user, and is meant to
+    be built once per request. The timezone is looked up once, a single
+    `now` snapshot is used for all of the past due checks, and the most
+    recently formatted dates are kept in a small LRU cache since many
+    tasks share the same due date.
+    """
+
+    def __init__(self, tz_name, now=None, cache_size=256):
+        self.tz_name = tz_name
+        self.timezone = get_timezone(tz_name)
+        self.now = now or datetime.utcnow()
+        self.formatted = LRUCache(max_entries=cache_size)
+
+    def localize(self, dt):
+        """Convert a naive UTC datetime to the user's timezone.
+        """
+        assert dt.tzinfo is None
+        return pytz.utc.localize(dt).astimezone(self.timezone)
+
+    def universify(self, dt):
+        """Convert an aware datetime to a naive UTC datetime for storage.
+        """
+        return universify_datetime(dt)
+
+    def format(self, dt, format=DATE_FORMAT):
+        """Return a naive UTC datetime formatted in the user's timezone.
+        """
+        key = (dt, format)
+        formatted = self.formatted.get(key)
+        if formatted is None:
+            formatted = self.localize(dt).strftime(format)
+            self.formatted.set(key, formatted)
+        return formatted
+
+    def format_all(self, dts, format=DATE_FORMAT):
+        """Format a batch of dates, returning a dict of date to string.
+        Missing dates are skipped.
+        """
+        return dict(
+            (dt, self.format(dt, format)) for dt in set(dts) if dt is not None
+        )
+
+    def past_due(self, dt):
+        """Check if a due date has passed, as of when the converter was
+        built.
+        """
+        return dt is not None and dt < self.now
@@ -1,4 +1,8 @@
+from hashlib import sha1
+
+from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import Response
 from pyramid.security import authenticated_userid
 from pyramid.security import remember
@@ -14,17 +18,37 @@ from peppercorn import parse
 from pyramid_persona.views import verify_login
 import transaction
 
-from .grid import TodoGrid
+from .archive import archive_page
+from .database import locked_retries
+from .exporter import EXPORTERS
+from .exporter import export_app_iter
+from .grid import CompiledTodoGrid
 from .scripts.initializedb import create_dummy_content
+from .importer import guess_format
+from .importer import import_tasks
+from .importer import read_records
 from .layouts import Layouts
 from .models import DBSession
 from .models import Tag
 from .models import TodoItem
 from .models import TodoUser
+from .models import load_revision
+from .models import load_sorted_tags
+from .paging import paginate
+from .paging import sort_params
+from .profiles import profile_time_zone
 from .schema import SettingsSchema
 from .schema import TodoSchema
-from .utils import localize_datetime
-from .utils import universify_datetime
+from .search import search_tasks
+from .tagfilter import TagFilter
+from .tagfilter import parse_tag_filter
+from .tagfilter import tag_filter_clause
+from .tasks import captured_values
+from .tasks import complete_tasks
+from .tasks import delete_task
+from .tasks import delete_tasks
+from .tasks import save_task
+from .utils import TimezoneConverter
 
 
 class ToDoViews(Layouts):
@@ -39,43 +63,133 @@ class ToDoViews(Layouts):
         self.request = request
         self.user_id = authenticated_userid(request)
         self.todo_list = []
-        self.user = None
-        if self.user_id is not None:
-            query = DBSession.query(TodoUser)
-            self.user = query.filter(TodoUser.email == self.user_id).first()
 
-    def form_resources(self, form):
+    @reify
+    def user(self):
+        """The logged in user, loaded the first time a view needs it.
+        Views that only need the name or timezone should use the
+        `profile` instead.
+        """
+        if self.user_id is None:
+            return None
+        query = DBSession.query(TodoUser)
+        return query.filter(TodoUser.email == self.user_id).first()
+
+    @reify
+    def profile(self):
+        """The cached profile of the logged in user.
+        """
+        if self.user_id is None:
+            return None
+        return self.request.registry.profile_cache.get(self.user_id)
+
+    @reify
+    def time_zone(self):
+        """The user's timezone, or the default one when there is no
+        profile.
+        """
+        return profile_time_zone(self.profile)
+
+    @reify
+    def tz_converter(self):
+        """The converter used to localize the due dates of this request
+        to the user's timezone.
+        """
+        return TimezoneConverter(self.time_zone)
+
+    def form_resources(self, form, bundles=()):
         """Get a list of css and javascript resources for a given form.
         These are then used to place the resources in the global layout.
+        Resources that are part of the `bundles` the page loads are left
+        out.
         """
         resources = form.get_widget_resources()
         js_resources = resources['js']
         css_resources = resources['css']
         js_links = ['deform:static/%s' % r for r in js_resources]
         css_links = ['deform:static/%s' % r for r in css_resources]
-        return (css_links, js_links)
+        assets = self.request.registry.assets
+        return (
+            assets.unbundled(css_links, bundles),
+            assets.unbundled(js_links, bundles),
+        )
 
     def sort_order(self):
         """The list_view and tag_view both use this helper method to
-        determine what the current sort parameters are.
-        """
-        order = self.request.GET.get('order_col', 'due_date')
-        order_dir = self.request.GET.get('order_dir', 'asc')
-        if order == 'due_date':
-            # handle sorting of NULL values so they are always at the end
-            order = 'CASE WHEN due_date IS NULL THEN 1 ELSE 0 END, due_date'
-        if order == 'task':
-            # Sort ignoring case
-            order += ' COLLATE NOCASE'
-        if order_dir:
-            order = ' '.join([order, order_dir])
-        return order
+        determine what the current sort parameters are. Unknown values
+        fall back to the default of due date, ascending.
+        """
+        return sort_params(
+            self.request.GET.get('order_col'),
+            self.request.GET.get('order_dir'),
+        )
+
+    def paginate(self, query):
+        """Fetch the page of tasks the `after` or `before` cursors in the
+        request point to, ordered by the current sort parameters.
+        """
+        settings = self.request.registry.settings
+        page_size = int(settings.get('todopyramid.page_size', 100))
+        order, order_dir = self.sort_order()
+        return paginate(
+            query,
+            order,
+            order_dir,
+            page_size,
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before'),
+        )
+
+    def not_modified(self):
+        """Set the ETag and Last-Modified headers for one of the pages
+        showing the user's tasks or tags, and return a 304 response if
+        the client already has the current page. Returns None when the
+        page has to be rendered.
+
+        The user's revision is looked up together with the next due date
+        still to come, so that the page is rendered again once a task
+        becomes past due. The ETag also covers the query string (sort
+        parameters and cursors), any pending flash messages, and the
+        version of the app and its asset bundles, so pages cached before
+        a deploy are not served with stale links.
+        """
+        request = self.request
+        if request.method not in ('GET', 'HEAD') or self.user_id is None:
+            return None
+        row = load_revision(self.user_id)
+        if row is None:
+            return None
+        revision, modified, next_due = row
+        session = request.session
+        flash = [
+            session.peek_flash(queue)
+            for queue in ('', 'success', 'info', 'error')
+        ]
+        state = repr((
+            self.user_id,
+            session.get_csrf_token(),
+            request.matched_route.name,
+            sorted(request.matchdict.items()),
+            sorted(request.GET.items()),
+            flash,
+            next_due,
+            request.registry.assets.version,
+        ))
+        response = request.response
+        response.etag = '%s-%s' % (
+            revision, sha1(state.encode('utf-8')).hexdigest()[:16])
+        response.last_modified = modified
+        response.cache_control = 'private, no-cache'
+        if response.etag in request.if_none_match:
+            response.status = 304
+            return response
+        return None
 
     def generate_task_form(self, formid="deform"):
         """This helper code generates the form that will be used to add
         and edit the tasks based on the schema of the form.
         """
-        schema = TodoSchema().bind(user_tz=self.user.time_zone)
+        schema = TodoSchema().bind(user_tz=self.time_zone)
         options = """
         {success:
           function (rText, sText, xhr, form) {
@@ -96,6 +210,21 @@ class ToDoViews(Layouts):
             ajax_options=options,
         )
 
+    def rendered_task_form(self, tag_name=None):
+        """The empty task form, with `tag_name` filled in, and its
+        resources. The rendered form is cached for each time zone and
+        tag, so Deform is only used on a miss.
+        """
+        def render():
+            form = self.generate_task_form()
+            appstruct = {'tags': tag_name} if tag_name else {}
+            css_resources, js_resources = self.form_resources(
+                form, bundles=('todo_list.css', 'todo_list.js'))
+            return form.render(appstruct), css_resources, js_resources
+
+        return self.request.registry.form_cache.get(
+            self.time_zone, tag_name, render)
+
     def process_task_form(self, form):
         """This helper code processes the task from that we have
         generated from Colander and Deform.
@@ -107,27 +236,16 @@ class ToDoViews(Layouts):
             # try to validate the submitted values
             controls = self.request.POST.items()
             captured = form.validate(controls)
-            action = 'created'
-            with transaction.manager:
-                tags = captured.get('tags', [])
-                if tags:
-                    tags = tags.split(',')
-                due_date = captured.get('due_date')
-                if due_date is not None:
-                    # Convert back to UTC for storage
-                    due_date = universify_datetime(due_date)
-                task_name = captured.get('name')
-                task = TodoItem(
-                    user=self.user_id,
-                    task=task_name,
-                    tags=tags,
-                    due_date=due_date,
-                )
-                task_id = captured.get('id')
-                if task_id is not None:
-                    action = 'updated'
-                    task.id = task_id
-                DBSession.merge(task)
+            task_name, tags, due_date = captured_values(captured)
+            for attempt in locked_retries():
+                with attempt:
+                    task, created, added_tags, removed_tags = save_task(
+                        self.user, task_name, tags, due_date,
+                        task_id=captured.get('id'),
+                    )
+            action = 'created' if created else 'updated'
+            if added_tags or removed_tags:
+                self.request.registry.tag_index.invalidate(self.user_id)
             msg = "Task <b><i>%s</i></b> %s successfully" % (task_name, action)
             self.request.session.flash(msg, queue='success')
             # Reload the page we were on
@@ -190,6 +308,7 @@ class ToDoViews(Layouts):
         """
         email = verify_login(self.request)
         headers = remember(self.request, email)
+        self.request.registry.profile_cache.invalidate(email)
         # Check to see if the user exists
         user = DBSession.query(TodoUser).filter(
             TodoUser.email == email).first()
@@ -246,11 +365,15 @@ class ToDoViews(Layouts):
                 }
             values = parse(self.request.params.items())
             # Update the user
-            with transaction.manager:
-                self.user.first_name = values.get('first_name', u'')
-                self.user.last_name = values.get('last_name', u'')
-                self.user.time_zone = values.get('time_zone', u'US/Eastern')
-                DBSession.add(self.user)
+            for attempt in locked_retries():
+                with attempt:
+                    self.user.first_name = values.get('first_name', u'')
+                    self.user.last_name = values.get('last_name', u'')
+                    self.user.time_zone = values.get(
+                        'time_zone', u'US/Eastern')
+                    DBSession.add(self.user)
+                    self.user.touch()
+            self.request.registry.profile_cache.invalidate(self.user_id)
             self.request.session.flash(
                 'Settings updated successfully',
                 queue='success',
@@ -276,15 +399,16 @@ class ToDoViews(Layouts):
     def tag_autocomplete(self):
         """Get a list of dictionaries for the given term. This gives
         the tag input the information it needs to do auto completion.
+        Only the user's own tags are suggested, most used first.
         """
         term = self.request.params.get('term', '')
         if len(term) < 2:
             return []
-        # XXX: This is global tags, need to hook into "user_tags"
-        tags = DBSession.query(Tag).filter(Tag.name.startswith(term)).all()
+        tag_index = self.request.registry.tag_index
+        tags = tag_index.complete(self.user_id, term)
         return [
-            dict(id=tag.name, value=tag.name, label=tag.name)
-            for tag in tags
+            dict(id=tag_name, value=tag_name, label=tag_name)
+            for tag_name in tags
         ]
 
     @view_config(renderer='json', name='edit.task', permission='view')
@@ -299,8 +423,7 @@ class ToDoViews(Layouts):
         due_date = None
         # If there is a due date, localize the time
         if task.due_date is not None:
-            due_dt = localize_datetime(task.due_date, self.user.time_zone)
-            due_date = due_dt.strftime('%Y-%m-%d %H:%M:%S')
+            due_date = self.tz_converter.format(task.due_date)
         return dict(
             id=task.id,
             name=task.task,
@@ -308,20 +431,134 @@ class ToDoViews(Layouts):
             due_date=due_date,
         )
 
-    @view_config(renderer='json', name='delete.task', permission='view')
+    @view_config(renderer='json', name='delete.task', permission='view',
+                 check_csrf=True)
     def delete_task(self):
-        """Delete a todo list item
-
-        TODO: Add a guard here so that you can only delete your tasks
+        """Delete a todo list item. Only the tasks of the current user
+        can be deleted.
         """
         todo_id = self.request.params.get('id', None)
         if todo_id is not None:
-            todo_item = DBSession.query(TodoItem).filter(
-                TodoItem.id == todo_id)
-            with transaction.manager:
-                todo_item.delete()
+            try:
+                todo_id = int(todo_id)
+            except ValueError:
+                return False
+            for attempt in locked_retries():
+                with attempt:
+                    tags = delete_task(self.user, todo_id)
+            if tags:
+                self.request.registry.tag_index.invalidate(self.user_id)
         return True
 
+    def batch_ids(self):
+        """The task ids of a batch request, given as a comma separated
+        list of `ids`. Returns None if they are not all numbers.
+        """
+        try:
+            return [
+                int(todo_id)
+                for todo_id in self.request.params.get('ids', '').split(',')
+                if todo_id.strip()
+            ]
+        except ValueError:
+            return None
+
+    def apply_batch(self, action):
+        """Run `delete_tasks` or `complete_tasks` on the tasks of a batch
+        request, and return the ids of the tasks it removed.
+        """
+        todo_ids = self.batch_ids()
+        if todo_ids is None:
+            return False
+        removed = []
+        if todo_ids:
+            for attempt in locked_retries():
+                with attempt:
+                    removed, tags = action(self.user, todo_ids)
+            if tags:
+                self.request.registry.tag_index.invalidate(self.user_id)
+        return {'deleted': removed}
+
+    @view_config(renderer='json', name='delete.tasks', permission='view',
+                 request_method='POST', check_csrf=True)
+    def delete_tasks(self):
+        """Delete a batch of todo list items at once, given as a comma
+        separated list of `ids`. Only the tasks of the current user are
+        deleted, and their ids are returned so the page can be updated.
+        """
+        return self.apply_batch(delete_tasks)
+
+    @view_config(renderer='json', name='complete.tasks', permission='view',
+                 request_method='POST', check_csrf=True)
+    def complete_tasks(self):
+        """Complete a batch of todo list items, moving them out of the
+        list and into the archive. Works like `delete_tasks`.
+        """
+        return self.apply_batch(complete_tasks)
+
+    @view_config(renderer='json', name='import.tasks', permission='view',
+                 request_method='POST', check_csrf=True)
+    def import_tasks_view(self):
+        """Bulk import tasks from a JSONL or CSV file. The file can be
+        uploaded in the `file` field of a form or sent as the request
+        body. The records are read and inserted in batches as the
+        upload is streamed, and a report of the rows that could not be
+        imported is returned.
+        """
+        upload = self.request.POST.get('file')
+        if hasattr(upload, 'file'):
+            stream = upload.file
+            filename = upload.filename
+        else:
+            stream = self.request.body_file
+            filename = None
+        format = guess_format(
+            self.request.GET.get('format'),
+            filename,
+            self.request.content_type,
+        )
+        if format is None:
+            self.request.response.status = 400
+            return {'error': 'Unknown import format, use jsonl or csv'}
+        settings = self.request.registry.settings
+        batch_size = int(settings.get('todopyramid.import.batch_size', 500))
+        report = import_tasks(
+            self.user_id,
+            read_records(stream, format),
+            batch_size=batch_size,
+        )
+        if report.imported:
+            self.request.registry.tag_index.invalidate(self.user_id)
+        return report.as_dict()
+
+    @view_config(route_name='export', permission='view')
+    def export_view(self):
+        """Stream all of the user's tasks as JSONL, CSV or an iCalendar
+        feed, depending on the extension in the url. The response has an
+        ETag and Last-Modified date so that clients polling the export
+        get a cheap 304 when nothing has changed.
+        """
+        # Special case when the db was blown away
+        if self.user_id is not None and self.user is None:
+            return self.logout()
+        format = self.request.matchdict['format']
+        exporter_class = EXPORTERS.get(format)
+        if exporter_class is None:
+            raise HTTPNotFound()
+        exporter = exporter_class(self.user.time_zone, self.user.modified)
+        response = Response(
+            content_type=exporter_class.content_type,
+            charset='utf-8',
+            conditional_response=True,
+        )
+        response.etag = '%s-%s' % (format, self.user.revision)
+        response.last_modified = self.user.modified
+        if format != 'ics':
+            response.content_disposition = (
+                'attachment; filename="tasks.%s"' % exporter.extension)
+        response.app_iter = export_app_iter(self.user_id, exporter)
+        return response
+
     @view_config(route_name='home', renderer='templates/home.pt')
     def home_view(self):
         """This is the first page the user will see when coming to the
@@ -338,7 +575,7 @@ class ToDoViews(Layouts):
         if self.user_id is None:
             count = None
         else:
-            count = len(self.user.todo_list.all())
+            count = self.user.task_count
         return {'user': self.user, 'count': count, 'section': 'home'}
 
     @view_config(route_name='list', renderer='templates/todo_list.pt',
@@ -348,24 +585,31 @@ class ToDoViews(Layouts):
         shows a listing of the tasks that the currently logged in user
         has created.
         """
+        not_modified = self.not_modified()
+        if not_modified is not None:
+            return not_modified
         # Special case when the db was blown away
         if self.user_id is not None and self.user is None:
             return self.logout()
-        form = self.generate_task_form()
         if 'submit' in self.request.POST:
-            return self.process_task_form(form)
-        order = self.sort_order()
-        todo_items = self.user.todo_list.order_by(order).all()
-        grid = TodoGrid(
+            return self.process_task_form(self.generate_task_form())
+        page = self.paginate(self.user.todo_list)
+        todo_items = page.items
+        tag_map = load_sorted_tags([item.id for item in todo_items])
+        grid = CompiledTodoGrid(
             self.request,
             None,
-            self.user.time_zone,
+            self.time_zone,
             todo_items,
             ['task', 'tags', 'due_date', ''],
+            tag_map=tag_map,
+            page=page,
+            converter=self.tz_converter,
+            fragment_cache=self.request.registry.fragment_cache,
         )
-        count = len(todo_items)
+        count = self.user.task_count
         item_label = 'items' if count > 1 or count == 0 else 'item'
-        css_resources, js_resources = self.form_resources(form)
+        form = self.rendered_task_form()
         return {
             'page_title': 'Todo List',
             'count': count,
@@ -373,9 +617,98 @@ class ToDoViews(Layouts):
             'section': 'list',
             'items': todo_items,
             'grid': grid,
-            'form': form.render(),
-            'css_resources': css_resources,
-            'js_resources': js_resources,
+            'form': form.html,
+            'css_resources': form.css,
+            'js_resources': form.js,
+        }
+
+    @view_config(route_name='search', renderer='templates/todo_list.pt',
+                 permission='view')
+    def search_view(self):
+        """Like the list_view, but only with the tasks whose name or tags
+        match the words searched for in `q`, best match first.
+        """
+        not_modified = self.not_modified()
+        if not_modified is not None:
+            return not_modified
+        # Special case when the db was blown away
+        if self.user_id is not None and self.user is None:
+            return self.logout()
+        if 'submit' in self.request.POST:
+            return self.process_task_form(self.generate_task_form())
+        registry = self.request.registry
+        page_size = int(registry.settings.get('todopyramid.page_size', 100))
+        search_text = self.request.GET.get('q', u'')
+        page = search_tasks(
+            self.user_id,
+            search_text,
+            page_size,
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before'),
+            full_text=getattr(registry, 'full_text_search', False),
+        )
+        todo_items = page.items
+        tag_map = load_sorted_tags([item.id for item in todo_items])
+        grid = CompiledTodoGrid(
+            self.request,
+            None,
+            self.time_zone,
+            todo_items,
+            ['task', 'tags', 'due_date', ''],
+            tag_map=tag_map,
+            page=page,
+            converter=self.tz_converter,
+            fragment_cache=registry.fragment_cache,
+        )
+        # The results are ranked, so the columns can not be sorted
+        grid.exclude_ordering = grid.columns
+        count = page.total
+        item_label = 'items' if count > 1 or count == 0 else 'item'
+        form = self.rendered_task_form()
+        return {
+            'page_title': 'Search',
+            'count': count,
+            'item_label': item_label,
+            'section': 'list',
+            'search_text': search_text,
+            'items': todo_items,
+            'grid': grid,
+            'form': form.html,
+            'css_resources': form.css,
+            'js_resources': form.js,
+        }
+
+    @view_config(route_name='archive', renderer='templates/archive.pt',
+                 permission='view')
+    def archive_view(self):
+        """List the tasks the user has completed, most recent first. The
+        archive is paged with the ids of the tasks at either end of a
+        page.
+        """
+        not_modified = self.not_modified()
+        if not_modified is not None:
+            return not_modified
+        # Special case when the db was blown away
+        if self.user_id is not None and self.user is None:
+            return self.logout()
+        settings = self.request.registry.settings
+        page_size = int(settings.get('todopyramid.page_size', 100))
+        cursors = {}
+        for key in ('after', 'before'):
+            try:
+                cursors[key] = int(self.request.GET[key])
+            except (KeyError, ValueError):
+                cursors[key] = None
+        page = archive_page(self.user_id, page_size, **cursors)
+        converter = self.tz_converter
+        dates = converter.format_all(
+            [item.due_date for item in page.items] +
+            [item.completed for item in page.items])
+        return {
+            'page_title': 'Archive',
+            'section': 'archive',
+            'page': page,
+            'dates': dates,
         }
 
     @view_config(route_name='tags', renderer='templates/todo_tags.pt',
@@ -383,6 +716,9 @@ class ToDoViews(Layouts):
     def tags_view(self):
         """This view simply shows all of the tags a user has created.
         """
+        not_modified = self.not_modified()
+        if not_modified is not None:
+            return not_modified
         # Special case when the db was blown away
         if self.user_id is not None and self.user is None:
             return self.logout()
@@ -393,34 +729,69 @@ class ToDoViews(Layouts):
             'tags': tags,
         }
 
+    def tag_filter(self, tag_name):
+        """Parse the tags in the url of a tag page. A tag that has a `+`
+        or a `,` in its name is shown on its own when it exists.
+        """
+        special = '+' in tag_name or ',' in tag_name
+        if special or tag_name.startswith('-'):
+            qry = DBSession.query(Tag.name).filter(Tag.name == tag_name)
+            if qry.first() is not None:
+                return TagFilter([tag_name], [], True)
+        return parse_tag_filter(tag_name)
+
     @view_config(route_name='tag', renderer='templates/todo_list.pt',
                  permission='view')
     def tag_view(self):
         """Very similar to the list_view, this view just filters the
-        list of tags down to the tag selected in the url based on the
+        list of tags down to the tags selected in the url based on the
         tag route replacement marker that ends up in the `matchdict`.
+        Several tags can be given, see `tagfilter.parse_tag_filter`.
         """
+        not_modified = self.not_modified()
+        if not_modified is not None:
+            return not_modified
         # Special case when the db was blown away
         if self.user_id is not None and self.user is None:
             return self.logout()
-        form = self.generate_task_form()
         if 'submit' in self.request.POST:
-            return self.process_task_form(form)
-        order = self.sort_order()
-        qry = self.user.todo_list.order_by(order)
+            return self.process_task_form(self.generate_task_form())
         tag_name = self.request.matchdict['tag_name']
-        tag_filter = TodoItem.tags.any(Tag.name.in_([tag_name]))
-        todo_items = qry.filter(tag_filter)
-        count = todo_items.count()
+        tag_filter = self.tag_filter(tag_name)
+        if tag_filter is None:
+            raise HTTPNotFound()
+        single = len(tag_filter.included) == 1 and not tag_filter.excluded
+        if single:
+            clause = TodoItem.tags.any(Tag.name == tag_filter.included[0])
+        else:
+            clause = tag_filter_clause(self.user_id, tag_filter)
+        qry = self.user.todo_list.filter(clause)
+        page = self.paginate(qry)
+        todo_items = page.items
+        if single:
+            count = self.user.tag_count(tag_filter.included[0])
+        elif not page.has_prev and not page.has_next:
+            # All of the matching tasks are on this page
+            count = len(todo_items)
+        else:
+            count = qry.count()
         item_label = 'items' if count > 1 or count == 0 else 'item'
-        grid = TodoGrid(
+        tag_map = load_sorted_tags([item.id for item in todo_items])
+        grid = CompiledTodoGrid(
             self.request,
-            tag_name,
-            self.user.time_zone,
+            tag_filter.included,
+            self.time_zone,
             todo_items,
             ['task', 'tags', 'due_date', ''],
+            tag_map=tag_map,
+            page=page,
+            converter=self.tz_converter,
+            fragment_cache=self.request.registry.fragment_cache,
         )
-        css_resources, js_resources = self.form_resources(form)
+        form_tags = None
+        if tag_filter.match_all:
+            form_tags = u','.join(tag_filter.included)
+        form = self.rendered_task_form(form_tags)
         return {
             'page_title': 'Tag List',
             'count': count,
@@ -429,7 +800,7 @@ class ToDoViews(Layouts):
             'tag_name': tag_name,
             'items': todo_items,
             'grid': grid,
-            'form': form.render({'tags': tag_name}),
-            'css_resources': css_resources,
-            'js_resources': js_resources,
+            'form': form.html,
+            'css_resources': form.css,
+            'js_resources': form.js,
         }